@@ -1,11 +1,78 @@
 # -*- coding: utf-8 -*-
+import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from generator import Generator
+import record
+from catalog import Catalog
+from generator import Generator, PagedGenerator
+from metadata import Metadata
+from metrics import REGISTRY
+from profiler import PROFILER
 from reader import Reader
 
+LOAD_TIME = REGISTRY.histogram(
+    "velasco_load_seconds",
+    "Time taken to load a chat's card or vocabulary.",
+    labels=("part",),
+)
+LOAD_BYTES = REGISTRY.counter(
+    "velasco_load_bytes_total",
+    "Bytes of the chat files loaded (record files are mapped, not read whole).",
+    labels=("part",),
+)
+
+
+# What has to be written to store a chat. It's taken from the chat's Reader
+# by Archivist.prepare(...), so that Archivist.write(...) can then write the
+# files from another thread while the Reader keeps being used
+class StoreJob(object):
+    def __init__(self, tag, card, vocab=None, journal=None):
+        # The chat's ID
+        self.tag = tag
+        # The Metadata card dump
+        self.card = card
+        # A Generator (or a JSON dump) to be written whole, if any
+        self.vocab = vocab
+        # The lists of words to append to the journal after that, if any
+        self.journal = journal
+        # The last message log segment whose messages are in this job, if any
+        self.log = None
+        # The PagedGenerator being spilled by this job and its spill, if any
+        self.spill = None
+
+    # Folds a newer job for the same chat into this one, so both can be
+    # written at once
+    def merge(self, job):
+        self.card = job.card
+        if job.vocab is not None:
+            self.vocab = job.vocab
+            self.journal = job.journal
+        elif job.journal is not None:
+            self.journal = (self.journal or []) + job.journal
+        if job.log is not None:
+            self.log = job.log
+        if job.spill is not None:
+            self.spill = job.spill
+
+
+# Writes a text file whole, or leaves the old one as it was: the text is
+# written to a temporary file first, which then replaces it
+def write_atomic(filepath, text, encoding=None):
+    temp = filepath + ".tmp"
+    with open(temp, "w", encoding=encoding) as file:
+        written = file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp, filepath)
+    return written
+
 
 class Archivist(object):
+    # File extension for the journal files
+    JOURNAL_EXT = ".vlj"
+
     def __init__(
         self,
         logger,
@@ -17,6 +84,14 @@ class Archivist(object):
         min_period=1,
         max_period=100000,
         read_only=False,
+        binary=True,
+        journal_size=2**23,
+        resident_keys=None,
+        use_catalog=True,
+        vocab_limit=None,
+        message_log=None,
+        short_memory=None,
+        commit_batch=50,
     ):
         if chatdir is None or len(chatdir) == 0:
             chatdir = "./"
@@ -30,6 +105,38 @@ class Archivist(object):
         self.min_period = min_period
         self.max_period = max_period
         self.read_only = read_only
+        # Wether vocabularies are saved as binary records instead of JSON
+        self.binary = binary
+        # Size (in bytes) of a chat's journal files from which they are folded
+        # into a new record file. With 0, record files are always rewritten
+        self.journal_size = journal_size
+        # Maximum number of keys read from a chat's record file that are kept
+        # in memory, or None to keep all of them
+        self.resident_keys = resident_keys
+        # Size budget (in bytes) of a chat's vocabulary, over which it's
+        # pruned when stored, unless its card sets another. None for no limit
+        self.vocab_limit = vocab_limit
+        # The MessageLog of the messages not saved yet, if any
+        self.message_log = message_log
+        # Maximum number of messages in a Reader's short term memory, or None
+        # for no limit, and the number committed at once from it
+        self.short_memory = short_memory
+        self.commit_batch = commit_batch
+        # Background thread folding journals into record files
+        self.compactor = None
+        # Chats whose journal is being folded
+        self.compacting = set()
+        self.compacting_lock = threading.Lock()
+        # Held while replacing record files and removing the journal files
+        # that were folded into them
+        self.record_lock = threading.Lock()
+        # The catalog of every chat's Metadata card. Without use_catalog it's
+        # left as it is when cards are written (as when many processes write
+        # them at once), and the changed cards are read again when it's next
+        # loaded
+        self.use_catalog = use_catalog
+        self.catalog = Catalog(self.chatdir + "/catalog.vlc", logger)
+        self.catalog_lock = threading.Lock()
 
     # Formats and returns a chat folder path
     def chat_folder(self, *formatting, **key_format):
@@ -43,11 +150,68 @@ class Archivist(object):
 
     # Stores a Reader/Generator file pair
     def store(self, tag, data, vocab):
+        job = self.prepare(tag, data, vocab, copy=False)
+        try:
+            self.write(job)
+        except Exception:
+            self.end_spill(job, False)
+            raise
+        self.end_spill(job)
+
+    # Takes what has to be written to store a Reader/Generator pair: the words
+    # learned since it was last saved if only those are needed, or the whole
+    # Generator otherwise. With copy=True the Generator is copied, so that the
+    # StoreJob can be written while the original keeps learning
+    # The messages logged until now are in the StoreJob, so the chat's
+    # message log moves on to a new segment
+    def prepare(self, tag, data, vocab, copy=True):
+        if vocab is None or isinstance(vocab, str):
+            job = StoreJob(tag, data, vocab)
+        elif self.can_journal(tag, vocab):
+            journal = vocab.journal
+            vocab.journal = []
+            job = StoreJob(tag, data, journal=journal)
+        elif copy:
+            whole = vocab.copy()
+            vocab.journal = []
+            job = StoreJob(tag, data, vocab=whole)
+        else:
+            job = StoreJob(tag, data, vocab=vocab)
+        if isinstance(vocab, PagedGenerator) and job.vocab is not None:
+            job.spill = (vocab, vocab.spill())
+        self.seal_log(job)
+        return job
+
+    # Ends the spill of the PagedGenerator of a StoreJob once it's written
+    # (or failed to be), so that it reads its keys from the new record file.
+    # It has to be called from where the Generator is used
+    def end_spill(self, job, written=True):
+        if job.spill is None:
+            return
+        vocab, spill = job.spill
+        records = None
+        filepath = self.chat_file(tag=job.tag, file="record", ext=record.EXTENSION)
+        try:
+            if written and not self.read_only and os.path.exists(filepath):
+                records = record.RecordFile(filepath)
+        finally:
+            vocab.refresh(spill, records)
+
+    # Moves the chat's message log on to a new segment, as the messages logged
+    # until now are in the StoreJob
+    def seal_log(self, job):
+        if self.message_log is not None:
+            job.log = self.message_log.seal(job.tag)
+
+    # Writes the files of a StoreJob, returning the number of bytes written
+    @PROFILER.hook("archivist.store")
+    def write(self, job):
+        tag = job.tag
         chat_folder = self.chat_folder(tag=tag)
         chat_card = self.chat_file(tag=tag, file="card", ext=".txt")
 
         if self.read_only:
-            return
+            return 0
         try:
             if not os.path.exists(chat_folder):
                 os.makedirs(chat_folder, exist_ok=True)
@@ -56,16 +220,221 @@ class Archivist(object):
                 )
         except Exception:
             self.logger.error("Failed creating {} folder.".format(chat_folder))
+            return 0
+        written = write_atomic(chat_card, job.card)
+        if self.use_catalog:
+            self.get_catalog().put(tag, job.card, os.stat(chat_card).st_mtime_ns)
+
+        if job.vocab is not None:
+            written += self.store_vocab(tag, job.vocab) or 0
+        if job.journal is not None:
+            written += self.append_journal(tag, job.journal)
+        self.clear_log(job)
+        return written
+
+    # Removes the message log segments whose messages a written StoreJob
+    # saved
+    def clear_log(self, job):
+        if self.message_log is not None and job.log is not None:
+            self.message_log.remove(job.tag, job.log)
+
+    # Reads again into a Reader the messages of its chat's message log that
+    # weren't saved when the bot last stopped
+    def replay_log(self, tag, reader):
+        if self.message_log is None:
             return
-        file = open(chat_card, "w")
-        file.write(data)
-        file.close()
-
-        if vocab is not None:
-            chat_record = self.chat_file(tag=tag, file="record", ext=self.chatext)
-            file = open(chat_record, "w", encoding="utf-16")
-            file.write(vocab)
-            file.close()
+        entries = self.message_log.replay(tag)
+        if len(entries) > 0:
+            reader.replay(entries)
+            self.logger.info(
+                "Replayed {} unsaved messages of chat {}.".format(len(entries), tag)
+            )
+
+    # Saves the chats with messages left in the message log by the last run.
+    # Chats that were never saved are left for when they are read again, as
+    # their Reader can't be made without the Telegram chat
+    def recover_log(self):
+        if self.message_log is None or self.read_only:
+            return
+        for tag in self.message_log.tags():
+            reader = self.get_reader(tag)
+            if reader is not None:
+                self.store(*reader.archive())
+
+    # Stores a Generator, or a Generator's JSON dump, as the chat's vocabulary.
+    # Only one format is kept for each chat, so the file in the other one is
+    # removed once the new one is written. Returns the size of the new file
+    def store_vocab(self, tag, vocab):
+        if self.read_only:
+            return 0
+        legacy_record = self.chat_file(tag=tag, file="record", ext=self.chatext)
+        binary_record = self.chat_file(tag=tag, file="record", ext=record.EXTENSION)
+        if self.binary and not isinstance(vocab, str):
+            with self.record_lock:
+                # The new record file has everything, journals included
+                journals = self.journal_files(tag)
+                number = self.journal_number(tag, journals)
+                record.save(vocab, binary_record, journal=number)
+                for _, filepath in journals:
+                    os.remove(filepath)
+            vocab.journal = []
+            stale = legacy_record
+            written = os.path.getsize(binary_record)
+        else:
+            if not isinstance(vocab, str):
+                vocab = vocab.dumps()
+            write_atomic(legacy_record, vocab, encoding="utf-16")
+            for _, filepath in self.journal_files(tag):
+                os.remove(filepath)
+            stale = binary_record
+            written = os.path.getsize(legacy_record)
+        if os.path.exists(stale):
+            os.remove(stale)
+        return written
+
+    # Tells whether only what a Generator learned since it was last saved has
+    # to be stored, as the rest is already in the chat's record file
+    def can_journal(self, tag, vocab):
+        return (
+            self.binary
+            and self.journal_size > 0
+            and isinstance(vocab, Generator)
+            and vocab.journal is not None
+            and not vocab.over_capacity()
+            and os.path.exists(
+                self.chat_file(tag=tag, file="record", ext=record.EXTENSION)
+            )
+        )
+
+    # Lists the journal files of a chat, as (number, path) pairs in order
+    def journal_files(self, tag):
+        chat_folder = self.chat_folder(tag=tag)
+        if not os.path.isdir(chat_folder):
+            return []
+        journals = []
+        for name in os.listdir(chat_folder):
+            if name.startswith("journal_") and name.endswith(Archivist.JOURNAL_EXT):
+                try:
+                    number = int(name[8 : -len(Archivist.JOURNAL_EXT)])
+                except ValueError:
+                    continue
+                journals.append((number, os.path.join(chat_folder, name)))
+        return sorted(journals)
+
+    # Returns the number of the last journal file of a chat, which is the one
+    # that new words get appended to
+    def journal_number(self, tag, journals=None):
+        if journals is None:
+            journals = self.journal_files(tag)
+        filepath = self.chat_file(tag=tag, file="record", ext=record.EXTENSION)
+        base = record.journal_of(filepath) if os.path.exists(filepath) else 0
+        if len(journals) > 0:
+            return max(journals[-1][0], base + 1)
+        return base + 1
+
+    # Appends the lists of words a Generator learned since it was last saved
+    # to the chat's journal, and sets its journal to be folded into a new
+    # record file if it's grown too big. Returns the number of bytes appended
+    def append_journal(self, tag, journal):
+        written = 0
+        if len(journal) > 0:
+            filepath = self.chat_file(
+                tag=tag,
+                file="journal_{}".format(self.journal_number(tag)),
+                ext=Archivist.JOURNAL_EXT,
+            )
+            with open(filepath, "a", encoding="utf-8") as file:
+                for words in journal:
+                    line = json.dumps(words, ensure_ascii=False) + "\n"
+                    written += len(line.encode("utf-8"))
+                    file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+        # The compactor removes the journals it folds while holding the lock
+        with self.record_lock:
+            journals = self.journal_files(tag)
+            size = sum(os.path.getsize(filepath) for _, filepath in journals)
+        if len(journals) > 0 and size >= self.journal_size:
+            self.compact(tag, journals[-1][0])
+        return written
+
+    # Loads the lists of words of a journal file
+    def load_journal(self, filepath):
+        journal = []
+        with open(filepath, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    journal.append(json.loads(line))
+                except ValueError:
+                    # The bot stopped while writing this line, nothing follows
+                    self.logger.warning(
+                        "Journal file {} is cut short.".format(filepath)
+                    )
+                    break
+        return journal
+
+    # Starts folding the journal files of a chat, up to the given number, into
+    # a new record file in the background. New words go to the next journal
+    def compact(self, tag, number):
+        with self.compacting_lock:
+            if tag in self.compacting:
+                return
+            self.compacting.add(tag)
+        open(
+            self.chat_file(
+                tag=tag, file="journal_{}".format(number + 1), ext=Archivist.JOURNAL_EXT
+            ),
+            "a",
+        ).close()
+        if self.compactor is None:
+            self.compactor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="compactor"
+            )
+        self.compactor.submit(self.fold_journal, tag, number)
+
+    # Folds the journal files of a chat, up to the given number, into a new
+    # record file. This reads everything from files, so it's safe to run while
+    # the chat's Generator keeps learning
+    def fold_journal(self, tag, number):
+        filepath = self.chat_file(tag=tag, file="record", ext=record.EXTENSION)
+        records = None
+        try:
+            records = record.RecordFile(filepath)
+            base = records.journal
+            vocab = Generator(load=records, mode=Generator.MODE_RECORD)
+            journals = [
+                journal
+                for journal in self.journal_files(tag)
+                if base < journal[0] <= number
+            ]
+            for _, journal in journals:
+                vocab.replay(self.load_journal(journal))
+            with self.record_lock:
+                if record.journal_of(filepath) != base:
+                    # The record file has been rewritten whole in the meantime
+                    return
+                record.save(vocab, filepath, journal=number)
+                for _, journal in journals:
+                    os.remove(journal)
+            self.logger.info(
+                "Folded {} journal files into the record of chat {}.".format(
+                    len(journals), tag
+                )
+            )
+        except Exception as e:
+            self.logger.error("Failed folding the journal of chat {}".format(tag))
+            self.logger.exception(e)
+        finally:
+            if records is not None:
+                records.close()
+            with self.compacting_lock:
+                self.compacting.discard(tag)
+
+    # Waits for any journal still being folded
+    def close(self):
+        if self.compactor is not None:
+            self.compactor.shutdown(wait=True)
+            self.compactor = None
 
     # Loads a Generator's vocabulary file dump
     def load_vocab(self, tag):
@@ -105,22 +474,106 @@ class Archivist(object):
             self.logger.error("Metadata file {} not found.".format(filepath))
             return None
 
-    # Returns a Reader for a given ID with an already working vocabulary - be it
-    # new or loaded from file
+    # Returns a chat's vocabulary Generator, opening the binary record file if
+    # there is one (which is then read lazily, after replaying its journal,
+    # keeping only resident_keys of its keys in memory if set), or loading
+    # the JSON file otherwise. Gives an empty Generator if there are none
+    def get_vocab(self, tag):
+        filepath = self.chat_file(tag=tag, file="record", ext=record.EXTENSION)
+        if os.path.exists(filepath):
+            records = record.RecordFile(filepath)
+            if self.resident_keys is None or not self.binary:
+                vocab = Generator(load=records, mode=Generator.MODE_RECORD)
+            else:
+                vocab = PagedGenerator(records, self.resident_keys)
+            # Learn whatever was appended to the journal since it was written
+            for number, journal in self.journal_files(tag):
+                if number > vocab.record.journal:
+                    vocab.replay(self.load_journal(journal))
+            return vocab
+        vocab_dump = self.load_vocab(tag)
+        if vocab_dump:
+            return Generator.loads(vocab_dump)
+        return Generator()
+
+    # Returns the size (in bytes) of the files of a chat's vocabulary
+    def vocab_size(self, tag):
+        size = 0
+        for ext in (record.EXTENSION, self.chatext):
+            filepath = self.chat_file(tag=tag, file="record", ext=ext)
+            if os.path.exists(filepath):
+                size += os.path.getsize(filepath)
+        for _, filepath in self.journal_files(tag):
+            size += os.path.getsize(filepath)
+        return size
+
+    # Loads a chat's vocabulary, measuring it
+    def measured_vocab(self, tag):
+        with LOAD_TIME.time("vocab"):
+            vocab = self.get_vocab(tag)
+        LOAD_BYTES.inc(self.vocab_size(tag), "vocab")
+        return vocab
+
+    # Returns a Reader for a given ID with a working vocabulary - be it new or
+    # loaded from file the first time it's used
     def get_reader(self, tag):
-        card = self.load_card(tag)
+        with LOAD_TIME.time("card"):
+            card = self.load_card(tag)
         if card:
-            vocab_dump = self.load_vocab(tag)
-            if vocab_dump:
-                vocab = Generator.loads(vocab_dump)
-            else:
-                vocab = Generator()
-            return Reader.FromCard(
-                card, vocab, self.min_period, self.max_period, self.logger
+            LOAD_BYTES.inc(len(card), "card")
+            reader = Reader.FromCard(
+                card,
+                lambda: self.measured_vocab(tag),
+                self.min_period,
+                self.max_period,
+                self.logger,
             )
+            reader.limit_memory(self.short_memory, self.commit_batch)
+            self.replay_log(tag, reader)
+            return reader
         else:
             return None
 
+    # Returns the catalog of Metadata cards, checking it against the chat
+    # folders the first time: any card file that changed since it was last
+    # put in the catalog is read again
+    def get_catalog(self):
+        with self.catalog_lock:
+            if self.catalog.loaded():
+                return self.catalog
+            self.catalog.load()
+            entries = {}
+            changed = 0
+            for cid in self.chat_tags():
+                filepath = self.chat_file(tag=cid, file="card", ext=".txt")
+                try:
+                    mtime = os.stat(filepath).st_mtime_ns
+                except OSError:
+                    continue
+                entry = self.catalog.get(cid)
+                if entry is None or entry[1] != mtime:
+                    card = self.load_card(cid)
+                    if not card:
+                        continue
+                    entry = (card, mtime)
+                    changed += 1
+                entries[cid] = entry
+            self.catalog.reset(entries)
+            self.logger.info(
+                "Catalog loaded with {} chats ({} cards read again).".format(
+                    len(entries), changed
+                )
+            )
+            return self.catalog
+
+    # Lists the IDs of the stored chats
+    def chat_tags(self):
+        directory = os.fsencode(self.chatdir)
+        for subdir in os.scandir(directory):
+            dirname = subdir.name.decode("utf-8")
+            if dirname.startswith("chat_"):
+                yield dirname[5:]
+
     # Count the stored chats
     def chat_count(self):
         count = 0
@@ -131,41 +584,149 @@ class Archivist(object):
                 count += 1
         return count
 
+    # Returns the (chat ID, card) pairs of every stored chat
+    def chat_cards(self):
+        return self.get_catalog().cards()
+
     # Crawl through all the stored Readers
+    # The Readers come from the catalog, and only load their vocabulary from
+    # file if it's used
     def readers_pass(self):
-        directory = os.fsencode(self.chatdir)
-        for subdir in os.scandir(directory):
-            dirname = subdir.name.decode("utf-8")
-            if dirname.startswith("chat_"):
-                cid = dirname[5:]
-                try:
-                    reader = self.get_reader(cid)
-                    # self.logger.info("Chat {} contents:\n{}".format(cid, reader.card.dumps()))
-                    self.logger.info(
-                        "Successfully passed through {} ({}) chat.\n".format(
-                            cid, reader.title()
-                        )
+        for cid, card in self.chat_cards():
+            try:
+                reader = Reader.FromCard(
+                    card,
+                    lambda cid=cid: self.get_vocab(cid),
+                    self.min_period,
+                    self.max_period,
+                    self.logger,
+                )
+                # self.logger.info("Chat {} contents:\n{}".format(cid, reader.card.dumps()))
+                self.logger.info(
+                    "Successfully passed through {} ({}) chat.\n".format(
+                        cid, reader.title()
                     )
-                    if reader.period() > self.max_period:
-                        reader.set_period(self.max_period)
-                        self.store(*reader.archive())
-                    elif reader.period() < self.min_period:
-                        reader.set_period(self.min_period)
-                        self.store(*reader.archive())
-                    yield reader
-                except Exception as e:
-                    self.logger.error("Failed passing through {}".format(dirname))
-                    self.logger.exception(e)
-                    raise e
-
-    # Load and immediately store every Reader
-    def update(self):
-        for reader in self.readers_pass():
-            if reader.vocab is None:
-                yield reader.cid()
-            else:
-                try:
+                )
+                if reader.period() > self.max_period:
+                    reader.set_period(self.max_period)
+                elif reader.period() < self.min_period:
+                    reader.set_period(self.min_period)
+                # Only the card of a clamped chat is written again
+                if reader.is_dirty():
                     self.store(*reader.archive())
-                except Exception as e:
-                    self.logger.exception(e)
-                    yield reader.cid()
+                yield reader
+            except Exception as e:
+                self.logger.error("Failed passing through chat_{}".format(cid))
+                self.logger.exception(e)
+                raise e
+
+    # Loads and immediately stores a chat, with its period clamped to the
+    # allowed range and its vocabulary pruned to its budget and rewritten
+    # whole, even if nothing is new. The card and the vocabulary are written
+    # as a single StoreJob, so the chat's message log is only cleared once
+    # both are
+    def update_chat(self, tag):
+        reader = self.get_reader(tag)
+        if reader is None:
+            raise ValueError("Chat {} has no Metadata card.".format(tag))
+        # Pruning drops the record file, which is closed once it's rewritten
+        records = reader.vocab.record
+        try:
+            if reader.period() > self.max_period:
+                reader.set_period(self.max_period)
+            elif reader.period() < self.min_period:
+                reader.set_period(self.min_period)
+            reader.prune(self.vocab_limit)
+            tag, card, _ = reader.archive()
+            job = StoreJob(tag, card, vocab=reader.vocab)
+            self.seal_log(job)
+            self.write(job)
+        finally:
+            if records is not None:
+                records.close()
+
+    # Load and immediately store every Reader, yielding the IDs of the chats
+    # that failed
+    def update(self):
+        for cid in self.chat_tags():
+            try:
+                self.update_chat(cid)
+            except Exception as e:
+                self.logger.error("Failed updating chat {}".format(cid))
+                self.logger.exception(e)
+                yield cid
+
+    # Rewrites the vocabulary of a chat from JSON into a binary record file
+    # (or the other way around if the Archivist isn't binary), returning
+    # False if it was already in the right format
+    def convert_chat(self, tag):
+        ext = self.chatext if self.binary else record.EXTENSION
+        if not os.path.exists(self.chat_file(tag=tag, file="record", ext=ext)):
+            return False
+        vocab = self.get_vocab(tag)
+        try:
+            self.store_vocab(tag, vocab)
+        finally:
+            if vocab.record is not None:
+                vocab.record.close()
+        return True
+
+    # Rewrites every JSON vocabulary file as a binary record file (or the
+    # other way around if the Archivist isn't binary), yielding the IDs of
+    # the chats that failed
+    def convert(self):
+        for cid in self.chat_tags():
+            try:
+                if self.convert_chat(cid):
+                    self.logger.info("Converted the vocabulary of chat {}.".format(cid))
+            except Exception as e:
+                self.logger.error("Failed converting chat {}".format(cid))
+                self.logger.exception(e)
+                yield cid
+
+    # Merges the vocabularies of the given chats into the target chat's,
+    # streaming them key by key into its new record file (see record.merge)
+    # so that none of them is loaded whole. The target's own vocabulary is
+    # merged too, if it's stored already; otherwise it gets the card of the
+    # first chat under its own ID. Its message count is the sum of theirs.
+    # The chats merged are left as they are. Returns the VocabStats of the
+    # new vocabulary
+    def merge_chats(self, tags, target):
+        tags = [tag for tag in tags if tag != target]
+        card = self.chat_file(tag=target, file="card", ext=".txt")
+        if os.path.exists(card):
+            tags.insert(0, target)
+        cards = [self.load_card(tag) for tag in tags]
+        missing = [tag for tag, card in zip(tags, cards) if not card]
+        if missing:
+            raise ValueError("Chats {} have no Metadata card.".format(missing))
+        meta = Metadata.loads(cards[0])
+        meta.id = str(target)
+        meta.count = sum(Metadata.loads(card).count for card in cards)
+
+        vocabs = [self.get_vocab(tag) for tag in tags]
+        try:
+            if any(vocab.trie is not None for vocab in vocabs):
+                self.logger.warning(
+                    "The contexts of more than 2 words aren't merged, the chat will"
+                    " learn them again."
+                )
+            os.makedirs(self.chat_folder(tag=target), exist_ok=True)
+            filepath = self.chat_file(tag=target, file="record", ext=record.EXTENSION)
+            with self.record_lock:
+                # The target's journal is merged along with its record file
+                journals = self.journal_files(target)
+                number = self.journal_number(target, journals)
+                stats = record.merge(vocabs, filepath, journal=number)
+                for _, journal in journals:
+                    os.remove(journal)
+        finally:
+            for vocab in vocabs:
+                if vocab.record is not None:
+                    vocab.record.close()
+        legacy = self.chat_file(tag=target, file="record", ext=self.chatext)
+        if os.path.exists(legacy):
+            os.remove(legacy)
+        meta.stats = list(stats)
+        self.store(target, meta.dumps(), None)
+        return stats
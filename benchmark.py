@@ -0,0 +1,695 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import logging
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from generator import ChainTrie, Generator, Successors, getkey, rewrite, triplets
+
+logger = logging.getLogger(__name__)
+
+
+# Builds a synthetic chat of n messages, with words drawn from a vocabulary
+# of the given size following a Zipf distribution of the given exponent (the
+# skew), like real chats do. Some words have uppercase letters and some
+# messages have line breaks, so every path of rewrite(...) gets used
+def corpus(messages, vocabulary, seed=0, skew=1.0):
+    rng = random.Random(seed)
+    words = ["w{}".format(i) for i in range(vocabulary)]
+    for i in range(0, vocabulary, 7):
+        words[i] = words[i].upper()
+    weights = list(itertools.accumulate(1 / (i + 1) ** skew for i in range(vocabulary)))
+    for _ in range(messages):
+        size = rng.randint(1, 20)
+        chosen = rng.choices(words, cum_weights=weights, k=size)
+        if size > 5 and rng.random() < 0.1:
+            chosen[size // 2] += "\n"
+        yield " ".join(chosen)
+
+
+# The old Generator cache layout, keyed by str(tuple) of casefolded words and
+# holding lists of word strings, kept here as the baseline to measure against
+class StrKeyChain(object):
+    def __init__(self):
+        self.cache = {}
+
+    def add(self, text):
+        words = [Generator.HEAD]
+        words.extend(rewrite(text + Generator.TAIL))
+        for w1, w2, w3 in triplets(words):
+            if w1 == Generator.HEAD:
+                self.cache.setdefault(Generator.HEAD, []).append(w2)
+            key = getkey(w1, w2)
+            if key in self.cache:
+                self.cache[key].append(w3)
+            else:
+                self.cache[key] = [w3]
+
+    def generate(self, size=50, silence=False):
+        w1 = random.choice(self.cache[Generator.HEAD])
+        w2 = random.choice(self.cache[getkey(Generator.HEAD, w1)])
+        gen_words = []
+        for i in range(size):
+            gen_words.append(w1)
+            if w2 == Generator.TAIL or getkey(w1, w2) not in self.cache:
+                break
+            w1, w2 = w2, random.choice(self.cache[getkey(w1, w2)])
+        return " ".join(gen_words)
+
+    def dumps(self):
+        return json.dumps(self.cache, ensure_ascii=False)
+
+
+# Feeds the corpus into a new chain, returning it along with the time taken
+# and the memory it holds once built
+def build(factory, texts):
+    tracemalloc.start()
+    start = time.perf_counter()
+    chain = factory()
+    for text in texts:
+        chain.add(text)
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return chain, elapsed, memory
+
+
+# Generates messages until the given number of words has been emitted,
+# returning the average time per word
+def per_word(chain, words, seed=0):
+    random.seed(seed)
+    emitted = 0
+    start = time.perf_counter()
+    while emitted < words:
+        emitted += len(chain.generate(size=50).split(" "))
+    return (time.perf_counter() - start) / emitted
+
+
+# Handles the engine command: compares the old str-key layout with the
+# Generator on the same chat
+def engine(args):
+    texts = list(corpus(args.messages, args.vocabulary, args.seed, args.skew))
+    print("{} messages, vocabulary of {} words".format(args.messages, args.vocabulary))
+    results = {}
+    for name, factory in (("str keys", StrKeyChain), ("interned", Generator)):
+        chain, elapsed, memory = build(factory, texts)
+        word_time = per_word(chain, args.words, args.seed)
+        disk = len(chain.dumps().encode("utf-16"))
+        results[name] = (memory, word_time, disk)
+        print(
+            "{:>10}: add {:.2f} s, {:.1f} MiB, generate {:.2f} us/word, "
+            "{:.1f} MiB on disk".format(
+                name, elapsed, memory / 2**20, word_time * 1e6, disk / 2**20
+            )
+        )
+    old, new = results["str keys"], results["interned"]
+    print(
+        "Memory {:.2f}x smaller, generation {:.2f}x faster, "
+        "file {:.2f}x smaller".format(old[0] / new[0], old[1] / new[1], old[2] / new[2])
+    )
+
+
+# The old rewrite(...), which split on spaces and then deleted the empty words
+# one by one, kept here as the baseline for the single-pass tokenizer
+def split_rewrite(text):
+    words = text.replace("\n", "\n ").split(" ")
+    i = 0
+    while i < len(words):
+        w = words[i].strip(" \t")
+        if len(w) > 0:
+            words[i] = w
+        else:
+            del words[i]
+            i -= 1
+        i += 1
+    return words
+
+
+# A Generator learning each message on its own with the old rewrite(...), as
+# Reader.commit_memory(...) did before add_many(...)
+class SplitGenerator(Generator):
+    def add(self, text):
+        words = [Generator.HEAD]
+        words.extend(split_rewrite(text + Generator.TAIL))
+        self.database(words)
+
+
+# Handles the ingest command: compares the old tokenizer and learning one
+# message at a time with the single-pass tokenizer and add_many(...), checking
+# that both give the same words and the same chain
+def ingest(args):
+    texts = list(corpus(args.messages, args.vocabulary, args.seed, args.skew))
+    print("{} messages, vocabulary of {} words".format(args.messages, args.vocabulary))
+    # A long message with runs of spaces, where deleting the empty words one
+    # by one is quadratic
+    long = "  ".join(texts[: args.long])
+    # Only what's measured is kept between runs, so the garbage collector
+    # doesn't go through the results of the previous ones
+    for name, items in (("corpus", texts), ("long message", [long])):
+        times = {}
+        for tokenizer in (split_rewrite, rewrite):
+            gc.collect()
+            start = time.perf_counter()
+            for text in items:
+                tokenizer(text)
+            times[tokenizer] = time.perf_counter() - start
+        assert all(split_rewrite(text) == rewrite(text) for text in items)
+        print(
+            "Tokenizing the {}: split {:.3f} s, single pass {:.3f} s, {:.2f}x"
+            " faster".format(
+                name,
+                times[split_rewrite],
+                times[rewrite],
+                times[split_rewrite] / times[rewrite],
+            )
+        )
+
+    dumps = {}
+    times = {}
+    for name in ("add", "add_many"):
+        chain = SplitGenerator() if name == "add" else Generator()
+        gc.collect()
+        start = time.perf_counter()
+        if name == "add":
+            for text in texts:
+                chain.add(text)
+        else:
+            for i in range(0, len(texts), args.batch):
+                chain.add_many(texts[i : i + args.batch])
+        times[name] = time.perf_counter() - start
+        dumps[name] = chain.dumps()
+        chain = None
+    assert dumps["add"] == dumps["add_many"]
+    print(
+        "Learning: add {:.2f} s ({:.0f} msg/s), add_many in batches of {} {:.2f} s"
+        " ({:.0f} msg/s), {:.2f}x faster".format(
+            times["add"],
+            len(texts) / times["add"],
+            args.batch,
+            times["add_many"],
+            len(texts) / times["add_many"],
+            times["add"] / times["add_many"],
+        )
+    )
+
+
+# The contexts of 3 to k words kept in a flat dictionary, keyed by the tuple
+# of their casefolded word IDs, as the order 2 cache would be if it were just
+# given longer keys. Kept here as the baseline for the ChainTrie
+class FlatContexts(object):
+    def __init__(self, order):
+        self.order = order
+        self.cache = {}
+
+    def learn(self, ids, folds):
+        for j in range(3, len(ids)):
+            for d in range(3, min(self.order, j) + 1):
+                key = tuple(folds[j - d : j])
+                value = self.cache.get(key)
+                if value is None:
+                    self.cache[key] = ids[j]
+                elif type(value) is int:
+                    succ = Successors([value], [1])
+                    succ.add(ids[j])
+                    self.cache[key] = succ
+                else:
+                    value.add(ids[j])
+
+
+# Handles the orders command: compares the memory taken by the contexts longer
+# than 2 words in a flat dictionary and in a ChainTrie, for each order
+def orders(args):
+    texts = list(corpus(args.messages, args.vocabulary, args.seed, args.skew))
+    print("{} messages, vocabulary of {} words".format(args.messages, args.vocabulary))
+    # Interned beforehand, so only the contexts are measured
+    vocab = Generator()
+    messages = []
+    for text in texts:
+        ids = [
+            vocab.tokens.intern(w)
+            for w in [Generator.HEAD] + rewrite(text + Generator.TAIL)
+        ]
+        messages.append((ids, [vocab.tokens.folds[i] for i in ids]))
+    for order in range(3, args.order + 1):
+        sizes = {}
+        for name, factory in (("flat", FlatContexts), ("trie", ChainTrie)):
+            tracemalloc.start()
+            store = factory(order)
+            for ids, folds in messages:
+                store.learn(ids, folds)
+            sizes[name] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            if name == "trie":
+                transitions = store.transitions()
+        print(
+            "Order {}: {} transitions, flat {:.1f} MiB ({:.1f} B each), "
+            "trie {:.1f} MiB ({:.1f} B each), {:.2f}x smaller".format(
+                order,
+                transitions,
+                sizes["flat"] / 2**20,
+                sizes["flat"] / transitions,
+                sizes["trie"] / 2**20,
+                sizes["trie"] / transitions,
+                sizes["flat"] / sizes["trie"],
+            )
+        )
+
+
+# Returns the value at the given percentile (0-100) of a sorted list
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    i = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[i]
+
+
+# Times each call to run(item) for every item, returning the results of an
+# operation: throughput (calls per second, or items handled per second if each
+# call handles per of them), latency percentiles (in s) and, if asked for,
+# the peak memory (in bytes) allocated while doing it all again under
+# tracemalloc. setup() is called before each pass, and its result is given to
+# run along with the item
+def measure(items, run, setup=None, memory=True, per=1):
+    state = setup() if setup is not None else None
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for item in items:
+        t = clock()
+        run(state, item)
+        latencies.append(clock() - t)
+    total = clock() - start
+    latencies.sort()
+    result = {
+        "calls": len(latencies),
+        "total": total,
+        "throughput": len(latencies) * per / total if total > 0 else 0.0,
+        "mean": total / len(latencies) if latencies else 0.0,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else 0.0,
+    }
+    if memory:
+        state = setup() if setup is not None else None
+        tracemalloc.start()
+        for item in items:
+            run(state, item)
+        result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+# A Telegram update for Speaker.read(...), with only what it uses
+def fake_update(cid, mid, text):
+    chat = SimpleNamespace(
+        id=cid, type="group", title="Chat {}".format(cid), first_name=None
+    )
+    message = SimpleNamespace(
+        message_id=mid,
+        text=text,
+        sticker=None,
+        animation=None,
+        video=None,
+        chat=chat,
+        reply_to_message=None,
+        from_user=None,
+    )
+    return SimpleNamespace(message=message)
+
+
+# Runs every operation of the suite, returning their results by name
+def suite(args):
+    # Imported here so that the engine command works without telegram
+    from archivist import Archivist
+    from reader import Reader
+    from speaker import Speaker
+
+    logging.basicConfig(level=logging.WARNING)
+    # Every chat read by the Speaker is new, and has no card to be loaded
+    logger.setLevel(logging.CRITICAL)
+    texts = list(corpus(args.messages, args.vocabulary, args.seed, args.skew))
+    reps = range(args.repeat)
+    results = {}
+
+    def record(name, result):
+        results[name] = result
+        print(
+            "{:>16}: {:>12.1f} op/s  p50 {:>10.1f} us  p99 {:>10.1f} us  "
+            "peak {:>8.1f} MiB".format(
+                name,
+                result["throughput"],
+                result["p50"] * 1e6,
+                result["p99"] * 1e6,
+                result.get("peak_memory", 0) / 2**20,
+            )
+        )
+
+    record("rewrite", measure(texts, lambda _, t: rewrite(t), memory=args.memory))
+    record(
+        "generator.add",
+        measure(texts, lambda gen, t: gen.add(t), Generator, memory=args.memory),
+    )
+
+    batches = [texts[i : i + args.batch] for i in range(0, len(texts), args.batch)]
+    record(
+        "generator.add_many",
+        measure(
+            batches,
+            lambda gen, batch: gen.add_many(batch),
+            Generator,
+            memory=args.memory,
+            per=args.batch,
+        ),
+    )
+
+    vocab = Generator()
+    for text in texts:
+        vocab.add(text)
+
+    def generate(_, seed):
+        random.seed(seed)
+        vocab.generate(size=50)
+
+    record(
+        "generator.generate",
+        measure(range(args.generate), generate, memory=args.memory),
+    )
+
+    def generate_many(_, seed):
+        random.seed(seed)
+        vocab.generate_many(args.batch, size=50)
+
+    # The arrays are built once, as they are until the vocabulary changes
+    vocab.generate_many(1)
+    record(
+        "generator.many",
+        measure(
+            range(max(1, args.generate // args.batch)),
+            generate_many,
+            memory=args.memory,
+            per=args.batch,
+        ),
+    )
+    record("generator.dumps", measure(reps, lambda _, i: vocab.dumps(), memory=False))
+    dump = vocab.dumps()
+    record(
+        "generator.loads",
+        measure(reps, lambda _, i: Generator.loads(dump), memory=args.memory),
+    )
+
+    with tempfile.TemporaryDirectory() as chatdir:
+        archivist = Archivist(logger, chatdir=chatdir, chatext=".vls")
+        reader = Reader.FromCard(
+            "CARD=v5\nCHAT_ID=1\nCHAT_TYPE=group\nCHAT_NAME=Bench\n"
+            "WORD_COUNT=0\nMESSAGE_PERIOD=10\nANSWER_PROB=0.5\n"
+            "RESTRICTED=False\nSILENCED=False\n",
+            vocab,
+            1,
+            100000,
+            logger,
+        )
+
+        # Every store goes to a new chat, so each one writes a whole record
+        def store(_, i):
+            archivist.store(str(i), reader.meta.dumps(), vocab)
+
+        record("archivist.store", measure(reps, store, memory=False))
+
+        # Loading the vocabulary too, which the Reader would only do later
+        def get_reader(_, i):
+            archivist.get_reader(str(i)).vocab.generate(size=50)
+
+        record("archivist.get", measure(reps, get_reader, memory=args.memory))
+
+        speaker = Speaker(
+            "@velascobot", archivist, logger, memory=args.chats + 1, save_time=1e9
+        )
+        context = SimpleNamespace(bot=None)
+        updates = [
+            fake_update(-(i % args.chats) - 1, i, text) for i, text in enumerate(texts)
+        ]
+        loop = asyncio.new_event_loop()
+
+        def read(_, update):
+            chat = update.message.chat
+            reader = speaker.get_reader(str(chat.id))
+            if reader is not None:
+                # Never reach the end of the period, nothing is sent
+                reader.countdown = len(texts)
+            loop.run_until_complete(speaker.read(update, context))
+
+        record("speaker.read", measure(updates, read, memory=False))
+        loop.run_until_complete(speaker.persister.close())
+        loop.close()
+        archivist.close()
+    return results
+
+
+# The git revision of the working tree, if there is one
+def revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Handles the suite command
+def run_suite(args):
+    random.seed(args.seed)
+    results = suite(args)
+    if args.output:
+        report = {
+            "revision": revision(),
+            "python": platform.python_version(),
+            "settings": {
+                "messages": args.messages,
+                "vocabulary": args.vocabulary,
+                "skew": args.skew,
+                "seed": args.seed,
+                "repeat": args.repeat,
+                "generate": args.generate,
+                "batch": args.batch,
+                "chats": args.chats,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Results written to {}".format(args.output))
+
+
+# Handles the compare command: shows how each operation changed from one
+# results file to another
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if old["settings"] != new["settings"]:
+        print("Warning: the results were taken with different settings.")
+    print(
+        "{} -> {}".format(
+            old.get("revision") or args.old, new.get("revision") or args.new
+        )
+    )
+    print(
+        "{:>20} {:>14} {:>14} {:>14} {:>14}".format(
+            "operation", "throughput", "p50", "p99", "peak memory"
+        )
+    )
+    for name, after in new["results"].items():
+        before = old["results"].get(name)
+        if before is None:
+            print("{:>20} (new)".format(name))
+            continue
+        ratios = [
+            after["throughput"] / before["throughput"] if before["throughput"] else 0,
+            before["p50"] / after["p50"] if after["p50"] else 0,
+            before["p99"] / after["p99"] if after["p99"] else 0,
+        ]
+        line = "{:>20} {:>13.2f}x {:>13.2f}x {:>13.2f}x".format(name, *ratios)
+        if "peak_memory" in before and "peak_memory" in after:
+            line += " {:>13.2f}x".format(
+                before["peak_memory"] / after["peak_memory"]
+                if after["peak_memory"]
+                else 0
+            )
+        print(line)
+    print("(Above 1x is better: more throughput, less latency, less memory.)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Velasco benchmarks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    chat = argparse.ArgumentParser(add_help=False)
+    chat.add_argument(
+        "-m",
+        "--messages",
+        metavar="N",
+        type=int,
+        default=200000,
+        help="The number of messages in the synthetic chat. (default: 200000)",
+    )
+    chat.add_argument(
+        "-v",
+        "--vocabulary",
+        metavar="V",
+        type=int,
+        default=50000,
+        help="The number of distinct words in the synthetic chat. (default: 50000)",
+    )
+    chat.add_argument(
+        "-k",
+        "--skew",
+        metavar="S",
+        type=float,
+        default=1.0,
+        help="The exponent of the Zipf distribution of the words. (default: 1.0)",
+    )
+    chat.add_argument(
+        "-s",
+        "--seed",
+        metavar="S",
+        type=int,
+        default=0,
+        help="The random seed for the synthetic chat. (default: 0)",
+    )
+
+    command = commands.add_parser(
+        "engine",
+        parents=[chat],
+        help="Compare the Generator with the old str-key layout.",
+    )
+    command.add_argument(
+        "-w",
+        "--words",
+        metavar="W",
+        type=int,
+        default=200000,
+        help="The number of words to generate when timing generation. (default: 200000)",
+    )
+    command.set_defaults(handler=engine)
+
+    command = commands.add_parser(
+        "orders",
+        parents=[chat],
+        help="Compare the memory taken by higher order chains in a flat dict and a trie.",
+    )
+    command.add_argument(
+        "-o",
+        "--order",
+        metavar="K",
+        type=int,
+        default=5,
+        help="The highest chain order to measure. (default: 5)",
+    )
+    command.set_defaults(handler=orders)
+
+    command = commands.add_parser(
+        "ingest",
+        parents=[chat],
+        help="Compare the old tokenizer and add() with the single pass one and"
+        + " add_many().",
+    )
+    command.add_argument(
+        "-b",
+        "--batch",
+        metavar="B",
+        type=int,
+        default=2000,
+        help="The number of messages learned by each call to add_many."
+        + " (default: 2000)",
+    )
+    command.add_argument(
+        "-l",
+        "--long",
+        metavar="L",
+        type=int,
+        default=5000,
+        help="The number of messages joined into the long message. (default: 5000)",
+    )
+    command.set_defaults(handler=ingest)
+
+    command = commands.add_parser(
+        "suite",
+        parents=[chat],
+        help="Measure the learning, generation and storing operations.",
+    )
+    command.add_argument(
+        "-r",
+        "--repeat",
+        metavar="R",
+        type=int,
+        default=5,
+        help="The number of times whole-vocabulary operations are run. (default: 5)",
+    )
+    command.add_argument(
+        "-g",
+        "--generate",
+        metavar="G",
+        type=int,
+        default=20000,
+        help="The number of messages to generate. (default: 20000)",
+    )
+    command.add_argument(
+        "-b",
+        "--batch",
+        metavar="B",
+        type=int,
+        default=1000,
+        help="The number of messages generated by each call to generate_many."
+        + " (default: 1000)",
+    )
+    command.add_argument(
+        "-c",
+        "--chats",
+        metavar="C",
+        type=int,
+        default=10,
+        help="The number of chats the messages are read from. (default: 10)",
+    )
+    command.add_argument(
+        "--no-memory",
+        dest="memory",
+        action="store_false",
+        help="Don't measure the peak memory (which runs everything twice).",
+    )
+    command.add_argument(
+        "-o",
+        "--output",
+        metavar="FILE",
+        help="The JSON file to write the results to.",
+    )
+    command.set_defaults(handler=run_suite)
+
+    command = commands.add_parser(
+        "compare", help="Compare 2 results files written by the suite command."
+    )
+    command.add_argument("old", metavar="OLD", help="The results to compare against.")
+    command.add_argument("new", metavar="NEW", help="The results to compare.")
+    command.set_defaults(handler=compare)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
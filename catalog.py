@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+
+
+# Formats a catalog file line
+def entry_line(cid, card, mtime):
+    entry = {"id": cid, "card": card, "mtime": mtime}
+    return json.dumps(entry, ensure_ascii=False) + "\n"
+
+
+# The catalog of the Metadata cards of all stored chats, kept in a single file
+# so that going through every chat's metadata doesn't need to open every
+# chat's folder, let alone its vocabulary. The file is a log: each line holds
+# one card dump as JSON, the last one for a chat being the current one, and it
+# gets rewritten from scratch when there are too many outdated lines
+class Catalog(object):
+    # The file is rewritten when it has more than twice as many lines as
+    # chats, plus this many
+    SLACK = 64
+
+    def __init__(self, filepath, logger):
+        self.filepath = filepath
+        self.logger = logger
+        # The card dump and the card file's modification time, by chat ID,
+        # or None until the catalog is loaded
+        self.entries = None
+        # Number of lines in the file
+        self.lines = 0
+        self.lock = threading.Lock()
+
+    def loaded(self):
+        return self.entries is not None
+
+    # Reads the catalog file
+    def load(self):
+        with self.lock:
+            self.entries = {}
+            self.lines = 0
+            if not os.path.exists(self.filepath):
+                return
+            with open(self.filepath, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry["id"]] = (entry["card"], entry["mtime"])
+                    except (ValueError, KeyError):
+                        self.logger.warning(
+                            "Skipping broken line in {}.".format(self.filepath)
+                        )
+                    self.lines += 1
+
+    # Returns the (card, modification time) pair of a chat, or None
+    def get(self, cid):
+        with self.lock:
+            return self.entries.get(cid)
+
+    # Returns the (chat ID, card) pairs of every chat
+    def cards(self):
+        with self.lock:
+            return [(cid, entry[0]) for cid, entry in self.entries.items()]
+
+    # Sets the card of a chat
+    def put(self, cid, card, mtime):
+        with self.lock:
+            self.entries[cid] = (card, mtime)
+            with open(self.filepath, "a", encoding="utf-8") as file:
+                file.write(entry_line(cid, card, mtime))
+            self.lines += 1
+            if self.lines > 2 * len(self.entries) + Catalog.SLACK:
+                self.rewrite()
+
+    # Replaces all the entries, and rewrites the file with them
+    def reset(self, entries):
+        with self.lock:
+            self.entries = dict(entries)
+            self.rewrite()
+
+    # Writes the file again with only the current entries (the lock is held)
+    def rewrite(self):
+        temp = self.filepath + ".tmp"
+        with open(temp, "w", encoding="utf-8") as file:
+            for cid, (card, mtime) in self.entries.items():
+                file.write(entry_line(cid, card, mtime))
+        os.replace(temp, self.filepath)
+        self.lines = len(self.entries)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import sqlite3
+import threading
+from collections import Counter
+
+from archivist import Archivist
+from generator import ChainTrie, Generator, TokenTable, casefold, triplets
+from profiler import PROFILER
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    id TEXT PRIMARY KEY,
+    card TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS successors (
+    chat TEXT NOT NULL,
+    w1 TEXT NOT NULL,
+    w2 TEXT NOT NULL,
+    word TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (chat, w1, w2, word)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tries (
+    chat TEXT PRIMARY KEY,
+    trie TEXT NOT NULL
+);
+"""
+
+
+# The bytes a (w1, w2, word) -> count row holds: its words in UTF-8, and the
+# count as an 8 byte integer. The database's own overhead isn't counted
+def row_size(w1, w2, word):
+    return (
+        len(w1.encode("utf-8"))
+        + len(w2.encode("utf-8"))
+        + len(word.encode("utf-8"))
+        + 8
+    )
+
+
+# Counts the (w1, w2, word) rows learned from the lists of words of a
+# Generator's journal, the way Generator.database(...) learns them
+def journal_rows(journal):
+    counts = Counter()
+    for words in journal:
+        for w1, w2, w3 in triplets(words):
+            if w1 == Generator.HEAD:
+                counts[(Generator.HEAD, "", w2)] += 1
+            counts[(casefold(w1), casefold(w2), w3)] += 1
+    return counts
+
+
+# An Archivist that keeps every chat in a single SQLite database instead of
+# the chat logs directory: a table of Metadata cards, and a table of
+# (chat, w1, w2, word) -> count rows holding the chains, along with the JSON
+# dump of the ChainTrie of chats of a higher order. Chats are saved with
+# the words learned since their last save (their Generator's journal), which
+# are added to the counts in a single transaction, and loaded by reading
+# their rows back into a Generator
+class DatabaseArchivist(Archivist):
+    # Default file name of the database, inside the chat logs directory
+    FILENAME = "velasco.db"
+
+    def __init__(self, logger, chatdir=None, chatext=None, database=None, **kwargs):
+        super().__init__(logger, chatdir=chatdir, chatext=chatext, **kwargs)
+        if database is None or len(database) == 0:
+            database = os.path.join(self.chatdir, DatabaseArchivist.FILENAME)
+        self.database = database
+        # A single connection, shared by the thread pool writing the chats and
+        # the bot's event loop, and only used while holding the lock
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+
+    # Writes the card and the vocabulary of a StoreJob in a single transaction,
+    # returning the number of bytes of the rows written
+    @PROFILER.hook("archivist.store")
+    def write(self, job):
+        if self.read_only:
+            return 0
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO chats (id, card) VALUES (?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET card = excluded.card",
+                (job.tag, job.card),
+            )
+            written = len(job.card.encode("utf-8"))
+            if job.vocab is not None:
+                written += self.replace_rows(job.tag, job.vocab)
+            if job.journal is not None:
+                written += self.add_rows(job.tag, journal_rows(job.journal))
+                written += self.learn_trie(job.tag, job.journal)
+        self.clear_log(job)
+        return written
+
+    # Replaces the rows of a chat with the whole chain of a Generator (or of
+    # its JSON dump), returning the bytes written. The lock and a transaction
+    # are held
+    def replace_rows(self, tag, vocab):
+        if isinstance(vocab, str):
+            vocab = Generator.loads(vocab)
+        self.connection.execute("DELETE FROM successors WHERE chat = ?", (tag,))
+        written = 0
+
+        def rows():
+            nonlocal written
+            for w1, w2, word, count in vocab.rows():
+                written += row_size(w1, w2, word)
+                yield (tag, w1, w2, word, count)
+
+        self.connection.executemany(
+            "INSERT INTO successors (chat, w1, w2, word, count) VALUES (?, ?, ?, ?, ?)",
+            rows(),
+        )
+        self.connection.execute("DELETE FROM tries WHERE chat = ?", (tag,))
+        if vocab.trie is not None:
+            written += self.put_trie(tag, vocab.trie, vocab.tokens)
+        vocab.journal = []
+        return written
+
+    # Writes the ChainTrie of a chat, returning the size of its dump. The lock
+    # and a transaction are held
+    def put_trie(self, tag, trie, tokens):
+        dump = json.dumps(trie.to_dict(tokens.words), ensure_ascii=False)
+        self.connection.execute(
+            "INSERT INTO tries (chat, trie) VALUES (?, ?) "
+            "ON CONFLICT (chat) DO UPDATE SET trie = excluded.trie",
+            (tag, dump),
+        )
+        return len(dump.encode("utf-8"))
+
+    # Reads a chat's ChainTrie, interning its words in the given TokenTable,
+    # or None if it has none. The lock is held
+    def get_trie(self, tag, tokens):
+        row = self.connection.execute(
+            "SELECT trie FROM tries WHERE chat = ?", (tag,)
+        ).fetchone()
+        if row is None:
+            return None
+        return ChainTrie.FromDict(json.loads(row[0]), tokens)
+
+    # Learns the lists of words of a Generator's journal into the chat's
+    # ChainTrie, if it has one, the way Generator.database(...) learns them.
+    # Returns the size of the trie's new dump. The lock and a transaction are
+    # held
+    def learn_trie(self, tag, journal):
+        tokens = TokenTable()
+        trie = self.get_trie(tag, tokens)
+        if trie is None or len(journal) == 0:
+            return 0
+        for words in journal:
+            ids = [tokens.intern(w) for w in words]
+            trie.learn(ids, [tokens.folds[i] for i in ids])
+        return self.put_trie(tag, trie, tokens)
+
+    # Adds the counts of (w1, w2, word) rows to a chat's rows, returning the
+    # bytes written. The lock and a transaction are held
+    def add_rows(self, tag, counts):
+        self.connection.executemany(
+            "INSERT INTO successors (chat, w1, w2, word, count) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (chat, w1, w2, word) DO UPDATE "
+            "SET count = count + excluded.count",
+            ((tag, w1, w2, word, count) for (w1, w2, word), count in counts.items()),
+        )
+        return sum(row_size(w1, w2, word) for w1, w2, word in counts)
+
+    # Stores a Generator, or a Generator's JSON dump, as the chat's whole
+    # vocabulary, returning the bytes written
+    def store_vocab(self, tag, vocab):
+        if self.read_only:
+            return 0
+        with self.lock, self.connection:
+            return self.replace_rows(tag, vocab)
+
+    # Every chat's rows are up to date with its Generator's last save, so only
+    # what it learned since then has to be stored, unless it changed in some
+    # other way
+    def can_journal(self, tag, vocab):
+        return isinstance(vocab, Generator) and vocab.journal is not None
+
+    # Loads a Metadata card
+    def load_card(self, tag):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT card FROM chats WHERE id = ?", (tag,)
+            ).fetchone()
+        if row is None:
+            self.logger.error("Metadata of chat {} not found.".format(tag))
+            return None
+        return row[0]
+
+    # Returns a chat's vocabulary Generator, read from its rows and its
+    # ChainTrie. Gives an empty Generator if there are none
+    def get_vocab(self, tag):
+        vocab = Generator()
+        with self.lock:
+            vocab.load_rows(
+                self.connection.execute(
+                    "SELECT w1, w2, word, count FROM successors WHERE chat = ?",
+                    (tag,),
+                )
+            )
+            vocab.trie = self.get_trie(tag, vocab.tokens)
+        return vocab
+
+    # Returns the (chat ID, card) pairs of every stored chat
+    def chat_cards(self):
+        with self.lock:
+            return self.connection.execute("SELECT id, card FROM chats").fetchall()
+
+    # Lists the IDs of the stored chats
+    def chat_tags(self):
+        return [cid for cid, _ in self.chat_cards()]
+
+    # The bytes of a chat's rows (as counted by row_size(...)) and of the dump
+    # of its ChainTrie
+    def vocab_size(self, tag):
+        with self.lock:
+            rows, trie = self.connection.execute(
+                "SELECT "
+                "(SELECT TOTAL(length(CAST(w1 AS BLOB)) + length(CAST(w2 AS BLOB))"
+                " + length(CAST(word AS BLOB)) + 8) FROM successors WHERE chat = ?), "
+                "(SELECT TOTAL(length(CAST(trie AS BLOB))) FROM tries WHERE chat = ?)",
+                (tag, tag),
+            ).fetchone()
+        return int(rows + trie)
+
+    # Count the stored chats
+    def chat_count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+
+    # The chats are already in the database, there are no files to convert
+    def convert(self):
+        return iter(())
+
+    def close(self):
+        super().close()
+        with self.lock:
+            self.connection.close()
@@ -1,27 +1,31 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import ast
 import json
 import random
+from array import array
+from collections import Counter, OrderedDict, namedtuple
+
+numpyError = None
+try:
+    import numpy
+except ImportError as e:
+    numpyError = e
 
 
 # This splits strings into lists of words delimited by space.
-# Other whitespaces are appended space characters so they are included
-# as their own Markov chain element, so as not to pollude with
-# "different" words that would only differ in having a whitespace
-# attached or not
+# Line breaks get a space appended so they end the word before them (or make
+# up a word of their own), and are included as their own Markov chain element,
+# so as not to pollude with "different" words that would only differ in
+# having a whitespace attached or not. Tabs around words are stripped. The
+# empty words are left out in a single pass, and the stripping is skipped
+# when there are no tabs
 def rewrite(text):
     words = text.replace("\n", "\n ").split(" ")
-    i = 0
-    while i < len(words):
-        w = words[i].strip(" \t")
-        if len(w) > 0:
-            words[i] = w
-        else:
-            del words[i]
-            i -= 1
-        i += 1
-    return words
+    if "\t" in text:
+        return [w for w in (w.strip("\t") for w in words) if w]
+    return [w for w in words if w]
 
 
 # This gives a dictionary key from 2 words, ignoring case
@@ -38,6 +42,11 @@ def getwords(key):
     return words
 
 
+# This gives the casefolded form of a word, which is the one chain keys use
+def casefold(word):
+    return word.strip().casefold()
+
+
 # Generates triplets of words from the given data string. So if our string
 # were "What a lovely day", we'd generate (What, a, lovely) and then
 # (a, lovely, day).
@@ -49,6 +58,622 @@ def triplets(wordlist):
         yield (wordlist[i], wordlist[i + 1], wordlist[i + 2])
 
 
+# Number of bits an interned ID is shifted when packing 2 of them together
+KEY_SHIFT = 32
+
+
+# This gives a dictionary key from 2 interned word IDs, packed into a single
+# integer, so the cache doesn't hold a tuple or a string per key
+def pairkey(i1, i2):
+    return (i1 << KEY_SHIFT) | i2
+
+
+# This turns a packed dictionary key back into 2 separate word IDs
+def unpairkey(key):
+    return (key >> KEY_SHIFT, key & ((1 << KEY_SHIFT) - 1))
+
+
+# This turns a dictionary key from a JSON dump back into 2 separate words.
+# Unlike getwords(...) it undoes the quoting of str(tuple), trying a fast
+# split first because literal_eval is slow for millions of keys
+def parsekey(key):
+    if key.startswith("('") and key.endswith("')") and "\\" not in key:
+        words = key[2:-2].split("', '")
+        if len(words) == 2:
+            return words
+    return list(ast.literal_eval(key))
+
+
+# This holds the words that can follow a chain key. Each distinct word is
+# stored once along with the number of times it has been seen after the key,
+# and picking one at random uses an alias table (Vose's method) so it takes
+# constant time. The table is built lazily, after any words have been added
+class Successors(object):
+    __slots__ = ("words", "counts", "total", "_index", "_alias")
+
+    # Number of distinct words from which a dictionary index is kept,
+    # instead of looking words up linearly
+    INDEX_SIZE = 32
+    # Number of distinct words up to which sampling walks the counts,
+    # instead of building an alias table
+    SCAN_SIZE = 8
+
+    def __init__(self, words=None, counts=None):
+        # The distinct words
+        self.words = list(words) if words is not None else []
+        # How many times each word has been seen
+        self.counts = list(counts) if counts is not None else [1] * len(self.words)
+        # The sum of all counts
+        self.total = sum(self.counts)
+        # Position of each word, only for long lists
+        self._index = None
+        # The alias table for sampling, built on demand
+        self._alias = None
+        if len(self.words) > Successors.INDEX_SIZE:
+            self._index = {w: i for i, w in enumerate(self.words)}
+
+    # Creates a Successors object from a list that can hold duplicates
+    def FromList(words):
+        succ = Successors()
+        for word in words:
+            succ.add(word)
+        return succ
+
+    def __len__(self):
+        return len(self.words)
+
+    # Returns the (word, count) pairs
+    def items(self):
+        return zip(self.words, self.counts)
+
+    def copy(self):
+        return Successors(self.words, self.counts)
+
+    # Returns the list of words with the duplicates, as it was stored before
+    # the counts were kept
+    def to_list(self):
+        return [w for w, c in self.items() for _ in range(c)]
+
+    def add(self, word, count=1):
+        if self._index is not None:
+            i = self._index.get(word)
+        else:
+            try:
+                i = self.words.index(word)
+            except ValueError:
+                i = None
+        if i is None:
+            self.words.append(word)
+            self.counts.append(count)
+            if self._index is not None:
+                self._index[word] = len(self.words) - 1
+            elif len(self.words) > Successors.INDEX_SIZE:
+                self._index = {w: i for i, w in enumerate(self.words)}
+        else:
+            self.counts[i] += count
+        self.total += count
+        self._alias = None
+
+    # Builds the alias table: each slot holds the probability of keeping its
+    # own word, and the position of the word to pick otherwise
+    def build(self):
+        n = len(self.counts)
+        prob = [c * n / self.total for c in self.counts]
+        alias = list(range(n))
+        small = [i for i in range(n) if prob[i] < 1]
+        large = [i for i in range(n) if prob[i] >= 1]
+        while small and large:
+            s = small.pop()
+            lg = large.pop()
+            alias[s] = lg
+            prob[lg] = prob[lg] + prob[s] - 1
+            if prob[lg] < 1:
+                small.append(lg)
+            else:
+                large.append(lg)
+        # What remains is only off from 1 because of rounding errors
+        for i in small + large:
+            prob[i] = 1
+        self._alias = (prob, alias)
+
+    # Picks a random word, weighted by its count
+    def choice(self):
+        n = len(self.words)
+        if n == 1:
+            return self.words[0]
+        if n <= Successors.SCAN_SIZE:
+            # Short lists are quicker to walk than to build a table for
+            r = random.random() * self.total
+            for word, count in zip(self.words, self.counts):
+                r -= count
+                if r < 0:
+                    return word
+            return self.words[-1]
+        if self._alias is None:
+            self.build()
+        prob, alias = self._alias
+        r = random.random() * len(prob)
+        i = int(r)
+        if r - i < prob[i]:
+            return self.words[i]
+        return self.words[alias[i]]
+
+
+# The size of a vocabulary: the messages learned, the tokens learned (every
+# word seen after a key, repeats and the end of message included), the keys
+# of its chain and their distinct (key, word) transitions, and about how many
+# bytes it takes in a record file
+VocabStats = namedtuple(
+    "VocabStats", ["messages", "tokens", "keys", "transitions", "bytes"]
+)
+
+
+# Most keys are only ever followed by one word, seen once, so the cache stores
+# those as the bare word ID and only uses a Successors object for the rest.
+# This gives the (word, count) pairs of a cache value, be it one or the other
+def successors(value):
+    if type(value) is int:
+        return ((value, 1),)
+    return value.items()
+
+
+# This turns (word, count) pairs into a cache value
+def compact(pairs):
+    pairs = list(pairs)
+    if len(pairs) == 1 and pairs[0][1] == 1:
+        return pairs[0][0]
+    return Successors(*zip(*pairs))
+
+
+# This picks a random word from a cache value
+def pick(value):
+    if type(value) is int:
+        return value
+    return value.choice()
+
+
+# Adds a word ID to a cache value (None, a word ID or a Successors), the given
+# number of times, returning the new value
+def grow(value, word, count=1):
+    if value is None:
+        return word if count == 1 else Successors([word], [count])
+    if type(value) is int:
+        value = Successors([value], [1])
+    value.add(word, count)
+    return value
+
+
+# Removes transitions from a chain of {key: {word: count}} and its HEAD words
+# ({word: count}) while keeping it walkable: every walk from HEAD still ends
+# at the end of a message. When a key is left without words, the transitions
+# leading to it go too, and when no transition leads to a key any more, the
+# key goes along with its own transitions. It counts the bytes this frees,
+# as stats() counts them (leaving out the words no longer used)
+class ChainPruner(object):
+    MASK = (1 << KEY_SHIFT) - 1
+
+    def __init__(self, chain, heads, folds, head, end):
+        self.chain = chain
+        self.heads = heads
+        self.folds = folds
+        # The casefolded ID of the HEAD marker
+        self.head = folds[head]
+        # The ID of the word ending every message, which leads to no key
+        self.end = end
+        self.freed = 0
+        # The keys with a transition to each key, the HEAD words leading to
+        # each key, and how many of both lead to each key
+        self.incoming = {}
+        self.starting = {}
+        self.refs = {}
+        for key, succ in chain.items():
+            for word in succ:
+                if word != end:
+                    target = self.target(key, word)
+                    self.incoming.setdefault(target, []).append(key)
+                    self.refs[target] = self.refs.get(target, 0) + 1
+        for word in heads:
+            target = pairkey(self.head, folds[word])
+            self.starting.setdefault(target, []).append(word)
+            self.refs[target] = self.refs.get(target, 0) + 1
+
+    # The key a transition leads to
+    def target(self, key, word):
+        return pairkey(key & ChainPruner.MASK, self.folds[word])
+
+    # Removes a transition, and whatever it leaves dead
+    def remove(self, key, word):
+        dead = []
+        self.unlink(key, self.chain[key], word, dead)
+        while dead:
+            key = dead.pop()
+            succ = self.chain.get(key)
+            if succ is None or (succ and self.refs.get(key, 0) > 0):
+                continue
+            del self.chain[key]
+            self.freed += 16
+            for word in list(succ):
+                self.unlink(key, succ, word, dead)
+            if self.refs.get(key, 0) == 0:
+                continue
+            # It was left without words, but some transitions lead to it
+            for source in self.incoming.pop(key, ()):
+                succ = self.chain.get(source)
+                if succ is None:
+                    continue
+                for word in list(succ):
+                    if word != self.end and self.target(source, word) == key:
+                        self.unlink(source, succ, word, dead)
+            for word in self.starting.pop(key, ()):
+                del self.heads[word]
+                self.freed += 8
+                self.refs[key] -= 1
+
+    # Removes a transition from its key's words, adding the keys it may have
+    # left dead to the given list
+    def unlink(self, key, succ, word, dead):
+        del succ[word]
+        self.freed += 8
+        if word != self.end:
+            target = self.target(key, word)
+            self.refs[target] -= 1
+            if self.refs[target] == 0:
+                dead.append(target)
+        if not succ:
+            dead.append(key)
+
+    # Removes the keys that can't be reached from HEAD, which are only left
+    # by transitions that lead in circles
+    def sweep(self):
+        seen = set()
+        stack = [pairkey(self.head, self.folds[word]) for word in self.heads]
+        while stack:
+            key = stack.pop()
+            if key in seen:
+                continue
+            seen.add(key)
+            for word in self.chain[key]:
+                if word != self.end:
+                    stack.append(self.target(key, word))
+        for key in [key for key in self.chain if key not in seen]:
+            succ = self.chain.pop(key)
+            self.freed += 16 + 8 * len(succ)
+
+
+# A hash table from 64-bit keys to 32-bit values, kept in 2 flat arrays with
+# open addressing, so that each entry takes a few bytes instead of the ~100
+# of a dictionary entry with its key and value objects. Keys are stored plus
+# one, as 0 marks an empty slot
+class EdgeTable(object):
+    # The table grows when it's this full
+    LOAD = 0.6
+    # Fibonacci hashing multiplier
+    MIX = 0x9E3779B97F4A7C15
+    MASK = (1 << 64) - 1
+
+    def __init__(self, bits=10):
+        self.bits = bits
+        self.keys = array("Q", bytes(8 << bits))
+        self.values = array("I", bytes(4 << bits))
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def copy(self):
+        table = EdgeTable(self.bits)
+        table.keys = array("Q", self.keys)
+        table.values = array("I", self.values)
+        table.size = self.size
+        return table
+
+    # Returns the slot of a key: the one holding it, or the empty one where
+    # it would go
+    def slot(self, key):
+        stored = key + 1
+        keys = self.keys
+        mask = len(keys) - 1
+        i = ((key * EdgeTable.MIX) & EdgeTable.MASK) >> (64 - self.bits)
+        while True:
+            k = keys[i]
+            if k == stored or k == 0:
+                return i
+            i = (i + 1) & mask
+
+    def get(self, key, default=None):
+        i = self.slot(key)
+        if self.keys[i] == 0:
+            return default
+        return self.values[i]
+
+    # Returns the value of a key, setting it to the given one if it's not there
+    def setdefault(self, key, value):
+        stored = key + 1
+        keys = self.keys
+        mask = len(keys) - 1
+        i = ((key * EdgeTable.MIX) & EdgeTable.MASK) >> (64 - self.bits)
+        while True:
+            k = keys[i]
+            if k == stored:
+                return self.values[i]
+            if k == 0:
+                break
+            i = (i + 1) & mask
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        i = self.slot(key)
+        if self.keys[i] == 0:
+            if self.size + 1 > len(self.keys) * EdgeTable.LOAD:
+                self.resize(self.bits + 1)
+                i = self.slot(key)
+            self.keys[i] = key + 1
+            self.size += 1
+        self.values[i] = value
+
+    def resize(self, bits):
+        items = list(self.items())
+        self.bits = bits
+        self.keys = array("Q", bytes(8 << bits))
+        self.values = array("I", bytes(4 << bits))
+        self.size = 0
+        for key, value in items:
+            self.put(key, value)
+
+    # Iterates over the (key, value) pairs
+    def items(self):
+        for k, v in zip(self.keys, self.values):
+            if k != 0:
+                yield k - 1, v
+
+
+# The chain for contexts longer than 2 words, up to the chain's order. The
+# contexts are stored from their last word backwards, so a context of k words
+# is a child of the context of its last k-1 words: every order shares the
+# nodes of the shorter contexts, and backing off to a shorter context is just
+# stopping higher up in the trie. Nodes are numbered, and the trie is an
+# EdgeTable from the packed (parent node, casefolded word ID) pair to the
+# child node, so a context takes the same few bytes whatever its length.
+# The 2-word contexts are the Generator's own cache, so the nodes at depth 1
+# and 2 only have children
+class ChainTrie(object):
+    def __init__(self, order):
+        # The longest context, in words
+        self.order = order
+        # (parent node << KEY_SHIFT | word) -> child node. The root is node 0
+        self.edges = EdgeTable()
+        # The cache value of the words following each node's context, if any
+        self.next = [None]
+
+    def __len__(self):
+        return len(self.next)
+
+    def copy(self):
+        trie = ChainTrie(self.order)
+        trie.edges = self.edges.copy()
+        trie.next = [
+            value if value is None or type(value) is int else value.copy()
+            for value in self.next
+        ]
+        return trie
+
+    # Learns every transition of a message, given its word IDs and the IDs of
+    # their casefolded forms. The EdgeTable lookups are inlined, as this runs
+    # for every word of every message
+    def learn(self, ids, folds):
+        order = self.order
+        edges = self.edges
+        following = self.next
+        mix, mask64 = EdgeTable.MIX, EdgeTable.MASK
+        for j in range(3, len(ids)):
+            node = 0
+            for d in range(1, min(order, j) + 1):
+                key = (node << KEY_SHIFT) | folds[j - d]
+                stored = key + 1
+                keys = edges.keys
+                mask = len(keys) - 1
+                i = ((key * mix) & mask64) >> (64 - edges.bits)
+                while True:
+                    k = keys[i]
+                    if k == stored:
+                        node = edges.values[i]
+                        break
+                    if k == 0:
+                        node = len(following)
+                        following.append(None)
+                        edges.put(key, node)
+                        break
+                    i = (i + 1) & mask
+                if d >= 3:
+                    following[node] = grow(following[node], ids[j])
+
+    # Returns the value for the longest context (of at least 3 words) found at
+    # the end of the given casefolded word IDs, or None
+    def lookup(self, folds):
+        edges = self.edges
+        node = 0
+        found = None
+        for d in range(1, min(self.order, len(folds)) + 1):
+            node = edges.get((node << KEY_SHIFT) | folds[-d])
+            if node is None:
+                break
+            if d >= 3 and self.next[node] is not None:
+                found = self.next[node]
+        return found
+
+    # Returns the depth of every node (children are numbered after parents)
+    def depths(self):
+        depths = [0] * len(self.next)
+        for edge, child in sorted(self.edges.items(), key=lambda e: e[1]):
+            depths[child] = depths[edge >> KEY_SHIFT] + 1
+        return depths
+
+    # Drops the contexts longer than the given order
+    def prune(self, order):
+        depths = self.depths()
+        kept = [i for i in range(len(self.next)) if depths[i] <= order]
+        renumber = {old: new for new, old in enumerate(kept)}
+        edges = EdgeTable()
+        for edge, child in self.edges.items():
+            if child in renumber:
+                parent = renumber[edge >> KEY_SHIFT]
+                word = edge & ((1 << KEY_SHIFT) - 1)
+                edges.put((parent << KEY_SHIFT) | word, renumber[child])
+        self.edges = edges
+        self.next = [self.next[i] for i in kept]
+        self.order = order
+
+    # Number of (context, word) transitions stored
+    def transitions(self):
+        return sum(
+            1 if type(value) is int else len(value)
+            for value in self.next
+            if value is not None
+        )
+
+    # Returns the trie for the dumps, with the words as strings: the edges as
+    # [parent, word, child] and the words following each node as {word: count}
+    def to_dict(self, words):
+        mask = (1 << KEY_SHIFT) - 1
+        return {
+            "order": self.order,
+            "edges": [
+                [edge >> KEY_SHIFT, words[edge & mask], child]
+                for edge, child in self.edges.items()
+            ],
+            "next": [
+                None if value is None else {words[w]: c for w, c in successors(value)}
+                for value in self.next
+            ],
+        }
+
+    # Creates a trie from its dump, interning its words in a TokenTable
+    def FromDict(dump, tokens):
+        intern = tokens.intern
+        trie = ChainTrie(dump["order"])
+        for parent, word, child in dump["edges"]:
+            trie.edges.put((parent << KEY_SHIFT) | intern(word), child)
+        trie.next = [
+            None if pairs is None else compact((intern(w), c) for w, c in pairs.items())
+            for pairs in dump["next"]
+        ]
+        return trie
+
+
+# The whole chain of a Generator as NumPy arrays, for generate_many(...): the
+# sorted keys, where each key's successors start, and the successor words with
+# the running sum of their counts, so that picking a word for many keys at
+# once is a couple of searchsorted(...) calls
+class ChainTables(object):
+    def __init__(self, gen):
+        keys = []
+        starts = [0]
+        words = []
+        counts = []
+        for key, value in sorted(gen.items()):
+            keys.append(key)
+            for word, count in successors(value):
+                words.append(word)
+                counts.append(count)
+            starts.append(len(words))
+        self.keys = numpy.array(keys, dtype=numpy.uint64)
+        self.starts = numpy.array(starts, dtype=numpy.int64)
+        self.words = numpy.array(words, dtype=numpy.int64)
+        # The running sums of the counts, starting from 0
+        self.cum = numpy.concatenate(([0], numpy.cumsum(counts, dtype=numpy.int64)))
+        self.head_words = numpy.array(gen.heads.words, dtype=numpy.int64)
+        self.head_cum = numpy.concatenate(
+            ([0], numpy.cumsum(gen.heads.counts, dtype=numpy.int64))
+        )
+        self.folds = numpy.array(gen.tokens.folds, dtype=numpy.uint64)
+        tail = gen.tokens.ids.get(Generator.TAIL)
+        self.tail = -1 if tail is None else tail
+
+    # Returns the positions of the keys made from 2 arrays of casefolded word
+    # IDs, with -1 for the ones that aren't in the chain
+    def find(self, f1, f2):
+        keys = (f1 << numpy.uint64(KEY_SHIFT)) | f2
+        pos = numpy.searchsorted(self.keys, keys)
+        pos[pos == len(self.keys)] = 0
+        found = len(self.keys) > 0 and self.keys[pos] == keys
+        return numpy.where(found, pos, -1)
+
+    # Picks a position in each range [start, end) of a running sum, weighted
+    # by the counts, given a random number in [0, 1) for each one
+    def sample(self, cum, start, r, end=None):
+        if end is None:
+            end = len(cum) - 1
+        base = cum[start]
+        target = base + (r * (cum[end] - base)).astype(numpy.int64)
+        return numpy.searchsorted(cum, target, side="right") - 1
+
+    # Picks a successor word for the keys at the given positions (-1 gives -1)
+    def successor(self, pos, r):
+        valid = pos >= 0
+        pos = numpy.maximum(pos, 0)
+        picked = self.sample(self.cum, self.starts[pos], r, self.starts[pos + 1])
+        return numpy.where(valid, self.words[picked], -1)
+
+
+# This is the table of all the words known by a Generator. Each distinct word
+# is stored only once and given an integer ID, and every word also remembers
+# the ID of its casefolded form, which is the one used for the chain keys
+class TokenTable(object):
+    def __init__(self):
+        # The words, indexed by their ID
+        self.words = []
+        # The IDs, indexed by their word
+        self.ids = {}
+        # The ID of the casefolded form of each word, indexed by ID
+        self.folds = []
+        # Bytes taken by the words, encoded in UTF-8
+        self.size = 0
+
+    def __len__(self):
+        return len(self.words)
+
+    def copy(self):
+        tokens = TokenTable()
+        tokens.words = list(self.words)
+        tokens.ids = dict(self.ids)
+        tokens.folds = list(self.folds)
+        tokens.size = self.size
+        return tokens
+
+    # Returns the ID of a word, adding it to the table if it's new
+    def intern(self, word):
+        tid = self.ids.get(word)
+        if tid is not None:
+            return tid
+        tid = len(self.words)
+        self.words.append(word)
+        self.ids[word] = tid
+        self.size += len(word.encode("utf-8"))
+        self.folds.append(tid)
+        folded = casefold(word)
+        if folded != word:
+            self.folds[tid] = self.intern(folded)
+        return tid
+
+    # Returns the word for an ID
+    def word(self, tid):
+        return self.words[tid]
+
+    # Returns the ID of the casefolded form of a word ID
+    def fold(self, tid):
+        return self.folds[tid]
+
+    # Returns the chain key for 2 word IDs, ignoring case
+    def key(self, i1, i2):
+        return pairkey(self.folds[i1], self.folds[i2])
+
+    # Returns the JSON dump dictionary key for a chain key
+    def dumpkey(self, key):
+        i1, i2 = unpairkey(key)
+        return str((self.words[i1], self.words[i2]))
+
+
 class Generator(object):
     # Marks when we want to create a Generator object from a given JSON
     MODE_JSON = "MODE_JSON"
@@ -59,39 +684,228 @@ class Generator(object):
     # Marks when we want to create a Generator object from a given dictionary
     MODE_DICT = "MODE_DICT"
 
-    # Marks when we want to create a Generator object from a whole Chat history (WIP)
+    # Marks when we want to create a Generator object from a whole Chat history
+    # (a HistoryStream)
     MODE_HIST = "MODE_HIST"
 
+    # Marks when we want to create a Generator object from a binary record file
+    MODE_RECORD = "MODE_RECORD"
+
     # Marks the beginning of a message
     HEAD = "\n^MESSAGE_SEPARATOR^"
     # Marks the end of a message
     TAIL = " ^MESSAGE_SEPARATOR^"
+    # The key of the ChainTrie in the JSON dumps
+    TRIE = "^CHAIN_TRIE^"
+    # Fraction of its size budget a vocabulary is pruned down to, so that it
+    # isn't pruned again as soon as it learns something new
+    PRUNE_TARGET = 0.9
 
     def __init__(self, load=None, mode=None):
+        # The table of interned words
+        self.tokens = TokenTable()
+        # The interned ID of the HEAD marker
+        self.head = self.tokens.intern(Generator.HEAD)
+        # The words that can start a message (the values under the HEAD key)
+        self.heads = Successors()
+        # The chain: packed key of 2 casefolded word IDs -> a word ID if only
+        # one word has been seen once after them, or a Successors otherwise
+        self.cache = {}
+        # The binary record file the chain is read from lazily, if any
+        self.record = None
+        # The lists of words learned since the Generator was last saved, for
+        # the Archivist to append to the chat's journal. None means that the
+        # chain was changed in some other way, and has to be saved whole
+        self.journal = []
+        # The chain as arrays for generate_many(...), built on demand
+        self.tables = None
+        # The chain for contexts of more than 2 words, if the order is higher
+        self.trie = None
+        # Number of keys of the chain, of (key, word) transitions, and the sum
+        # of their counts, kept up to date as it learns
+        self.n_keys = 0
+        self.n_transitions = 0
+        self.n_tokens = 0
         if mode is not None:
-            if mode == Generator.MODE_JSON:
-                self.cache = json.loads(load)
+            if mode == Generator.MODE_RECORD:
+                self.load_record(load)
+            elif mode == Generator.MODE_JSON:
+                self.load_dict(json.loads(load))
             elif mode == Generator.MODE_LIST:
-                self.cache = {}
                 self.load_list(load)
             elif mode == Generator.MODE_DICT:
-                self.cache = load
-            # TODO: Chat History mode
-        else:
-            self.cache = {}
+                self.load_dict(load)
+            elif mode == Generator.MODE_HIST:
+                self.load_history(load)
+
+    # Returns a copy of this Generator that doesn't change when this one
+    # learns. A record file it reads from is shared, as it's never written
+    def copy(self):
+        gen = Generator()
+        gen.tokens = self.tokens.copy()
+        gen.head = self.head
+        gen.heads = self.heads.copy()
+        gen.cache = {
+            key: value if type(value) is int else value.copy()
+            for key, value in self.cache.items()
+        }
+        gen.record = self.record
+        gen.trie = None if self.trie is None else self.trie.copy()
+        gen.journal = None if self.journal is None else list(self.journal)
+        gen.n_keys = self.n_keys
+        gen.n_transitions = self.n_transitions
+        gen.n_tokens = self.n_tokens
+        return gen
 
     # Loads a text divided into a list of lines
     def load_list(self, many):
-        for one in many:
-            self.add(one)
+        self.add_many(many)
+
+    # Learns every message of a chat history (a HistoryStream) the way a
+    # Reader would, reading it one message at a time
+    def load_history(self, history):
+        # Imported here to avoid a circular import, as Readers hold Generators
+        from reader import Reader
+
+        self.journal = None
+        for message in history.messages():
+            text = Reader.message_text(message)
+            if text is not None:
+                self.add(text)
+
+    # Learns again the lists of words from a journal, which are already saved
+    def replay(self, journal):
+        pending = self.journal
+        self.journal = None
+        for words in journal:
+            self.database(words)
+        self.journal = pending
+
+    # Takes the words and the HEAD list from a RecordFile, leaving the rest of
+    # the chain in the file until each key is needed
+    def load_record(self, record):
+        tokens = TokenTable()
+        tokens.words = record.tokens()
+        tokens.ids = {w: i for i, w in enumerate(tokens.words)}
+        tokens.folds = record.folds.tolist()
+        tokens.size = len(record.strings)
+        self.tokens = tokens
+        self.head = tokens.intern(Generator.HEAD)
+        self.heads = Successors()
+        for word, count in record.heads():
+            self.heads.add(word, count)
+        trie = record.trie()
+        if trie is not None:
+            self.trie = ChainTrie.FromDict(trie, tokens)
+        self.record = record
+        self.n_keys = record.n_keys
+        self.n_transitions = record.n_successors
+        if numpyError:
+            self.n_tokens = sum(record.counts)
+        else:
+            self.n_tokens = int(
+                numpy.frombuffer(record.counts, dtype=numpy.uint32).sum(
+                    dtype=numpy.uint64
+                )
+            )
+
+    # Returns the value stored for a key (or None), reading it from the
+    # record file and keeping it in the cache the first time it's needed
+    def lookup(self, key):
+        value = self.cache.get(key)
+        if value is None and self.record is not None:
+            i = self.record.find(key)
+            if i is not None:
+                value = compact(self.record.pairs(i))
+                self.cache[key] = value
+        return value
+
+    # Iterates over every key of the chain along with its value, including
+    # the ones still only in the record file
+    def items(self):
+        if self.record is None:
+            yield from self.cache.items()
+            return
+        for key, pairs in self.record.items():
+            value = self.cache.get(key)
+            if value is None:
+                value = compact(pairs)
+            yield key, value
+        for key, value in self.cache.items():
+            if key not in self.record:
+                yield key, value
+
+    # Loads a cache dictionary as found in the JSON dumps, where keys are
+    # str(tuple) of 2 casefolded words and values are either lists of words,
+    # duplicates included (as all files were before the counts were kept),
+    # or dictionaries of word -> count
+    def load_dict(self, cache):
+        intern = self.tokens.intern
+        if Generator.TRIE in cache:
+            self.trie = ChainTrie.FromDict(cache[Generator.TRIE], self.tokens)
+        for dkey, value in cache.items():
+            if dkey == Generator.TRIE:
+                continue
+            if isinstance(value, dict):
+                pairs = [(intern(w), c) for w, c in value.items()]
+            else:
+                pairs = [(intern(w), 1) for w in value]
+            if dkey == Generator.HEAD:
+                for word, count in pairs:
+                    self.heads.add(word, count)
+                continue
+            w1, w2 = parsekey(dkey)
+            key = pairkey(intern(w1), intern(w2))
+            for word, count in pairs:
+                self.learn(key, word, count)
+
+    # Returns the cache dictionary as found in the JSON dumps. Words seen only
+    # once after a key are kept as a one-word list, as it is shorter
+    def to_dict(self):
+        words = self.tokens.words
+        cache = {}
+        if len(self.heads) > 0:
+            cache[Generator.HEAD] = {words[w]: c for w, c in self.heads.items()}
+        for key, value in self.items():
+            if type(value) is int:
+                cache[self.tokens.dumpkey(key)] = [words[value]]
+            else:
+                cache[self.tokens.dumpkey(key)] = {
+                    words[w]: c for w, c in value.items()
+                }
+        if self.trie is not None:
+            cache[Generator.TRIE] = self.trie.to_dict(words)
+        return cache
+
+    # Iterates over the chain as (w1, w2, word, count) rows, where w1 and w2
+    # are the casefolded words of a key, as kept in the database. The words
+    # that can start a message are given with w1 = HEAD and w2 = ""
+    def rows(self):
+        words = self.tokens.words
+        for word, count in self.heads.items():
+            yield Generator.HEAD, "", words[word], count
+        for key, value in self.items():
+            i1, i2 = unpairkey(key)
+            w1, w2 = words[i1], words[i2]
+            for word, count in successors(value):
+                yield w1, w2, words[word], count
+
+    # Loads the chain from (w1, w2, word, count) rows, as given by rows()
+    def load_rows(self, rows):
+        intern = self.tokens.intern
+        for w1, w2, word, count in rows:
+            if w1 == Generator.HEAD and w2 == "":
+                self.heads.add(intern(word), count)
+            else:
+                self.learn(pairkey(intern(w1), intern(w2)), intern(word), count)
 
     # Dumps the cache dictionary into a JSON-formatted string
     def dumps(self):
-        return json.dumps(self.cache, ensure_ascii=False)
+        return json.dumps(self.to_dict(), ensure_ascii=False)
 
     # Dumps the cache dictionary into a file, formatted as JSON
     def dump(self, f):
-        json.dump(self.cache, f, ensure_ascii=False)
+        json.dump(self.to_dict(), f, ensure_ascii=False)
 
     # Loads the cache dictionary from a JSON-formatted string
     def loads(dump):
@@ -111,68 +925,488 @@ class Generator(object):
         words.extend(text)
         self.database(words)
 
+    # Learns many messages at once. Their triplets are counted first, packed
+    # as (key << KEY_SHIFT | word) integers so that a Counter counts them in
+    # C, and then each distinct (key, word) pair is learned once with its
+    # count. That's done inline unless the chain is read from a record file,
+    # as it runs for every pair. The chain ends up as if the messages had been
+    # added one by one, in the same order
+    def add_many(self, texts):
+        intern = self.tokens.intern
+        known = self.tokens.ids.get
+        folds = self.tokens.folds
+        journal = self.journal
+        starts = []
+        packed = []
+        for text in texts:
+            words = [Generator.HEAD]
+            words.extend(rewrite(text + Generator.TAIL))
+            if journal is not None:
+                journal.append(words)
+            ids = [known(w) for w in words]
+            if None in ids:
+                ids = [intern(w) for w in words]
+            if len(ids) < 3:
+                continue
+            starts.append(ids[1])
+            f = [folds[i] for i in ids]
+            packed.extend(
+                [
+                    (((f1 << KEY_SHIFT) | f2) << KEY_SHIFT) | i3
+                    for f1, f2, i3 in zip(f, f[1:], ids[2:])
+                ]
+            )
+            if self.trie is not None:
+                self.trie.learn(ids, f)
+        for word, count in Counter(starts).items():
+            self.heads.add(word, count)
+        counts = Counter(packed)
+        mask = (1 << KEY_SHIFT) - 1
+        if self.record is not None:
+            for pair, count in counts.items():
+                self.learn(pair >> KEY_SHIFT, pair & mask, count)
+            return
+        self.tables = None
+        self.n_tokens += len(packed)
+        cache = self.cache
+        keys = 0
+        transitions = 0
+        for pair, count in counts.items():
+            key = pair >> KEY_SHIFT
+            word = pair & mask
+            value = cache.get(key)
+            if value is None:
+                cache[key] = word if count == 1 else Successors([word], [count])
+                keys += 1
+                transitions += 1
+            elif type(value) is int:
+                if value == word:
+                    cache[key] = Successors([word], [count + 1])
+                else:
+                    cache[key] = Successors([value, word], [1, count])
+                    transitions += 1
+            else:
+                n = len(value.words)
+                value.add(word, count)
+                transitions += len(value.words) - n
+        self.n_keys += keys
+        self.n_transitions += transitions
+
+    # Stores a word ID as seen after a key, the given number of times
+    def learn(self, key, word, count=1):
+        self.tables = None
+        self.n_tokens += count
+        value = self.lookup(key)
+        if value is None:
+            # if the key doesn't exist, create a new entry for it starting
+            # with the new end of chain
+            if count == 1:
+                self.cache[key] = word
+            else:
+                self.cache[key] = Successors([word], [count])
+            self.n_keys += 1
+            self.n_transitions += 1
+        elif type(value) is int:
+            # if it only had one word so far, it needs the counts now
+            succ = Successors([value], [1])
+            succ.add(word, count)
+            self.cache[key] = succ
+            self.n_transitions += len(succ) - 1
+        else:
+            # otherwise, count the new word into the chain
+            n = len(value)
+            value.add(word, count)
+            self.n_transitions += len(value) - n
+
     # This takes a list of words and stores it in the cache, adding
     # a special entry for the first word (the HEAD marker)
     def database(self, words):
-        for w1, w2, w3 in triplets(words):
-            if w1 == Generator.HEAD:
-                if w1 in self.cache:
-                    self.cache[Generator.HEAD].append(w2)
-                else:
-                    self.cache[Generator.HEAD] = [w2]
-            key = getkey(w1, w2)
-            if key in self.cache:
-                # if the key exists, add the new word to the end of the chain
-                self.cache[key].append(w3)
-            else:
-                # otherwise, create a new entry for the new key starting with
-                # the new end of chain
-                self.cache[key] = [w3]
+        if self.journal is not None:
+            self.journal.append(words)
+        intern = self.tokens.intern
+        ids = [intern(w) for w in words]
+        folds = self.tokens.folds
+        for i1, i2, i3 in triplets(ids):
+            if i1 == self.head:
+                self.heads.add(i2)
+            self.learn(pairkey(folds[i1], folds[i2]), i3)
+        if self.trie is not None:
+            self.trie.learn(ids, [folds[i] for i in ids])
+
+    # Only a PagedGenerator can be over the number of keys it keeps in memory
+    def over_capacity(self):
+        return False
+
+    # The number of words the next word is chosen from
+    def order(self):
+        return 2 if self.trie is None else self.trie.order
+
+    # Sets the order of the chain. Contexts of more than 2 words are only
+    # learned from then on, and lowering the order forgets the longer ones
+    def set_order(self, order):
+        if order == self.order():
+            return
+        if order <= 2:
+            self.trie = None
+        elif self.trie is None:
+            self.trie = ChainTrie(order)
+        elif order < self.trie.order:
+            self.trie.prune(order)
+        else:
+            self.trie.order = order
+        self.journal = None
 
     # This generates the Markov text/word chain
     # silence=True disables Telegram user mentions
     def generate(self, size=50, silence=False):
-        if len(self.cache) == 0:
+        if len(self.heads) == 0:
             # If there is nothing in the cache we cannot generate anything
             return ""
+        if self.trie is not None:
+            return self.generate_trie(size, silence)
 
+        words = self.tokens.words
+        folds = self.tokens.folds
+        # The TAIL marker never gets interned by rewrite(...), so this is None
+        tail = self.tokens.ids.get(Generator.TAIL)
         # Start with a message HEAD and a random message starting word
-        w1 = random.choice(self.cache[Generator.HEAD])
-        w2 = random.choice(self.cache[getkey(Generator.HEAD, w1)])
+        i1 = self.heads.choice()
+        i2 = pick(self.lookup(pairkey(folds[self.head], folds[i1])))
         gen_words = []
         # As long as we don't go over the max. message length (in n. of words)...
-        for i in range(size):
+        for _ in range(size):
+            w1 = words[i1]
             if silence and w1.startswith("@") and len(w1) > 1:
                 # ...append word 1, disabling any possible Telegram mention
                 gen_words.append(w1.replace("@", "(@)"))
             else:
                 # ..append word 1
                 gen_words.append(w1)
-            if w2 == Generator.TAIL or getkey(w1, w2) not in self.cache:
+            key = pairkey(folds[i1], folds[i2])
+            following = self.cache.get(key)
+            if following is None and self.record is not None:
+                following = self.lookup(key)
+            if i2 == tail or following is None:
                 # When there's no key from the last 2 words to follow the chain,
                 # or we reached a separation between messages, stop
                 break
             else:
                 # Get a random third word that follows the chain of words 1
                 # and 2, then make words 2 and 3 to be the new words 1 and 2
-                w1, w2 = w2, random.choice(self.cache[getkey(w1, w2)])
+                if type(following) is int:
+                    i1, i2 = i2, following
+                else:
+                    i1, i2 = i2, following.choice()
+        return " ".join(gen_words)
+
+    # Generates a message like generate(...), but choosing each word from the
+    # longest context the ChainTrie has for the words so far, and backing off
+    # to the 2-word chain when it has none
+    def generate_trie(self, size=50, silence=False):
+        words = self.tokens.words
+        folds = self.tokens.folds
+        tail = self.tokens.ids.get(Generator.TAIL)
+        i1 = self.heads.choice()
+        i2 = pick(self.lookup(pairkey(folds[self.head], folds[i1])))
+        # The casefolded IDs of the words so far, HEAD included
+        context = [folds[self.head], folds[i1], folds[i2]]
+        gen_words = []
+        for _ in range(size):
+            w1 = words[i1]
+            if silence and w1.startswith("@") and len(w1) > 1:
+                gen_words.append(w1.replace("@", "(@)"))
+            else:
+                gen_words.append(w1)
+            if i2 == tail:
+                break
+            following = self.trie.lookup(context)
+            if following is None:
+                following = self.lookup(pairkey(folds[i1], folds[i2]))
+                if following is None:
+                    break
+            i1, i2 = i2, pick(following)
+            context.append(folds[i2])
         return " ".join(gen_words)
 
+    # Generates n messages at once, walking all their chains in lockstep over
+    # the arrays of a ChainTables, and drawing the random numbers of each step
+    # in a single NumPy call. The messages follow the same distribution as the
+    # ones from generate(...), which is used instead if NumPy isn't installed
+    def generate_many(self, n, size=50, silence=False):
+        if numpyError is not None or self.trie is not None:
+            return [self.generate(size=size, silence=silence) for _ in range(n)]
+        if len(self.heads) == 0:
+            return [""] * n
+        if self.tables is None:
+            self.tables = ChainTables(self)
+        tables = self.tables
+        # Seeded from random, so that random.seed(...) makes it reproducible
+        rng = numpy.random.default_rng(random.getrandbits(64))
+
+        out = numpy.zeros((n, size), dtype=numpy.int64)
+        lengths = numpy.zeros(n, dtype=numpy.int64)
+        active = numpy.arange(n)
+        i1 = tables.head_words[tables.sample(tables.head_cum, 0, rng.random(n))]
+        head = numpy.full(n, self.tokens.folds[self.head], dtype=numpy.uint64)
+        pos = tables.find(head, tables.folds[i1])
+        i2 = tables.successor(pos, rng.random(n))
+        for step in range(size):
+            out[active, step] = i1
+            lengths[active] = step + 1
+            pos = tables.find(tables.folds[i1], tables.folds[numpy.maximum(i2, 0)])
+            keep = (pos >= 0) & (i2 >= 0) & (i2 != tables.tail)
+            active, i2, pos = active[keep], i2[keep], pos[keep]
+            if len(active) == 0:
+                break
+            i1, i2 = i2, tables.successor(pos, rng.random(len(active)))
+
+        words = self.tokens.words
+        messages = []
+        for row, length in zip(out.tolist(), lengths.tolist()):
+            gen_words = [words[i] for i in row[:length]]
+            if silence:
+                gen_words = [
+                    w.replace("@", "(@)") if w.startswith("@") and len(w) > 1 else w
+                    for w in gen_words
+                ]
+            messages.append(" ".join(gen_words))
+        return messages
+
     # Cross a second Generator into this one
     def cross(self, gen):
-        for key in gen.cache:
-            if key in self.cache:
-                self.cache[key].extend(gen.cache[key])
-            else:
-                self.cache[key] = list(gen.cache[key])
+        self.journal = None
+        # The other Generator has its own word IDs, so translate them to ours
+        intern = self.tokens.intern
+        ids = [intern(w) for w in gen.tokens.words]
+        for word, count in gen.heads.items():
+            self.heads.add(ids[word], count)
+        for key, value in gen.items():
+            i1, i2 = unpairkey(key)
+            key = pairkey(ids[i1], ids[i2])
+            for word, count in successors(value):
+                self.learn(key, ids[word], count)
+
+    # Prunes the chain down to a fraction (target) of a size budget, in
+    # bytes as given by stats(), if it's over it. The least frequent
+    # transitions are removed first, starting with those of the keys that
+    # have the most words to choose from, through a ChainPruner so that the
+    # chain stays walkable from HEAD. The words no longer used go as well.
+    # The ChainTrie is left as it is. Returns the VocabStats before and after
+    def prune(self, limit, target=None):
+        if target is None:
+            target = Generator.PRUNE_TARGET
+        before = self.stats()
+        if before.bytes <= limit:
+            return before, before
+        goal = int(limit * target)
+        end = self.tokens.ids.get(Generator.TAIL.strip())
+        chain = {key: dict(successors(value)) for key, value in self.items()}
+        heads = dict(self.heads.items())
+        pruner = ChainPruner(chain, heads, self.tokens.folds, self.head, end)
+        size, words = before.bytes, self.words_size()
+        # The transitions with the lowest count, the ones to remove first last
+        candidates = []
+        while size > goal and chain:
+            if not candidates:
+                threshold = min(c for succ in chain.values() for c in succ.values())
+                candidates = sorted(
+                    (
+                        (key, word)
+                        for key, succ in chain.items()
+                        for word, count in succ.items()
+                        if count == threshold
+                    ),
+                    key=lambda pair: len(chain[pair[0]]),
+                )
+            # The pruner doesn't count the words no longer used, so they're
+            # taken to shrink along with the rest, and anything left over is
+            # removed in the next round
+            excess = (size - goal) * (size - words) / size
+            freed = pruner.freed
+            while candidates and pruner.freed - freed < excess:
+                key, word = candidates.pop()
+                if word in chain.get(key, ()):
+                    pruner.remove(key, word)
+            pruner.sweep()
+            size, words = self.chain_size(chain, heads)
+        self.rebuild(chain, heads)
+        return before, self.stats()
+
+    # The bytes the words take in stats()
+    def words_size(self):
+        return 12 * len(self.tokens) + self.tokens.size
+
+    # The bytes stats() would give for a chain of {key: {word: count}} and
+    # its {word: count} HEAD words, and how many of them its words take,
+    # leaving out the words of the ChainTrie
+    def chain_size(self, chain, heads):
+        words = self.tokens.words
+        folds = self.tokens.folds
+        mask = (1 << KEY_SHIFT) - 1
+        used = {self.head, folds[self.head]}
+        for word in heads:
+            used.update((word, folds[word]))
+        for key, succ in chain.items():
+            used.update((key >> KEY_SHIFT, key & mask))
+            for word in succ:
+                used.update((word, folds[word]))
+        size = sum(12 + len(words[i].encode("utf-8")) for i in used)
+        return (
+            size
+            + 16 * len(chain)
+            + 8 * (sum(len(succ) for succ in chain.values()) + len(heads)),
+            size,
+        )
 
-    # Count again the number of messages
-    # (for whenever the count number is unreliable)
+    # Replaces the chain with one of {key: {word: count}} and its HEAD words,
+    # in a new TokenTable with only the words they use. As the words are
+    # given new IDs, the whole chain is in memory afterwards, and has to be
+    # saved whole
+    def rebuild(self, chain, heads):
+        old = self.tokens.words
+        trie = None if self.trie is None else self.trie.to_dict(old)
+        tokens = TokenTable()
+        intern = tokens.intern
+        self.head = intern(Generator.HEAD)
+        self.heads = Successors()
+        for word, count in heads.items():
+            self.heads.add(intern(old[word]), count)
+        mask = (1 << KEY_SHIFT) - 1
+        cache = {}
+        n_tokens = 0
+        n_transitions = 0
+        for key, succ in chain.items():
+            key = pairkey(intern(old[key >> KEY_SHIFT]), intern(old[key & mask]))
+            cache[key] = compact((intern(old[w]), c) for w, c in succ.items())
+            n_tokens += sum(succ.values())
+            n_transitions += len(succ)
+        if trie is not None:
+            self.trie = ChainTrie.FromDict(trie, tokens)
+        self.tokens = tokens
+        self.cache = cache
+        self.record = None
+        self.tables = None
+        self.journal = None
+        self.n_keys = len(cache)
+        self.n_transitions = n_transitions
+        self.n_tokens = n_tokens
+
+    # The number of messages learned, which is how many times a word was
+    # seen after HEAD
     def new_count(self):
-        count = 0
-        for key in self.cache:
-            for word in self.cache[key]:
-                if word == Generator.TAIL:
-                    # ...by just counting message separators
-                    count += 1
-        return count
+        return self.heads.total
+
+    # Returns the VocabStats of the Generator. The bytes are those of the
+    # sections of a record file, leaving out the ChainTrie
+    def stats(self):
+        size = (
+            self.words_size()
+            + 16 * self.n_keys
+            + 8 * (self.n_transitions + len(self.heads))
+        )
+        return VocabStats(
+            self.heads.total, self.n_tokens, self.n_keys, self.n_transitions, size
+        )
+
+
+# A Generator reading its chain from a binary record file that only keeps in
+# memory a bounded number of the keys it reads from it, so that the memory
+# taken by a chat doesn't grow with the size of its vocabulary. The keys are
+# kept in least recently used order, and when there are too many the oldest
+# one is dropped, to be read from the file again if it's needed. Keys changed
+# by learning are kept in the cache instead, and never dropped, as the record
+# file doesn't have their new values
+class PagedGenerator(Generator):
+    # Default maximum number of keys read from the file kept in memory
+    CAPACITY = 2**16
+
+    def __init__(self, record, capacity=CAPACITY):
+        # The keys read from the record file and not changed since, in least
+        # recently used order
+        self.paged = OrderedDict()
+        # Maximum number of keys in memory, changed keys included
+        self.capacity = capacity
+        # Number of keys read from the record file, and dropped from memory
+        self.faults = 0
+        self.evictions = 0
+        # The keys changed since the last time the Generator was spilled, and
+        # the spill being written (if any)
+        self.fresh = set()
+        self.spilling = None
+        super().__init__(load=record, mode=Generator.MODE_RECORD)
+
+    def lookup(self, key):
+        value = self.cache.get(key)
+        if value is not None or self.record is None:
+            return value
+        value = self.paged.get(key)
+        if value is not None:
+            self.paged.move_to_end(key)
+            return value
+        i = self.record.find(key)
+        if i is None:
+            return None
+        value = compact(self.record.pairs(i))
+        self.faults += 1
+        self.paged[key] = value
+        # The changed keys take their share of the capacity
+        while len(self.paged) > 0 and self.resident() > self.capacity:
+            self.paged.popitem(last=False)
+            self.evictions += 1
+        return value
+
+    def learn(self, key, word, count=1):
+        # The key is read first, so that it's changed in the cache (where it
+        # stays until the Generator is spilled) rather than among the paged
+        # keys, where it could be dropped at any time
+        if key not in self.cache:
+            value = self.lookup(key)
+            if value is not None:
+                self.paged.pop(key, None)
+                self.cache[key] = value
+        self.fresh.add(key)
+        super().learn(key, word, count)
+
+    # Tells whether the changed keys went over the capacity, so the Generator
+    # has to be spilled: written whole into a new record file, which it then
+    # reads its keys from, so that the changed keys can be dropped
+    def over_capacity(self):
+        return self.spilling is None and len(self.cache) > self.capacity
+
+    # Starts a spill, as the Generator is about to be written whole. Returns
+    # the spill, to give refresh(...) once it's written
+    def spill(self):
+        self.spilling = object()
+        self.fresh = set()
+        return self.spilling
+
+    # Ends a spill once its record file has been written (or failed to be
+    # written, with records=None). The keys that didn't change since the
+    # spill started are dropped from the cache, as the new record file has
+    # them. A spill that isn't the last one started is left alone
+    def refresh(self, spill, records):
+        if spill is not self.spilling:
+            if records is not None:
+                records.close()
+            return False
+        self.spilling = None
+        if records is None:
+            return False
+        for key in [key for key in self.cache if key not in self.fresh]:
+            del self.cache[key]
+        self.paged.clear()
+        self.record = records
+        return True
+
+    # Pruning leaves the whole chain in the cache, without the record file.
+    # A spill started before has words of the old token table
+    def prune(self, limit, target=None):
+        stats = super().prune(limit, target)
+        if self.record is None:
+            self.paged.clear()
+            self.spilling = None
+        return stats
+
+    # Number of keys in memory
+    def resident(self):
+        return len(self.cache) + len(self.paged)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import codecs
+import json
+import os
+
+# Telegram chat types for each chat type found in the exports
+CHAT_TYPES = {
+    "personal_chat": "private",
+    "bot_chat": "private",
+    "saved_messages": "private",
+    "private_group": "group",
+    "private_supergroup": "supergroup",
+    "public_supergroup": "supergroup",
+    "private_channel": "channel",
+    "public_channel": "channel",
+}
+
+
+# Returns the Telegram chat type of an exported chat
+def chat_type(header):
+    return CHAT_TYPES.get(header.get("type"), "private")
+
+
+# Returns the ID the Telegram Bot API gives to an exported chat, as exports
+# leave out the -100 prefix of supergroups and channels, and the - of groups
+def chat_id(header):
+    cid = int(header["id"])
+    ctype = chat_type(header)
+    if ctype == "supergroup" or ctype == "channel":
+        return str(-(10**12 + cid))
+    elif ctype == "group":
+        return str(-cid)
+    return str(cid)
+
+
+# Returns the text of an exported message, which is either a string or a
+# list of strings and formatted parts such as {"type": "bold", "text": ...}
+def entry_text(text):
+    if isinstance(text, str):
+        return text
+    parts = []
+    for part in text or []:
+        if isinstance(part, str):
+            parts.append(part)
+        elif isinstance(part, dict):
+            parts.append(part.get("text", ""))
+    return "".join(parts)
+
+
+class Media(object):
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+
+# A message from a chat export, with the same attributes Reader.read(...)
+# uses from a Telegram Message. Exports made by Telegram Desktop don't keep
+# the files' IDs, so media messages only get their file if the export has a
+# "file_id" field; otherwise they are read like any other unknown message
+class HistoryMessage(object):
+    def __init__(self, entry):
+        self.message_id = entry.get("id")
+        self.text = None
+        self.sticker = None
+        self.animation = None
+        self.video = None
+        media = entry.get("media_type")
+        file_id = entry.get("file_id")
+        if media is None and "photo" not in entry and "file" not in entry:
+            # Like Telegram Messages, media messages have captions, not texts
+            text = entry_text(entry.get("text"))
+            if len(text) > 0:
+                self.text = text
+        elif file_id is not None:
+            if media == "sticker":
+                self.sticker = Media(file_id)
+            elif media == "animation":
+                self.animation = Media(file_id)
+            elif media == "video_file":
+                self.video = Media(file_id)
+
+
+# Reads a chat export (the result.json file made by Telegram Desktop) as a
+# stream, one message at a time, so that exports of any size can be read
+# holding only a chunk of the file and a message in memory. The fields that
+# come before the messages in the file (the chat's name, type and ID) are
+# read when the stream is created, and kept in the header
+class HistoryStream(object):
+    # Size (in bytes) of the chunks the file is read in
+    CHUNK_SIZE = 2**16
+
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        # The export file, opened in binary mode
+        self.file = file
+        self.chunk_size = chunk_size
+        try:
+            self.size = os.fstat(file.fileno()).st_size
+        except (AttributeError, OSError):
+            self.size = None
+        # Number of bytes read from the file so far
+        self.bytes_read = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json = json.JSONDecoder()
+        # The text read and not yet parsed is buffer[pos:]
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        # The top level fields before the messages
+        self.header = {}
+        self.read_header()
+
+    # Opens an export file as a stream
+    def open(filepath, chunk_size=CHUNK_SIZE):
+        return HistoryStream(open(filepath, "rb"), chunk_size)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # The fraction of the file read so far, if its size is known
+    def progress(self):
+        if not self.size:
+            return None
+        return self.bytes_read / self.size
+
+    # Reads the next chunk of the file, dropping the text already parsed.
+    # Returns False at the end of the file
+    def fill(self):
+        if self.eof:
+            return False
+        data = self.file.read(self.chunk_size)
+        self.bytes_read += len(data)
+        self.eof = len(data) == 0
+        self.buffer = self.buffer[self.pos :] + self.decoder.decode(data, self.eof)
+        self.pos = 0
+        return not self.eof
+
+    # Returns the next character that isn't whitespace without taking it, or
+    # "" at the end of the file
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    # Takes the next character that isn't whitespace, which has to be one of
+    # the given ones, and returns it
+    def expect(self, chars):
+        c = self.peek()
+        if c == "" or c not in chars:
+            raise ValueError(
+                "Expected {} in chat export, found {}.".format(
+                    " or ".join(repr(x) for x in chars), repr(c) if c else "the end"
+                )
+            )
+        self.pos += 1
+        return c
+
+    # Parses the next JSON value, reading as much of the file as it takes
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer might go on in the file
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise ValueError("Chat export is truncated or malformed.") from e
+            self.fill()
+
+    # Reads the top level fields until the start of the message list
+    def read_header(self):
+        self.expect("{")
+        while self.peek() != "}":
+            key = self.value()
+            self.expect(":")
+            if key == "messages":
+                self.expect("[")
+                return
+            self.header[key] = self.value()
+            if self.expect(",}") == "}":
+                break
+        raise ValueError(
+            "No messages in chat export (only single chat exports can be read)."
+        )
+
+    # Iterates over the exported messages, as dictionaries
+    def entries(self):
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+    # Iterates over the exported messages (leaving out service messages such
+    # as joins or pins) as HistoryMessages
+    def messages(self):
+        for entry in self.entries():
+            if isinstance(entry, dict) and entry.get("type", "message") == "message":
+                yield HistoryMessage(entry)
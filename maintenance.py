@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import signal
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from archivist import Archivist
+from database import DatabaseArchivist
+from history import HistoryStream, chat_id
+from reader import Reader
+
+logger = logging.getLogger(__name__)
+
+log_format = "[MAINTENANCE][%(asctime)s]%(name)s::%(levelname)s: %(message)s"
+
+
+# The Archivist of each worker process of the pool
+worker = None
+
+
+# Sets up a worker process of the pool. Interruptions are left to the main
+# process, which lets the chats being handled finish
+def init_worker(directory, binary, vocab_limit):
+    global worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker = Archivist(
+        logger,
+        chatdir=directory,
+        chatext=".vls",
+        binary=binary,
+        use_catalog=False,
+        vocab_limit=vocab_limit,
+    )
+
+
+# Returns the size and modification time of every file in a folder, by name
+def snapshot(folder):
+    files = {}
+    if os.path.isdir(folder):
+        for entry in os.scandir(folder):
+            if entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+# Runs a command on a chat in a worker process, returning the chat ID, the
+# bytes read and written, and the error if it failed
+def run_chat(command, cid):
+    folder = worker.chat_folder(tag=cid)
+    before = snapshot(folder)
+    try:
+        if command == "update":
+            worker.update_chat(cid)
+        elif not worker.convert_chat(cid):
+            # Already in the right format, nothing was read
+            return cid, 0, 0, None
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    after = snapshot(folder)
+    read = sum(size for size, _ in before.values())
+    written = sum(
+        size
+        for name, (size, mtime) in after.items()
+        if before.get(name) != (size, mtime)
+    )
+    return cid, read, written, error
+
+
+# Formats a number of bytes
+def size(n):
+    return "{:.1f} MiB".format(n / 2**20)
+
+
+# Handles the update and convert commands: runs them on every chat over a
+# pool of processes. The chats done are written down in a progress file as
+# they finish, so that running the command again after an interruption (or
+# after some chats failed) only goes through the rest
+def bulk(archivist, args):
+    progress = os.path.join(
+        args.directory, "maintenance_{}.progress".format(args.command)
+    )
+    if args.restart and os.path.exists(progress):
+        os.remove(progress)
+    done = set()
+    if os.path.exists(progress):
+        with open(progress, "r") as file:
+            done = {line.strip() for line in file if line.strip()}
+    tags = [cid for cid in archivist.chat_tags() if cid not in done]
+    logger.info(
+        "Running {} on {} chats with {} workers ({} done in a previous run).".format(
+            args.command, len(tags), args.workers, len(done)
+        )
+    )
+
+    start = time.perf_counter()
+    total_read = 0
+    total_written = 0
+    failed = {}
+    finished = 0
+    interrupted = False
+    with (
+        open(progress, "a") as file,
+        ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=init_worker,
+            initargs=(args.directory, archivist.binary, archivist.vocab_limit),
+        ) as pool,
+    ):
+        futures = {pool.submit(run_chat, args.command, cid): cid for cid in tags}
+        try:
+            for future in as_completed(futures):
+                try:
+                    cid, read, written, error = future.result()
+                except Exception:
+                    cid, read, written = futures[future], 0, 0
+                    error = traceback.format_exc()
+                finished += 1
+                total_read += read
+                total_written += written
+                if error is None:
+                    file.write(cid + "\n")
+                    file.flush()
+                else:
+                    failed[cid] = error
+                    logger.error("Failed chat {}:\n{}".format(cid, error))
+                if finished % 100 == 0:
+                    logger.info("{}/{} chats done.".format(finished, len(tags)))
+        except KeyboardInterrupt:
+            interrupted = True
+            logger.warning("Interrupted, waiting for the chats being handled...")
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "{} chats done in {:.1f} s, {} failed. Read {}, wrote {}.".format(
+            finished - len(failed),
+            elapsed,
+            len(failed),
+            size(total_read),
+            size(total_written),
+        )
+    )
+    if failed:
+        logger.error("Failed chats: {}".format(", ".join(failed)))
+    if interrupted or failed:
+        logger.info("Run the command again to go through the rest of the chats.")
+        return 1
+    os.remove(progress)
+    return 0
+
+
+# Handles the import command: reads a chat export into the chat's vocabulary,
+# creating the chat if it isn't stored yet
+def history(archivist, args):
+    with HistoryStream.open(args.file) as stream:
+        cid = args.chat_id or chat_id(stream.header)
+        reader = archivist.get_reader(cid)
+        if reader is None:
+            logger.info("Importing {} into new chat {}.".format(args.file, cid))
+            reader = Reader.FromHistory(
+                stream,
+                None,
+                archivist.min_period,
+                archivist.max_period,
+                logger,
+                cid=cid,
+                names=args.names,
+            )
+        else:
+            logger.info("Importing {} into chat {}.".format(args.file, cid))
+            reader.names = args.names
+            reader.read_history(stream)
+    archivist.store(*reader.archive())
+    archivist.close()
+    logger.info("Chat {} now has {} messages.".format(cid, reader.count()))
+    return 0
+
+
+# Handles the migrate command: copies every chat of the chat logs directory
+# into the database. The chat folders are left as they are
+def migrate(archivist, args):
+    database = DatabaseArchivist(
+        logger, chatdir=args.directory, chatext=".vls", database=args.database
+    )
+    failed = []
+    for cid in archivist.chat_tags():
+        try:
+            card = archivist.load_card(cid)
+            if not card:
+                failed.append(cid)
+                continue
+            database.store(cid, card, None)
+            database.store_vocab(cid, archivist.get_vocab(cid))
+            logger.info("Migrated chat {}.".format(cid))
+        except Exception as e:
+            logger.error("Failed migrating chat {}".format(cid))
+            logger.exception(e)
+            failed.append(cid)
+    database.close()
+    if failed:
+        logger.error(
+            "Failed migrating {} chats: {}".format(len(failed), ", ".join(failed))
+        )
+    else:
+        logger.info("All chats migrated into {}.".format(database.database))
+    return len(failed)
+
+
+# Handles the merge command: merges the vocabularies of some chats into a
+# chat, which can be one of them or a new one
+def merge(archivist, args):
+    start = time.perf_counter()
+    stats = archivist.merge_chats(args.chats, args.into)
+    archivist.close()
+    logger.info(
+        "Merged {} into chat {} in {:.1f} s: {} messages, {} keys and {}"
+        " transitions ({}).".format(
+            ", ".join(args.chats),
+            args.into,
+            time.perf_counter() - start,
+            stats.messages,
+            stats.keys,
+            stats.transitions,
+            size(stats.bytes),
+        )
+    )
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Maintenance tasks for a Velasco chatlog directory."
+    )
+    parser.add_argument(
+        "-d",
+        "--directory",
+        metavar="CHATLOG_DIR",
+        default="./chatlogs",
+        help='The chat logs directory path (default: "./chatlogs").',
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    pool = argparse.ArgumentParser(add_help=False)
+    pool.add_argument(
+        "-j",
+        "--workers",
+        metavar="N",
+        type=int,
+        default=os.cpu_count(),
+        help="The number of worker processes. (default: the number of CPUs)",
+    )
+    pool.add_argument(
+        "--restart",
+        action="store_true",
+        help="Go through every chat again, instead of resuming the last run.",
+    )
+
+    command = commands.add_parser(
+        "convert",
+        parents=[pool],
+        help="Rewrite the JSON vocabulary files as binary records.",
+    )
+    command.add_argument(
+        "--json",
+        action="store_true",
+        help="Convert the binary records back into JSON files instead.",
+    )
+    command.set_defaults(handler=bulk)
+
+    command = commands.add_parser(
+        "update",
+        parents=[pool],
+        help="Load and store again every chat, rewriting its files whole.",
+    )
+    command.add_argument(
+        "-V",
+        "--vocab_limit",
+        metavar="MIB",
+        type=float,
+        default=None,
+        help="Prune the vocabularies over this size budget (in MiB), unless their"
+        + " card sets their own. (default: only the ones whose card sets one)",
+    )
+    command.set_defaults(handler=bulk)
+
+    command = commands.add_parser(
+        "import",
+        help="Learn a chat history exported from Telegram Desktop (result.json).",
+    )
+    command.add_argument("file", metavar="FILE", help="The exported JSON file.")
+    command.add_argument(
+        "-c",
+        "--chat-id",
+        metavar="ID",
+        help="The chat to import it into (default: the chat it was exported from).",
+    )
+    command.add_argument(
+        "-n",
+        "--names",
+        metavar="NAME",
+        nargs="*",
+        default=[],
+        help="The bot's username and nicknames, to skip messages summoning it.",
+    )
+    command.set_defaults(handler=history)
+
+    command = commands.add_parser(
+        "merge",
+        help="Merge the vocabularies of some chats into a chat, streaming them.",
+    )
+    command.add_argument("chats", metavar="ID", nargs="+", help="The chats to merge.")
+    command.add_argument(
+        "-i",
+        "--into",
+        metavar="ID",
+        required=True,
+        help="The chat to merge them into, along with its own vocabulary if it"
+        + " exists (it's created with the card of the first chat otherwise).",
+    )
+    command.set_defaults(handler=merge)
+
+    command = commands.add_parser(
+        "migrate",
+        help="Copy every chat of the chat logs directory into a SQLite database.",
+    )
+    command.add_argument(
+        "--database",
+        metavar="FILE",
+        help='The database file (default: "CHATLOG_DIR/{}").'.format(
+            DatabaseArchivist.FILENAME
+        ),
+    )
+    command.set_defaults(handler=migrate)
+
+    args = parser.parse_args()
+    logging.basicConfig(format=log_format, level=logging.INFO)
+
+    vocab_limit = getattr(args, "vocab_limit", None)
+    archivist = Archivist(
+        logger,
+        chatdir=args.directory,
+        chatext=".vls",
+        binary=not getattr(args, "json", False),
+        vocab_limit=None if vocab_limit is None else int(vocab_limit * 2**20),
+    )
+    return args.handler(archivist, args)
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main() else 0)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
 from collections.abc import Sequence
 
 
@@ -12,57 +13,70 @@ class MemoryList(Sequence):
       back
     - If a new item is added that goes over a given capacity
       limit, the item at the front (oldest accessed item)
-      is removed (and returned)"""
+      is removed (and returned)
+    Items are kept in a dictionary by the value of key(item)
+    (the item itself by default), so adding, looking up by
+    key with get(...), moving to the back and removing items
+    take constant time whatever the capacity."""
 
-    def __init__(self, capacity, data=None):
+    def __init__(self, capacity, data=None, key=None):
         super(MemoryList, self).__init__()
         self._capacity = capacity
+        self._key = key if key is not None else (lambda val: val)
+        self._dict = OrderedDict()
         if data is not None:
-            self._list = list(data)
-        else:
-            self._list = list()
+            for val in data:
+                self._dict[self._key(val)] = val
 
     def __repr__(self):
         return "<{0} {1}, capacity {2}>".format(
-            self.__class__.__name__, self._list, self._capacity
+            self.__class__.__name__, list(self._dict.values()), self._capacity
         )
 
     def __str__(self):
-        return "{0}, {1}/{2}".format(self._list, len(self._list), self._capacity)
+        return "{0}, {1}/{2}".format(
+            list(self._dict.values()), len(self._dict), self._capacity
+        )
 
     def __len__(self):
-        return len(self._list)
+        return len(self._dict)
 
     def capacity(self):
         return self._capacity
 
+    # Indexing has to walk the items, unlike everything else
     def __getitem__(self, ii):
-        return self._list[ii]
+        return list(self._dict.values())[ii]
 
     def __contains__(self, val):
-        return val in self._list
+        return self._key(val) in self._dict
 
     def __iter__(self):
-        return self._list.__iter__()
+        return iter(self._dict.values())
 
     def add(self, val):
-        if val in self._list:
-            self._list.remove(val)
-
-        self._list.append(val)
-        if len(self._list) >= self._capacity:
-            x = self._list[0]
-            del self._list[0]
-            return x
+        key = self._key(val)
+        if key in self._dict:
+            self._dict.move_to_end(key)
+        self._dict[key] = val
+        if len(self._dict) >= self._capacity:
+            return self._dict.popitem(last=False)[1]
         else:
             return None
 
+    # Returns the item with the given key, moving it to the back
+    def get(self, key, default=None):
+        val = self._dict.get(key)
+        if val is None:
+            return default
+        self._dict.move_to_end(key)
+        return val
+
     def search(self, cond, *args, **kwargs):
-        val = next((v for v in self._list if cond(v)), *args, **kwargs)
+        val = next((v for v in self._dict.values() if cond(v)), *args, **kwargs)
         if val is not None:
-            self._list.remove(val)
-            self._list.append(val)
+            self._dict.move_to_end(self._key(val))
         return val
 
     def remove(self, val):
-        self._list.remove(val)
+        del self._dict[self._key(val)]
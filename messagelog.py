@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import time
+
+from metrics import REGISTRY
+
+LOGGED = REGISTRY.counter(
+    "velasco_message_log_entries_total",
+    "Messages appended to the message log.",
+)
+FLUSH_TIME = REGISTRY.histogram(
+    "velasco_message_log_flush_seconds",
+    "Time taken to write and sync a batch of the message log.",
+)
+
+
+# A write-ahead log of the messages read from each chat since it was last
+# saved, so that they can be read again if the bot stops without saving them.
+# - Messages are kept in a buffer, and written and synced to disk in batches:
+#   flush(...) is called once batch messages are waiting, or interval seconds
+#   after the first one
+# - Each chat's log is split in numbered segments. Storing a chat seals its
+#   current segment, and new messages go to the next one; once the store has
+#   been written, the sealed segments are removed
+# - Segments left by a previous run are replayed when the chat is loaded
+class MessageLog(object):
+    # Default folder of the segment files, inside the chat logs directory
+    DIRECTORY = "message_log"
+    # File extension for the segment files
+    EXT = ".vlw"
+
+    def __init__(self, directory, logger, batch=32, interval=1.0):
+        # Folder where the segment files are written
+        self.directory = directory
+        # The logger shared program-wide
+        self.logger = logger
+        # Number of messages waiting from which they are flushed
+        self.batch = batch
+        # Maximum time (in s) a message waits to be flushed
+        self.interval = interval
+        # Held while touching the buffer or the files, as they are flushed and
+        # removed from other threads
+        self.lock = threading.Lock()
+        # The lines waiting to be written, by (chat ID, segment number)
+        self.buffer = {}
+        self.pending = 0
+        # Chat ID -> the number of the segment new messages go to
+        self.current = {}
+        # Chat ID -> the numbers of its segment files
+        self.files = {}
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if not name.endswith(MessageLog.EXT):
+                continue
+            tag, _, number = name[: -len(MessageLog.EXT)].rpartition("_")
+            try:
+                self.files.setdefault(tag, set()).add(int(number))
+            except ValueError:
+                continue
+
+    # Formats and returns a segment file path
+    def segment_file(self, tag, number):
+        return os.path.join(
+            self.directory, "{}_{}{}".format(tag, number, MessageLog.EXT)
+        )
+
+    # The number of a chat's current segment. Segments left by a previous run
+    # are never appended to
+    def number(self, tag):
+        number = self.current.get(tag)
+        if number is None:
+            number = self.current[tag] = max(self.files.get(tag, ()), default=0) + 1
+        return number
+
+    # Lists the chats with segment files
+    def tags(self):
+        with self.lock:
+            return [tag for tag, numbers in self.files.items() if numbers]
+
+    # Adds a message read from a chat, with the text it's learned as (or None
+    # if it isn't). Returns True if a batch is waiting to be flushed
+    def append(self, tag, mid, text):
+        line = json.dumps([str(mid), text], ensure_ascii=False) + "\n"
+        with self.lock:
+            self.buffer.setdefault((tag, self.number(tag)), []).append(line)
+            self.pending += 1
+            LOGGED.inc()
+            return self.pending >= self.batch
+
+    # Writes and syncs every message waiting. Returns the number written
+    def flush(self):
+        with self.lock:
+            if self.pending == 0:
+                return 0
+            start = time.perf_counter()
+            written = self.pending
+            for (tag, number), lines in self.buffer.items():
+                with open(self.segment_file(tag, number), "a", encoding="utf-8") as f:
+                    f.writelines(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.files.setdefault(tag, set()).add(number)
+            self.buffer = {}
+            self.pending = 0
+        FLUSH_TIME.observe(time.perf_counter() - start)
+        return written
+
+    # Ends the current segment of a chat, returning its number. The messages
+    # it holds are saved along with the chat
+    def seal(self, tag):
+        with self.lock:
+            number = self.number(tag)
+            self.current[tag] = number + 1
+            return number
+
+    # Removes the segments of a chat up to the given number, once the store
+    # that holds their messages has been written
+    def remove(self, tag, number):
+        with self.lock:
+            for key in [key for key in self.buffer if key[0] == tag]:
+                if key[1] <= number:
+                    self.pending -= len(self.buffer.pop(key))
+            numbers = self.files.get(tag, set())
+            for n in [n for n in numbers if n <= number]:
+                try:
+                    os.remove(self.segment_file(tag, n))
+                except FileNotFoundError:
+                    pass
+                numbers.discard(n)
+
+    # Returns the (message ID, text) pairs of the segment files of a chat, in
+    # the order they were read
+    def replay(self, tag):
+        entries = []
+        with self.lock:
+            numbers = sorted(self.files.get(tag, ()))
+            for number in numbers:
+                filepath = self.segment_file(tag, number)
+                with open(filepath, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            mid, text = json.loads(line)
+                        except ValueError:
+                            # The bot stopped while writing this line
+                            self.logger.warning(
+                                "Message log {} is cut short.".format(filepath)
+                            )
+                            break
+                        entries.append((mid, text))
+        return entries
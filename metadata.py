@@ -12,6 +12,20 @@ def parse_card_line(line):
         return s[1]
 
 
+# This reads the numbers of a VOCAB_STATS line, or None if there are none
+def parse_stats(value):
+    if len(value.strip()) == 0:
+        return None
+    return [int(n) for n in value.split(",")]
+
+
+# This reads a number from a card line, or None if it's empty
+def parse_number(value):
+    if len(value.strip()) == 0:
+        return None
+    return int(value)
+
+
 # This is a chat's Metadata, holding different configuration values for
 # Velasco and other miscellaneous information about the chat
 class Metadata(object):
@@ -25,6 +39,9 @@ class Metadata(object):
         answer=0.5,
         restricted=False,
         silenced=False,
+        order=2,
+        stats=None,
+        vocab_limit=None,
     ):
         # The Telegram chat's ID
         self.id = str(cid)
@@ -49,6 +66,15 @@ class Metadata(object):
         self.restricted = restricted
         # Wether messages should silence user mentions
         self.silenced = silenced
+        # The chain order: how many of the previous words each word of a
+        # message is chosen after (2 unless set in the card)
+        self.order = order
+        # The numbers of the vocabulary's VocabStats when it was last saved
+        # (messages, tokens, keys, transitions, bytes), or None if unknown
+        self.stats = stats
+        # The size budget (in bytes) of the vocabulary, over which it's
+        # pruned, or None to use the bot's. With 0 it's never pruned
+        self.vocab_limit = vocab_limit
 
     # Sets the period for a chat
     # It has to be higher than 1
@@ -84,6 +110,11 @@ class Metadata(object):
         lines.append("ANSWER_PROB=" + str(self.answer))
         lines.append("RESTRICTED=" + str(self.restricted))
         lines.append("SILENCED=" + str(self.silenced))
+        lines.append("CHAIN_ORDER=" + str(self.order))
+        stats = "" if self.stats is None else ",".join(str(n) for n in self.stats)
+        lines.append("VOCAB_STATS=" + stats)
+        limit = "" if self.vocab_limit is None else str(self.vocab_limit)
+        lines.append("VOCAB_LIMIT=" + limit)
         # lines.append("WORD_DICT=")
         return ("\n".join(lines)) + "\n"
 
@@ -114,6 +145,16 @@ class Metadata(object):
                 answer=float(parse_card_line(lines[6])),
                 restricted=(parse_card_line(lines[7]) == "True"),
                 silenced=(parse_card_line(lines[8]) == "True"),
+                # Older v5 cards had no chain order, vocabulary stats or limit
+                order=int(parse_card_line(lines[9]) or 2) if len(lines) > 9 else 2,
+                stats=(
+                    parse_stats(parse_card_line(lines[10])) if len(lines) > 10 else None
+                ),
+                vocab_limit=(
+                    parse_number(parse_card_line(lines[11]))
+                    if len(lines) > 11
+                    else None
+                ),
             )
         elif version == "v3":
             # Deprecated: this elif block will be removed in a new version
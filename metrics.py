@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Formats a metric's labels, as in {name="value"}
+def label_text(names, values):
+    if not names:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for name, value in zip(names, values)
+        )
+        + "}"
+    )
+
+
+# Formats a sample's value
+def number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+# A metric, with a value for each combination of its labels. Updating it only
+# takes a lock and a dictionary lookup, as it's done from the handlers
+class Metric(object):
+    TYPE = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    # The lines of the metric in the Prometheus text format
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.TYPE),
+        ]
+        with self.lock:
+            values = self.snapshot()
+        for labels, value in sorted(values.items()):
+            lines.extend(self.samples(labels, value))
+        return lines
+
+    # A copy of the values, taken while holding the lock
+    def snapshot(self):
+        return dict(self.values)
+
+    def samples(self, labels, value):
+        return [
+            "{}{} {}".format(self.name, label_text(self.labels, labels), number(value))
+        ]
+
+
+# A value that only goes up
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+# A value that goes up and down
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+# Counts the values observed in buckets of upper bounds, along with their sum
+class Histogram(Metric):
+    TYPE = "histogram"
+    # Default buckets, for durations in seconds
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # The count of each bucket, then the total count and sum
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    # Measures the time taken by a with block
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def snapshot(self):
+        return {labels: list(counts) for labels, counts in self.values.items()}
+
+    def samples(self, labels, counts):
+        names = self.labels + ("le",)
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            total += count
+            lines.append(
+                "{}_bucket{} {}".format(
+                    self.name, label_text(names, labels + (number(bound),)), total
+                )
+            )
+        text = label_text(self.labels, labels)
+        lines.append("{}_count{} {}".format(self.name, text, counts[-2]))
+        lines.append("{}_sum{} {}".format(self.name, text, number(counts[-1])))
+        return lines
+
+
+class Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+# The metrics of the bot. Collectors are functions run before the metrics are
+# rendered, to set the gauges that are taken from the bot's state (such as
+# the chats in memory) instead of being updated as things happen
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=Histogram.BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def collect(self):
+        for collector in self.collectors:
+            collector()
+
+    # Returns every metric in the Prometheus text format
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# The registry every module adds its metrics to
+REGISTRY = Registry()
+
+
+# Serves the metrics in the Prometheus text format over HTTP from a
+# background thread. As collectors read the bot's state, they are run in the
+# bot's event loop (if one is given) while the server thread waits
+class MetricsServer(object):
+    def __init__(self, logger, port, host="127.0.0.1", registry=REGISTRY, loop=None):
+        self.logger = logger
+        self.registry = registry
+        self.loop = loop
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                try:
+                    body = server.scrape().encode("utf-8")
+                except Exception as e:
+                    server.logger.error("Failed collecting metrics: {}".format(e))
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, name="metrics", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        host, port = self.httpd.server_address[:2]
+        self.logger.info("Serving metrics on http://{}:{}/metrics".format(host, port))
+
+    # Collects and renders the metrics (this runs in the server's threads)
+    def scrape(self):
+        if self.loop is not None and self.loop.is_running():
+
+            async def collect():
+                self.registry.collect()
+
+            asyncio.run_coroutine_threadsafe(collect(), self.loop).result(timeout=5)
+        else:
+            self.registry.collect()
+        return self.registry.render()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import REGISTRY
+
+STORE_TIME = REGISTRY.histogram(
+    "velasco_store_seconds", "Time taken to write a chat's files."
+)
+STORE_BYTES = REGISTRY.counter(
+    "velasco_store_bytes_total", "Bytes written to the chat files."
+)
+
+
+# Writes the Archivist's StoreJobs in a thread pool, so that storing a big chat
+# doesn't stop the event loop from handling every other chat's updates.
+# - Jobs for a chat that is already waiting to be written are merged into the
+#   waiting one, and jobs for the same chat are never written at once
+# - At most max_pending chats can be waiting or being written; submit(...)
+#   waits for room if there isn't any
+class Persister(object):
+    def __init__(self, archivist, logger, workers=2, max_pending=64):
+        # The Archivist that writes the files
+        self.archivist = archivist
+        # The logger shared program-wide
+        self.logger = logger
+        # Maximum number of chats waiting or being written
+        self.max_pending = max_pending
+        # The thread pool where files are written
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="persister"
+        )
+        # Jobs waiting to be written, by chat ID
+        self.pending = {}
+        # Chat IDs being written right now
+        self.running = set()
+        # Notified whenever a job is done
+        self.done = None
+        # Metrics
+        self.writes = 0
+        self.failures = 0
+        self.merged = 0
+        self.max_depth = 0
+        self.write_time = 0.0
+        self.max_write_time = 0.0
+
+    # Number of chats waiting or being written
+    def depth(self):
+        return len(self.pending) + len(self.running)
+
+    # Average time (in s) taken to write a job
+    def mean_write_time(self):
+        return self.write_time / self.writes if self.writes > 0 else 0.0
+
+    # The Condition notified when jobs are done, created from within the loop
+    def condition(self):
+        if self.done is None:
+            self.done = asyncio.Condition()
+        return self.done
+
+    # Queues a StoreJob to be written
+    async def submit(self, job):
+        if job.tag in self.pending:
+            self.pending[job.tag].merge(job)
+            self.merged += 1
+            return
+        done = self.condition()
+        async with done:
+            await done.wait_for(lambda: self.depth() < self.max_pending)
+        if job.tag in self.pending:
+            # Another job for the chat got in while waiting
+            self.pending[job.tag].merge(job)
+            self.merged += 1
+            return
+        self.pending[job.tag] = job
+        self.max_depth = max(self.max_depth, self.depth())
+        self.dispatch()
+
+    # Starts writing every waiting job whose chat isn't being written already
+    def dispatch(self):
+        loop = asyncio.get_running_loop()
+        for tag in [tag for tag in self.pending if tag not in self.running]:
+            job = self.pending.pop(tag)
+            self.running.add(tag)
+            future = loop.run_in_executor(self.executor, self.write, job)
+            future.add_done_callback(lambda f, job=job: self.finished(job, f))
+
+    # Writes a job, returning the time it took (this runs in the thread pool)
+    def write(self, job):
+        start = time.perf_counter()
+        written = self.archivist.write(job)
+        elapsed = time.perf_counter() - start
+        STORE_TIME.observe(elapsed)
+        STORE_BYTES.inc(written or 0)
+        return elapsed
+
+    # Collects a written job and starts the next ones. A Generator spilled by
+    # the job is refreshed here, in the event loop where it's used
+    def finished(self, job, future):
+        tag = job.tag
+        self.running.discard(tag)
+        written = future.exception() is None
+        if not written:
+            self.failures += 1
+            self.logger.error("Failed storing chat {}:".format(tag))
+            self.logger.exception(future.exception())
+        else:
+            elapsed = future.result()
+            self.writes += 1
+            self.write_time += elapsed
+            self.max_write_time = max(self.max_write_time, elapsed)
+        try:
+            self.archivist.end_spill(job, written)
+        except Exception as e:
+            self.logger.error("Failed reopening the record of chat {}:".format(tag))
+            self.logger.exception(e)
+        self.dispatch()
+        asyncio.ensure_future(self.notify())
+
+    # Wakes up anything waiting for jobs to be done
+    async def notify(self):
+        done = self.condition()
+        async with done:
+            done.notify_all()
+
+    # Waits until a chat has no job waiting or being written, so that its
+    # files can be read back
+    async def wait(self, tag):
+        if tag not in self.pending and tag not in self.running:
+            return
+        done = self.condition()
+        async with done:
+            await done.wait_for(
+                lambda: tag not in self.pending and tag not in self.running
+            )
+
+    # Waits until every queued job has been written
+    async def flush(self):
+        done = self.condition()
+        async with done:
+            await done.wait_for(lambda: self.depth() == 0)
+
+    # Writes every queued job and stops the thread pool
+    async def close(self):
+        await self.flush()
+        self.executor.shutdown(wait=True)
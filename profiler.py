@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import cProfile
+import functools
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+
+# Formats a frame for a collapsed stack, as "function (file:line)"
+def frame_name(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(
+        code.co_name, os.path.basename(code.co_filename), code.co_firstlineno
+    ).replace(";", ":")
+
+
+# Profiles the bot for a window of time, switched on and off while it runs.
+# During a window:
+# - The thread that started it (the bot's event loop) is profiled with
+#   cProfile. Only one cProfile can run at once since Python 3.12, so other
+#   threads (such as the Persister's writes) are only seen by the sampler
+# - A thread samples the stacks of every other thread every few ms, for the
+#   collapsed stacks that flame graph tools read
+# - The calls to the hooked functions are timed, from any thread
+# Outside of a window, a hooked function only costs a check of a flag
+class Profiler(object):
+    # Default time (in s) between samples of the stacks
+    INTERVAL = 0.005
+
+    def __init__(self, directory="profiles", interval=INTERVAL):
+        # Folder where the results are written
+        self.directory = directory
+        self.interval = interval
+        self.running = False
+        self.lock = threading.Lock()
+        self.profile = None
+        self.sampler = None
+        self.start_time = 0.0
+        # Collapsed stack -> number of samples
+        self.stacks = Counter()
+        # Hook name -> [calls, total time]
+        self.calls = {}
+
+    # Starts a window, unless one is running. Returns False if there was one
+    def start(self):
+        with self.lock:
+            if self.running:
+                return False
+            self.stacks = Counter()
+            self.calls = {}
+            self.start_time = time.perf_counter()
+            self.profile = cProfile.Profile()
+            self.running = True
+        self.sampler = threading.Thread(
+            target=self.sample, name="profiler", daemon=True
+        )
+        self.sampler.start()
+        self.profile.enable()
+        return True
+
+    # Ends the window, and writes its results. Returns a summary and the
+    # paths of the pstats and collapsed stack files, or None if no window was
+    # running. It has to be called from the thread that started it
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                return None
+            self.running = False
+        self.profile.disable()
+        self.sampler.join()
+        elapsed = time.perf_counter() - self.start_time
+
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(
+            self.directory, "profile_{}".format(time.strftime("%Y%m%d_%H%M%S"))
+        )
+        # The profile is left out if nothing was profiled, as pstats can't
+        # take an empty one
+        self.profile.create_stats()
+        stats = pstats.Stats()
+        if self.profile.stats:
+            stats.add(self.profile)
+        stats.dump_stats(base + ".pstats")
+        with open(base + ".collapsed", "w", encoding="utf-8") as file:
+            for stack, count in self.stacks.most_common():
+                file.write("{} {}\n".format(stack, count))
+        self.profile = None
+        return self.summary(elapsed, stats), [base + ".pstats", base + ".collapsed"]
+
+    # The time spent in each hooked function, and the functions that took the
+    # most time by themselves
+    def summary(self, elapsed, stats, top=10):
+        lines = [
+            "Profiled {:.1f} s, {} stack samples.".format(
+                elapsed, sum(self.stacks.values())
+            )
+        ]
+        for name, (calls, total) in sorted(self.calls.items()):
+            lines.append(
+                "{}: {} calls, {:.3f} s ({:.3f} ms each)".format(
+                    name, calls, total, 1000 * total / calls
+                )
+            )
+        busiest = sorted(stats.stats.items(), key=lambda item: -item[1][2])[:top]
+        if busiest:
+            lines.append("Busiest functions:")
+        for (filename, line, function), (_, calls, own, total, _) in busiest:
+            lines.append(
+                "{} ({}:{}): {:.3f} s in {} calls ({:.3f} s with callees)".format(
+                    function, os.path.basename(filename), line, own, calls, total
+                )
+            )
+        return "\n".join(lines)
+
+    # Samples the stacks of the other threads until the window ends
+    def sample(self):
+        me = threading.get_ident()
+        while self.running:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    # Adds the time of a call to a hooked function
+    def record(self, name, elapsed):
+        with self.lock:
+            calls = self.calls.setdefault(name, [0, 0.0])
+            calls[0] += 1
+            calls[1] += elapsed
+
+    # Decorator for the functions to time during a window, under the given
+    # name
+    def hook(self, name):
+        def wrap(func):
+            if asyncio.iscoroutinefunction(func):
+
+                @functools.wraps(func)
+                async def hooked(*args, **kwargs):
+                    if not self.running:
+                        return await func(*args, **kwargs)
+                    start = time.perf_counter()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self.record(name, time.perf_counter() - start)
+
+                return hooked
+
+            @functools.wraps(func)
+            def hooked(*args, **kwargs):
+                if not self.running:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name, time.perf_counter() - start)
+
+            return hooked
+
+        return wrap
+
+
+# The profiler every module hooks its functions to
+PROFILER = Profiler()
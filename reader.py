@@ -2,9 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import random
+from collections import deque
 
-from generator import Generator
+from generator import Generator, VocabStats
+from history import chat_id, chat_type
 from metadata import Metadata, parse_card_line
+from metrics import REGISTRY
+from profiler import PROFILER
+
+PRUNES = REGISTRY.counter(
+    "velasco_vocab_prunes_total", "Vocabularies pruned for going over their budget."
+)
+PRUNED_BYTES = REGISTRY.counter(
+    "velasco_vocab_pruned_bytes_total",
+    "Bytes (as estimated by the vocabulary stats) reclaimed by pruning.",
+)
 
 
 # This gives me the chat title, or the first and maybe last
@@ -21,6 +33,11 @@ def get_chat_title(chat):
         return ""
 
 
+# Formats a number of bytes
+def mib(n):
+    return "{:.2f} MiB".format(n / 2**20)
+
+
 class Memory(object):
     def __init__(self, mid, content):
         self.id = mid
@@ -35,32 +52,96 @@ class Reader(object):
     STICKER_TAG = "^IS_STICKER^"
     ANIM_TAG = "^IS_ANIMATION^"
     VIDEO_TAG = "^IS_VIDEO^"
+    # Number of messages read from a history before committing them
+    HISTORY_BATCH = 2000
+    # Number of recent message IDs kept to reply to
+    RECENT_IDS = 64
 
     def __init__(self, metadata, vocab, min_period, max_period, logger, names=[]):
         # The Metadata object holding a chat's specific bot parameters
         self.meta = metadata
-        # The Generator object holding the vocabulary learned so far
-        self.vocab = vocab
+        # The Generator object holding the vocabulary learned so far, or a
+        # function that loads it, which is called the first time it's used
+        if callable(vocab):
+            self._vocab = None
+            self.vocab_loader = vocab
+        else:
+            self._vocab = vocab
+            self.vocab_loader = None
+            self.apply_order()
+        # The minimum period allowed for this bot
+        self.min_period = min_period
         # The maximum period allowed for this bot
         self.max_period = max_period
         # The short term memory, for recently read messages (see below)
         self.short_term_mem = []
+        # The IDs of the last messages learned, to reply to. They're kept
+        # after the short term memory is committed
+        self.recent_ids = deque(maxlen=Reader.RECENT_IDS)
+        # Maximum number of messages in the short term memory, or None for no
+        # limit, and the number committed at once when it goes over it
+        self.memory_limit = None
+        self.memory_batch = 1
         # The countdown until the period ends and it's time to talk
         self.countdown = self.meta.period
         # The logger object shared program-wide
         self.logger = logger
         # The bot's nicknames + username
         self.names = names
+        # Whether the Metadata and the vocabulary changed since they were last
+        # archived, so that saving an idle chat can be skipped
+        self.meta_dirty = False
+        self.vocab_dirty = False
+
+    # The Generator, loaded now if it wasn't already
+    @property
+    def vocab(self):
+        if self._vocab is None and self.vocab_loader is not None:
+            self._vocab = self.vocab_loader()
+            self.vocab_loader = None
+            self.apply_order()
+        return self._vocab
+
+    @vocab.setter
+    def vocab(self, vocab):
+        self._vocab = vocab
+        self.vocab_loader = None
+        self.apply_order()
+        self.vocab_dirty = True
+
+    # Sets the chain order of the Metadata in the Generator
+    def apply_order(self):
+        if self._vocab is not None:
+            self._vocab.set_order(self.meta.order)
+
+    # Tells whether the Generator has been loaded (or wasn't loaded lazily)
+    def has_vocab(self):
+        return self.vocab_loader is None
 
     # Create a new Reader from a Chat object
     def FromChat(chat, min_period, max_period, logger):
         meta = Metadata(chat.id, chat.type, get_chat_title(chat))
         vocab = Generator()
-        return Reader(meta, vocab, min_period, max_period, logger)
-
-    # TODO: Create a new Reader from a whole Chat history
-    def FromHistory(history, vocab, min_period, max_period, logger):
-        return None
+        reader = Reader(meta, vocab, min_period, max_period, logger)
+        # It has never been saved
+        reader.meta_dirty = True
+        reader.vocab_dirty = True
+        return reader
+
+    # Create a new Reader from a whole Chat history (a HistoryStream), with
+    # the chat ID given or else the one found in the export
+    def FromHistory(
+        history, vocab, min_period, max_period, logger, cid=None, names=None
+    ):
+        header = history.header
+        if cid is None:
+            cid = chat_id(header)
+        meta = Metadata(cid, chat_type(header), header.get("name") or "")
+        if vocab is None:
+            vocab = Generator()
+        reader = Reader(meta, vocab, min_period, max_period, logger, names or [])
+        reader.read_history(history)
+        return reader
 
     # Create a new Reader from a meta's file dump
     def FromCard(card, vocab, min_period, max_period, logger):
@@ -103,10 +184,37 @@ class Reader(object):
         return r
 
     # Returns a nice lice little tuple package for the archivist to save to file.
-    # Also commits to long term memory any pending short term memories
+    # Also commits to long term memory any pending short term memories. The
+    # vocabulary is left out unless it changed since it was last archived, and
+    # both are marked as saved
     def archive(self):
         self.commit_memory()
-        return (self.meta.id, self.meta.dumps(), self.vocab.dumps())
+        vocab = None
+        if self.vocab_changed():
+            self.meta.stats = list(self.vocab.stats())
+            vocab = self.vocab
+        self.meta_dirty = False
+        self.vocab_dirty = False
+        return (self.meta.id, self.meta.dumps(), vocab)
+
+    # Tells whether the vocabulary changed since it was last archived. One
+    # that has to be saved whole counts as changed too
+    def vocab_changed(self):
+        return (
+            self.vocab_dirty
+            or len(self.short_term_mem) > 0
+            or (self._vocab is not None and self._vocab.journal is None)
+        )
+
+    # Tells whether the vocabulary keeps more changed keys in memory than it
+    # should, so that it has to be saved whole
+    def over_capacity(self):
+        return self._vocab is not None and self._vocab.over_capacity()
+
+    # Tells whether anything changed since the Reader was last archived, so
+    # that it has to be saved
+    def is_dirty(self):
+        return self.meta_dirty or self.vocab_changed()
 
     # Checks type. Returns "True" for "group" even if it's supergroupA
     def check_type(self, t):
@@ -117,13 +225,16 @@ class Reader(object):
         return t == self.meta.type
 
     def set_title(self, title):
-        self.meta.title = title
+        if title != self.meta.title:
+            self.meta.title = title
+            self.meta_dirty = True
 
     # Sets a new period in the Metadata
     def set_period(self, period):
         # The period has to be in the range [min..max_period]; otherwise, clamp to said range
         new_period = max(self.min_period, min(period, self.max_period))
         set_period = self.meta.set_period(new_period)
+        self.meta_dirty = True
         if new_period == set_period and new_period < self.countdown:
             # If succesfully changed and the new period is less than the current
             # remaining countdown, reduce the countdown to the new period
@@ -131,7 +242,9 @@ class Reader(object):
         return new_period
 
     def set_answer(self, prob):
-        return self.meta.set_answer(prob)
+        answer = self.meta.set_answer(prob)
+        self.meta_dirty = True
+        return answer
 
     def cid(self):
         return str(self.meta.id)
@@ -139,6 +252,52 @@ class Reader(object):
     def count(self):
         return self.meta.count
 
+    # Returns the VocabStats of the vocabulary without loading it: its own if
+    # it's loaded, or the ones saved in the card (None if there are none)
+    def stats(self):
+        if self.has_vocab():
+            return self._vocab.stats()
+        if self.meta.stats is None:
+            return None
+        return VocabStats(*self.meta.stats)
+
+    # Returns the size budget (in bytes) of the vocabulary: the one set in
+    # the card, or else the given default. None or 0 mean there's none
+    def vocab_limit(self, default=None):
+        if self.meta.vocab_limit is not None:
+            return self.meta.vocab_limit
+        return default
+
+    # Prunes the vocabulary if it's over its size budget (see vocab_limit),
+    # logging how much was reclaimed. A vocabulary that was never loaded is
+    # only loaded for it if its saved stats are over the budget. Returns the
+    # VocabStats before and after, or None if it wasn't pruned
+    def prune(self, default=None):
+        limit = self.vocab_limit(default)
+        stats = self.stats()
+        if not limit or stats is None or stats.bytes <= limit:
+            return None
+        self.commit_memory()
+        before, after = self.vocab.prune(limit)
+        self.vocab_dirty = True
+        PRUNES.inc()
+        PRUNED_BYTES.inc(before.bytes - after.bytes)
+        self.logger.info(
+            "Pruned the vocabulary of chat {} ({}) over its budget of {}: from {}"
+            " to {}, {} of {} transitions and {} of {} keys left.".format(
+                self.cid(),
+                self.title(),
+                mib(limit),
+                mib(before.bytes),
+                mib(after.bytes),
+                after.transitions,
+                before.transitions,
+                after.keys,
+                before.keys,
+            )
+        )
+        return before, after
+
     def period(self):
         return self.meta.period
 
@@ -156,12 +315,14 @@ class Reader(object):
 
     def toggle_restrict(self):
         self.meta.restricted = not self.meta.restricted
+        self.meta_dirty = True
 
     def is_silenced(self):
         return self.meta.silenced
 
     def toggle_silence(self):
         self.meta.silenced = not self.meta.silenced
+        self.meta_dirty = True
 
     # Rolls the chance for answering in this specific chat,
     # according to the answer probability
@@ -178,14 +339,25 @@ class Reader(object):
     def add_memory(self, mid, content):
         mem = Memory(mid, content)
         self.short_term_mem.append(mem)
-
-    # Returns a random message ID from the short memory,
+        self.recent_ids.append(mid)
+        if (
+            self.memory_limit is not None
+            and len(self.short_term_mem) > self.memory_limit
+        ):
+            self.commit_some(self.memory_batch)
+
+    # Caps the short term memory at limit messages, committing the oldest
+    # batch of them whenever it goes over it
+    def limit_memory(self, limit, batch):
+        self.memory_limit = limit
+        self.memory_batch = max(1, batch)
+
+    # Returns a random message ID from the last ones learned,
     # when answering to a random comment
     def random_memory(self):
-        if len(self.short_term_mem) == 0:
+        if len(self.recent_ids) == 0:
             return None
-        mem = random.choice(self.short_term_mem)
-        return mem.id
+        return random.choice(self.recent_ids)
 
     def reset_countdown(self):
         self.countdown = self.meta.period
@@ -193,25 +365,65 @@ class Reader(object):
     # Reads a message
     # This process will determine which kind of message it is (Sticker, Anim,
     # Video, or actual text) and pre-process it accordingly for the Generator,
-    # then store it in the short term memory
+    # then store it in the short term memory. Returns the text it's learned as
     def read(self, message):
         mid = str(message.message_id)
-
+        text = Reader.message_text(message)
+        if text is not None:
+            self.learn(mid, text)
+        self.meta.count += 1
+        self.meta_dirty = True
+        return text
+
+    # Reads again messages that were read but not saved, as (message ID, text)
+    # pairs like the ones read(...) takes from each message
+    def replay(self, entries):
+        for mid, text in entries:
+            if text is not None:
+                self.learn(mid, text)
+            self.meta.count += 1
+        self.meta_dirty = True
+
+    # Returns the text a message is learned as: its text, or for multimedia
+    # messages TAG + the media file ID. None if it's not learned at all
+    def message_text(message):
         if message.text is not None:
-            self.learn(mid, message.text)
+            return message.text
         elif message.sticker is not None:
-            self.learn_drawing(mid, Reader.STICKER_TAG, message.sticker.file_id)
+            return Reader.STICKER_TAG + " " + message.sticker.file_id
         elif message.animation is not None:
-            self.learn_drawing(mid, Reader.ANIM_TAG, message.animation.file_id)
+            return Reader.ANIM_TAG + " " + message.animation.file_id
         elif message.video is not None:
-            self.learn_drawing(mid, Reader.VIDEO_TAG, message.video.file_id)
+            return Reader.VIDEO_TAG + " " + message.video.file_id
+        return None
 
-        self.meta.count += 1
+    # Reads every message of a chat history (a HistoryStream), committing
+    # them to the vocabulary in batches so that only a batch of messages is
+    # held in memory at once, and logging the progress after each batch
+    def read_history(self, history, batch=HISTORY_BATCH):
+        vocab = self.vocab
+        # The words learned aren't kept for the journal: after an import, the
+        # whole vocabulary has to be saved
+        vocab.journal = None
+        read = 0
+        for message in history.messages():
+            self.read(message)
+            read += 1
+            if read % batch == 0:
+                self.commit_memory()
+                self.log_history(history, read)
+        self.commit_memory()
+        self.log_history(history, read)
+        return read
 
-    # Stores a multimedia message in the short term memory as a text with
-    # TAG + the media file ID
-    def learn_drawing(self, mid, tag, drawing):
-        self.learn(mid, tag + " " + drawing)
+    def log_history(self, history, read):
+        progress = history.progress()
+        if progress is None:
+            self.logger.info("Read {} messages from history.".format(read))
+        else:
+            self.logger.info(
+                "Read {} messages from history ({:.1f}%).".format(read, progress * 100)
+            )
 
     # Stores a text message in the short term memory
     def learn(self, mid, text):
@@ -224,10 +436,24 @@ class Reader(object):
 
     # Commits the short term memory messages into the "long term memory"
     # aka the vocabulary Generator's cache
+    @PROFILER.hook("reader.commit_memory")
     def commit_memory(self):
-        for mem in self.short_term_mem:
-            self.vocab.add(mem.content)
+        if len(self.short_term_mem) > 0:
+            self.vocab.add_many(mem.content for mem in self.short_term_mem)
+            self.vocab_dirty = True
         self.short_term_mem = []
 
+    # Commits the oldest messages of the short term memory, at most batch of
+    # them, so that a long memory can be committed a bit at a time. Returns
+    # the number of messages left
+    @PROFILER.hook("reader.commit_some")
+    def commit_some(self, batch):
+        oldest = self.short_term_mem[:batch]
+        if len(oldest) > 0:
+            del self.short_term_mem[:batch]
+            self.vocab.add_many(mem.content for mem in oldest)
+            self.vocab_dirty = True
+        return len(self.short_term_mem)
+
     def generate_message(self, max_len):
         return self.vocab.generate(size=max_len, silence=self.is_silenced())
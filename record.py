@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import heapq
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left
+
+numpyError = None
+try:
+    import numpy
+except ImportError as e:
+    numpyError = e
+
+# Binary vocabulary record file, meant to be opened with mmap and read lazily.
+# All numbers are little-endian. The file is laid out as:
+#   header      magic, version, the size of each section and the number of
+#               the last journal file folded into it (see HEADER)
+#   keys        uint64[keys], the sorted packed keys of the chain
+#   starts      uint64[keys + 1], where each key's successors start
+#   offsets     uint64[tokens + 1], where each token starts in the strings
+#   folds       uint32[tokens], the ID of each token's casefolded form
+#   words       uint32[successors], the word IDs following every key
+#   counts      uint32[successors], how many times each one was seen
+#   heads       uint32[heads] words and uint32[heads] counts for HEAD
+#   strings     the UTF-8 encoded tokens, one after the other
+#   trie        the JSON dump of the ChainTrie for chains of a higher order,
+#               if there is one
+# Every section starts at a multiple of 8 bytes.
+
+MAGIC = b"VLSR"
+VERSION = 3
+# magic, version, reserved, tokens, keys, successors, heads, strings size,
+# journal number, trie size
+HEADER = struct.Struct("<4sHHQQQQQQQ")
+# Version 2 files had no trie
+HEADER_V2 = struct.Struct("<4sHHQQQQQQ")
+# Version 1 files had no journal number either
+HEADER_V1 = struct.Struct("<4sHHQQQQQ")
+# File extension for the record files
+EXTENSION = ".vlr"
+
+
+# Rounds a size up to a multiple of 8
+def align(size):
+    return (size + 7) & ~7
+
+
+# Writes the given array to a file as little-endian, padded to 8 bytes
+def write_array(f, values):
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    data = values.tobytes()
+    f.write(data)
+    f.write(bytes(align(len(data)) - len(data)))
+
+
+# Writes a Generator into a binary record file, marking it as having folded
+# every journal file up to the given number
+def dump(gen, f, journal=0):
+    # Imported here to avoid a circular import, as the Generator reads records
+    from generator import successors
+
+    tokens = gen.tokens
+    keys = array("Q")
+    starts = array("Q", [0])
+    words = array("I")
+    counts = array("I")
+    for key, value in sorted(gen.items()):
+        keys.append(key)
+        for word, count in successors(value):
+            words.append(word)
+            counts.append(count)
+        starts.append(len(words))
+
+    strings = [w.encode("utf-8") for w in tokens.words]
+    offsets = array("Q", [0])
+    for s in strings:
+        offsets.append(offsets[-1] + len(s))
+    folds = array("I", tokens.folds)
+    head_words = array("I", gen.heads.words)
+    head_counts = array("I", gen.heads.counts)
+    trie = b""
+    if gen.trie is not None:
+        trie = json.dumps(gen.trie.to_dict(tokens.words), ensure_ascii=False)
+        trie = trie.encode("utf-8")
+
+    f.write(
+        HEADER.pack(
+            MAGIC,
+            VERSION,
+            0,
+            len(tokens),
+            len(keys),
+            len(words),
+            len(head_words),
+            offsets[-1],
+            journal,
+            len(trie),
+        )
+    )
+    f.write(bytes(align(HEADER.size) - HEADER.size))
+    for values in (keys, starts, offsets, folds, words, counts):
+        write_array(f, values)
+    write_array(f, head_words)
+    write_array(f, head_counts)
+    data = b"".join(strings)
+    f.write(data)
+    f.write(bytes(align(len(data)) - len(data)))
+    f.write(trie)
+
+
+# Reads the header of a record file, returning its values as a tuple
+def read_header(data):
+    magic, version = struct.unpack_from("<4sH", data, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a record file.")
+    if version > VERSION:
+        raise ValueError("Unknown record file version ({}).".format(version))
+    if version == 1:
+        return HEADER_V1.unpack_from(data, 0) + (0, 0), HEADER_V1.size
+    if version == 2:
+        return HEADER_V2.unpack_from(data, 0) + (0,), HEADER_V2.size
+    return HEADER.unpack_from(data, 0), HEADER.size
+
+
+# Returns the number of the last journal file folded into a record file
+def journal_of(filepath):
+    with open(filepath, "rb") as f:
+        return read_header(f.read(HEADER.size))[0][8]
+
+
+# A binary record file opened with mmap. Nothing but the header is read when
+# opening it: the sections are exposed as views over the mapped memory, and
+# each key's successors are only read when asked for
+class RecordFile(object):
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._file = open(filepath, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as e:
+            self._file.close()
+            raise ValueError("Record file {} is empty.".format(filepath)) from e
+        try:
+            header, size = read_header(self._map)
+        except ValueError as e:
+            self._map.close()
+            self._file.close()
+            raise ValueError("{}: {}".format(filepath, e)) from e
+        (
+            _,
+            self.version,
+            _,
+            self.n_tokens,
+            self.n_keys,
+            self.n_successors,
+            self.n_heads,
+            strings_size,
+            self.journal,
+            trie_size,
+        ) = header
+
+        self._offset = align(size)
+        self.keys = self._section("Q", self.n_keys)
+        self.starts = self._section("Q", self.n_keys + 1)
+        self.offsets = self._section("Q", self.n_tokens + 1)
+        self.folds = self._section("I", self.n_tokens)
+        self.words = self._section("I", self.n_successors)
+        self.counts = self._section("I", self.n_successors)
+        self.head_words = self._section("I", self.n_heads)
+        self.head_counts = self._section("I", self.n_heads)
+        self.strings = memoryview(self._map)[self._offset : self._offset + strings_size]
+        self._offset += align(strings_size)
+        self.trie_data = memoryview(self._map)[self._offset : self._offset + trie_size]
+
+    # Returns a view of the next section of the file
+    def _section(self, typecode, length):
+        size = length * array(typecode).itemsize
+        view = memoryview(self._map)[self._offset : self._offset + size]
+        self._offset += align(size)
+        if sys.byteorder != "little":
+            # Views can't swap bytes, so this section has to be read into memory
+            values = array(typecode, view.tobytes())
+            values.byteswap()
+            return values
+        return view.cast(typecode)
+
+    def __len__(self):
+        return self.n_keys
+
+    # Returns the list of tokens of the string table
+    def tokens(self):
+        strings = self.strings.tobytes()
+        offsets = self.offsets.tolist()
+        return [
+            strings[offsets[i] : offsets[i + 1]].decode("utf-8")
+            for i in range(self.n_tokens)
+        ]
+
+    # Returns the position of a key in the index, or None if it's not there
+    def find(self, key):
+        i = bisect_left(self.keys, key)
+        if i < self.n_keys and self.keys[i] == key:
+            return i
+        return None
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    # Returns the (word, count) pairs following the key at a given position
+    def pairs(self, i):
+        start, end = self.starts[i], self.starts[i + 1]
+        return zip(self.words[start:end].tolist(), self.counts[start:end].tolist())
+
+    # Iterates over all the keys, along with their (word, count) pairs
+    def items(self):
+        for i in range(self.n_keys):
+            yield self.keys[i], self.pairs(i)
+
+    # Returns the dump of the ChainTrie, or None if there is none
+    def trie(self):
+        if len(self.trie_data) == 0:
+            return None
+        return json.loads(self.trie_data.tobytes().decode("utf-8"))
+
+    # Returns the (word, count) pairs following HEAD
+    def heads(self):
+        return zip(self.head_words.tolist(), self.head_counts.tolist())
+
+    def close(self):
+        for name in (
+            "keys",
+            "starts",
+            "offsets",
+            "folds",
+            "words",
+            "counts",
+            "head_words",
+            "head_counts",
+            "strings",
+            "trie_data",
+        ):
+            view = getattr(self, name, None)
+            if isinstance(view, memoryview):
+                view.release()
+        self._map.close()
+        self._file.close()
+
+
+# Writes a Generator into a record file at the given path. The file is
+# written beside it and then renamed over it, so that any Generator still
+# reading the old file through mmap keeps seeing it whole
+def save(gen, filepath, journal=0):
+    temp = filepath + ".tmp"
+    with open(temp, "wb") as f:
+        dump(gen, f, journal)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, filepath)
+
+
+# A section of a record file being merged, written to a temporary file as it
+# grows, so that only the last few values are held in memory
+class Spool(object):
+    # Number of values held before they're written
+    SIZE = 2**16
+
+    def __init__(self, typecode, directory):
+        self.typecode = typecode
+        self.values = array(typecode)
+        self.length = 0
+        self.file = tempfile.TemporaryFile(dir=directory)
+
+    def append(self, value):
+        self.values.append(value)
+        self.length += 1
+        if len(self.values) >= Spool.SIZE:
+            self.flush()
+
+    def flush(self):
+        values = self.values
+        if sys.byteorder != "little":
+            values.byteswap()
+        self.file.write(values.tobytes())
+        self.values = array(self.typecode)
+
+    # Copies the whole section into a file, padded to 8 bytes
+    def copy(self, f):
+        self.flush()
+        self.file.seek(0)
+        size = 0
+        while True:
+            data = self.file.read(2**20)
+            if not data:
+                break
+            f.write(data)
+            size += len(data)
+        f.write(bytes(align(size) - size))
+
+    def close(self):
+        self.file.close()
+
+
+# Iterates over the chain of a Generator in the order of its keys once they
+# are translated into other word IDs (ids[word] for each of its words), as
+# (key, its position among the Generators, (word, count) pairs) tuples, with
+# the keys and words translated. For a Generator reading a record file, only
+# the keys it changed are held in memory, and the rest are read from the
+# file in order, through an index of its keys sorted by their new values
+def merged_items(gen, ids, n):
+    # Imported here to avoid a circular import, as the Generator reads records
+    from generator import KEY_SHIFT, pairkey, successors, unpairkey
+
+    def translate(key):
+        i1, i2 = unpairkey(key)
+        return pairkey(ids[i1], ids[i2])
+
+    def pairs(items):
+        return [(ids[word], count) for word, count in items]
+
+    changed = sorted(
+        (translate(key), n, pairs(successors(value)))
+        for key, value in gen.cache.items()
+    )
+    records = gen.record
+    if records is None:
+        yield from changed
+        return
+
+    def stored():
+        cache = gen.cache
+        if numpyError is None:
+            keys = numpy.frombuffer(records.keys, dtype=numpy.uint64)
+            table = numpy.array(ids, dtype=numpy.uint64)
+            shift = numpy.uint64(KEY_SHIFT)
+            new = (table[keys >> shift] << shift) | table[
+                keys & numpy.uint64((1 << KEY_SHIFT) - 1)
+            ]
+            if len(new) < 2 or bool((new[1:] > new[:-1]).all()):
+                # The IDs kept the order of the keys, as they do for the
+                # Generator whose words were translated first
+                order = numpy.arange(len(new))
+            else:
+                order = numpy.argsort(new, kind="stable")
+            new = new[order]
+            # Turned into Python numbers a chunk at a time
+            chunks = (
+                (order[i : i + Spool.SIZE].tolist(), new[i : i + Spool.SIZE].tolist())
+                for i in range(0, len(order), Spool.SIZE)
+            )
+        else:
+            new = [translate(key) for key in records.keys]
+            order = sorted(range(len(new)), key=new.__getitem__)
+            chunks = [(order, [new[i] for i in order])]
+        for positions, translated in chunks:
+            for i, key in zip(positions, translated):
+                if records.keys[i] not in cache:
+                    yield key, n, pairs(records.pairs(i))
+
+    yield from heapq.merge(changed, stored())
+
+
+# Writes a record file merging the chains of the given Generators into one,
+# summing the counts of the words that follow the same key in more than one
+# of them. The keys of all of them are merged in order and written as they
+# go, so besides the table of words, what's held in memory is the keys each
+# Generator changed and an index of the keys of their record files. The
+# ChainTries aren't merged, as they can only be merged whole. Returns the
+# VocabStats of the new record file
+def merge(gens, filepath, journal=0):
+    from generator import Successors, TokenTable, VocabStats
+
+    # The words of every Generator, translated to the IDs of the new table
+    tokens = TokenTable()
+    ids = [[tokens.intern(word) for word in gen.tokens.words] for gen in gens]
+    heads = Successors()
+    for gen, table in zip(gens, ids):
+        for word, count in gen.heads.items():
+            heads.add(table[word], count)
+
+    directory = os.path.dirname(os.path.abspath(filepath))
+    keys = Spool("Q", directory)
+    starts = Spool("Q", directory)
+    words = Spool("I", directory)
+    counts = Spool("I", directory)
+    starts.append(0)
+    total = 0
+    items = heapq.merge(
+        *[merged_items(gen, table, n) for n, (gen, table) in enumerate(zip(gens, ids))]
+    )
+    try:
+        key, _, pairs = next(items, (None, None, None))
+        while key is not None:
+            following = {}
+            for word, count in pairs:
+                following[word] = following.get(word, 0) + count
+            nxt, _, pairs = next(items, (None, None, None))
+            while nxt == key:
+                for word, count in pairs:
+                    following[word] = following.get(word, 0) + count
+                nxt, _, pairs = next(items, (None, None, None))
+            keys.append(key)
+            for word, count in following.items():
+                words.append(word)
+                counts.append(min(count, 0xFFFFFFFF))
+                total += count
+            starts.append(words.length)
+            key = nxt
+
+        strings = [w.encode("utf-8") for w in tokens.words]
+        offsets = array("Q", [0])
+        for string in strings:
+            offsets.append(offsets[-1] + len(string))
+        temp = filepath + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC,
+                    VERSION,
+                    0,
+                    len(tokens),
+                    keys.length,
+                    words.length,
+                    len(heads),
+                    offsets[-1],
+                    journal,
+                    0,
+                )
+            )
+            f.write(bytes(align(HEADER.size) - HEADER.size))
+            keys.copy(f)
+            starts.copy(f)
+            write_array(f, offsets)
+            write_array(f, array("I", tokens.folds))
+            words.copy(f)
+            counts.copy(f)
+            write_array(f, array("I", heads.words))
+            write_array(f, array("I", heads.counts))
+            data = b"".join(strings)
+            f.write(data)
+            f.write(bytes(align(len(data)) - len(data)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, filepath)
+    finally:
+        for spool in (keys, starts, words, counts):
+            spool.close()
+    size = (
+        12 * len(tokens)
+        + offsets[-1]
+        + 16 * keys.length
+        + 8 * (words.length + len(heads))
+    )
+    return VocabStats(heads.total, total, keys.length, words.length, size)
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import heapq
+import random
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from metrics import REGISTRY
+
+SEND_TIME = REGISTRY.histogram(
+    "velasco_send_seconds", "Time taken by Telegram to take a message."
+)
+SEND_DELAY = REGISTRY.histogram(
+    "velasco_send_delay_seconds",
+    "Time a message waited in line before being sent.",
+    buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+SEND_ERRORS = REGISTRY.counter(
+    "velasco_send_errors_total", "Errors sending messages, by type.", labels=("error",)
+)
+
+
+# A token bucket: holds up to burst tokens, refilled at rate tokens per
+# second, and every message sent takes one
+class TokenBucket(object):
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    # Time (in s) until a token is available, 0 if there is one
+    def delay(self, now):
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    # Time (in s) until the bucket is full again
+    def full_in(self, now):
+        self.refill(now)
+        return (self.burst - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+# A message waiting to be sent: send() returns the awaitable that sends it,
+# and the future gets its result
+class SendJob(object):
+    __slots__ = ("cid", "send", "priority", "seq", "queued", "attempts", "future")
+
+    def __init__(self, cid, send, priority, seq, future):
+        self.cid = cid
+        self.send = send
+        self.priority = priority
+        self.seq = seq
+        self.queued = time.monotonic()
+        # Number of times sending it failed and it was put back in line
+        self.attempts = 0
+        self.future = future
+
+
+# The messages waiting to be sent to a chat, its rate limit and its backoff
+class ChatQueue(object):
+    __slots__ = ("bucket", "jobs", "busy", "until", "errors")
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        # Heap of (priority, seq, SendJob)
+        self.jobs = []
+        # True while a message to the chat is being sent, as messages to the
+        # same chat are sent one after the other, in order
+        self.busy = False
+        # Nothing is sent to the chat until this time
+        self.until = 0.0
+        # Consecutive network errors sending to the chat
+        self.errors = 0
+
+    def head(self):
+        return self.jobs[0][2] if self.jobs else None
+
+
+# Sends the bot's messages within Telegram's flood limits: about 30 messages
+# per second overall, one per second in a chat and 20 per minute in a group.
+# Every limit is a TokenBucket, and messages to different chats are sent
+# concurrently as soon as their chat's and the global buckets allow it.
+# - Messages with a lower priority value go first: replies, then periodic
+#   messages, then announcements
+# - Messages to the same chat are sent one at a time, in priority order and
+#   in the order they were queued within a priority
+# - Only chats that have a message that can go right now are looked at when
+#   picking the next one, so announcements to thousands of chats take about
+#   (chats / global rate) seconds
+# When Telegram answers that the limits were exceeded anyway (RetryAfter),
+# nothing is sent to that chat for the time it asks for; if another chat is
+# already waiting for its own RetryAfter, the limit hit is taken to be the
+# global one, and nothing is sent to any chat for that time. Other network
+# errors (time outs, lost connections) back off the chat exponentially, with
+# jitter, and the whole bot if they keep happening in every chat. The
+# message that failed is put back in line and retried a few times, except
+# for periodic messages under the "drop" policy, which are dropped instead,
+# as they make little sense once the conversation has moved on
+class SendScheduler(object):
+    REPLY = 0
+    PERIODIC = 1
+    ANNOUNCE = 2
+
+    # What to do with periodic messages that have to wait for a backoff
+    QUEUE = "queue"
+    DROP = "drop"
+
+    def __init__(
+        self,
+        logger,
+        rate=25,
+        burst=5,
+        chat_rate=1,
+        group_rate=20 / 60,
+        workers=16,
+        deferred=QUEUE,
+        retries=3,
+        backoff=1,
+        max_backoff=60,
+    ):
+        # The logger shared program-wide
+        self.logger = logger
+        # The global limit
+        self.bucket = TokenBucket(rate, burst)
+        # Messages per second in a private chat and in a group
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        # Maximum number of messages being sent at once
+        self.workers = workers
+        # Policy for periodic messages that have to wait for a backoff
+        self.deferred = deferred
+        # Times a message is retried after a network error
+        self.retries = retries
+        # Base and maximum backoff (in s) after network errors
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Nothing is sent to any chat until this time
+        self.until = 0.0
+        # Consecutive network errors, in any chat
+        self.errors = 0
+        # (chat ID, time) of the last RetryAfter of a single chat
+        self.flood = (None, 0.0)
+        # ChatQueues of the chats with messages waiting, being sent, or whose
+        # bucket is still refilling, by chat ID
+        self.chats = {}
+        # Heap of (priority, seq, chat ID) of the chats that can send their
+        # next message now. Entries that no longer match the chat's next
+        # message are skipped when they come up
+        self.ready = []
+        # Heap of (time, chat ID) of chats whose bucket is refilling
+        self.waiting = []
+        # Messages being sent
+        self.running = set()
+        self.seq = 0
+        # Set whenever there is something new to dispatch
+        self.event = None
+        self.task = None
+        # Metrics
+        self.sent = 0
+        self.failures = 0
+        self.dropped = 0
+        self.retried = 0
+        self.queued = 0
+        self.max_depth = 0
+        self.delay_time = 0.0
+        self.max_delay = 0.0
+
+    # Number of messages waiting or being sent
+    def depth(self):
+        return self.queued + len(self.running)
+
+    # Average time (in s) a message waited before being sent
+    def mean_delay(self):
+        done = self.sent + self.failures
+        return self.delay_time / done if done > 0 else 0.0
+
+    # Seconds left until messages can be sent to a chat (or to any chat, if
+    # no chat ID is given) again, 0 if they can be sent now
+    def paused(self, cid=None):
+        now = time.monotonic()
+        until = self.until
+        chat = self.chats.get(str(cid)) if cid is not None else None
+        if chat is not None:
+            until = max(until, chat.until)
+        return max(0.0, until - now)
+
+    # Whether a message with some priority for a chat would be dropped right
+    # away, as it would have to wait for a backoff
+    def would_drop(self, cid, priority):
+        return (
+            priority == SendScheduler.PERIODIC
+            and self.deferred == SendScheduler.DROP
+            and self.paused(cid) > 0
+        )
+
+    # Chats with negative IDs are groups, supergroups or channels
+    def chat_bucket(self, cid):
+        if str(cid).startswith("-"):
+            return TokenBucket(self.group_rate)
+        return TokenBucket(self.chat_rate)
+
+    # Queues a message for a chat: send() must return the awaitable that sends
+    # it. Returns a future with the result of sending it, which is cancelled
+    # if the message is dropped
+    def submit(self, cid, send, priority=PERIODIC):
+        if self.task is None:
+            self.event = asyncio.Event()
+            self.task = asyncio.ensure_future(self.run())
+        cid = str(cid)
+        future = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        job = SendJob(cid, send, priority, self.seq, future)
+        if self.would_drop(cid, priority):
+            self.drop(job)
+            return future
+        chat = self.chats.get(cid)
+        if chat is None:
+            chat = self.chats[cid] = ChatQueue(self.chat_bucket(cid))
+        self.enqueue(chat, job)
+        self.max_depth = max(self.max_depth, self.depth())
+        return future
+
+    # Puts a message in its chat's line
+    def enqueue(self, chat, job):
+        heapq.heappush(chat.jobs, (job.priority, job.seq, job))
+        if chat.head() is job and not chat.busy:
+            heapq.heappush(self.ready, (job.priority, job.seq, job.cid))
+        self.queued += 1
+        self.event.set()
+
+    def drop(self, job):
+        self.dropped += 1
+        job.future.cancel()
+        self.logger.warning(
+            "Dropped a message to chat {} while backing off.".format(job.cid)
+        )
+
+    # Queues a message and waits until it is sent, returning the result
+    async def send(self, cid, send, priority=PERIODIC):
+        return await self.submit(cid, send, priority)
+
+    # Puts a chat back in line after its bucket refilled or a message to it
+    # was sent, or forgets it if it has nothing left to send
+    def wake(self, cid, now):
+        chat = self.chats.get(cid)
+        if chat is None or chat.busy:
+            return
+        job = chat.head()
+        if job is not None:
+            heapq.heappush(self.ready, (job.priority, job.seq, cid))
+            return
+        # Kept until its bucket is full and its backoff is over
+        idle = max(now + chat.bucket.full_in(now), chat.until)
+        if idle <= now:
+            del self.chats[cid]
+        else:
+            heapq.heappush(self.waiting, (idle, cid))
+
+    # Takes the next message that can be sent now, if any
+    def next_job(self, now):
+        while self.ready:
+            priority, seq, cid = self.ready[0]
+            chat = self.chats.get(cid)
+            job = chat.head() if chat is not None else None
+            if job is None or job.seq != seq or chat.busy:
+                # Stale entry
+                heapq.heappop(self.ready)
+                continue
+            delay = max(chat.bucket.delay(now), chat.until - now)
+            if delay > 0:
+                heapq.heappop(self.ready)
+                heapq.heappush(self.waiting, (now + delay, cid))
+                continue
+            heapq.heappop(self.ready)
+            heapq.heappop(chat.jobs)
+            return job
+        return None
+
+    # Dispatches the queued messages as the limits allow
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            while self.waiting and self.waiting[0][0] <= now:
+                _, cid = heapq.heappop(self.waiting)
+                self.wake(cid, now)
+            timeout = None
+            if self.ready and len(self.running) < self.workers:
+                timeout = max(self.bucket.delay(now), self.until - now)
+                if timeout <= 0:
+                    job = self.next_job(now)
+                    if job is not None:
+                        self.dispatch(job, now)
+                    continue
+            if self.waiting:
+                wake = self.waiting[0][0] - now
+                timeout = wake if timeout is None else min(timeout, wake)
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    # Starts sending a message
+    def dispatch(self, job, now):
+        chat = self.chats[job.cid]
+        chat.busy = True
+        chat.bucket.take(now)
+        self.bucket.take(now)
+        self.queued -= 1
+        delay = now - job.queued
+        self.delay_time += delay
+        self.max_delay = max(self.max_delay, delay)
+        SEND_DELAY.observe(delay)
+        task = asyncio.ensure_future(self.deliver(job))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    # Sends a message and hands its result or error to its future
+    async def deliver(self, job):
+        chat = self.chats[job.cid]
+        start = time.perf_counter()
+        try:
+            result = await job.send()
+            SEND_TIME.observe(time.perf_counter() - start)
+            self.sent += 1
+            chat.errors = 0
+            self.errors = 0
+            if not job.future.done():
+                job.future.set_result(result)
+        except Exception as e:
+            SEND_TIME.observe(time.perf_counter() - start)
+            SEND_ERRORS.inc(1, type(e).__name__)
+            self.handle(chat, job, e)
+        finally:
+            chat.busy = False
+            self.wake(job.cid, time.monotonic())
+            self.event.set()
+
+    # Backs off from an error sending a message, or gives up on it
+    def handle(self, chat, job, e):
+        if isinstance(e, RetryAfter):
+            self.flooded(chat, job, e)
+        elif isinstance(e, NetworkError) and not isinstance(e, BadRequest):
+            self.failed(chat, job, e)
+        else:
+            self.fail(job, e)
+
+    # Gives up on a message
+    def fail(self, job, e):
+        self.failures += 1
+        if not job.future.done():
+            job.future.set_exception(e)
+
+    # Backs off after Telegram asked to wait before sending again
+    def flooded(self, chat, job, e):
+        now = time.monotonic()
+        after = e.retry_after
+        if isinstance(after, timedelta):
+            after = after.total_seconds()
+        chat.until = max(chat.until, now + after)
+        cid, until = self.flood
+        if cid is not None and cid != job.cid and until > now:
+            # Two chats flooded at once: the global limit was hit
+            self.until = max(self.until, now + after)
+            self.logger.warning(
+                "Flood limit exceeded, not sending anything for {} s.".format(after)
+            )
+        else:
+            self.logger.warning(
+                "Flood limit exceeded in chat {}, not sending anything to it for "
+                "{} s.".format(job.cid, after)
+            )
+        self.flood = (job.cid, chat.until)
+        self.retry(chat, job, e, count=False)
+
+    # Backs off exponentially after a network error, with jitter
+    def failed(self, chat, job, e):
+        now = time.monotonic()
+        chat.errors += 1
+        self.errors += 1
+        delay = self.jitter(chat.errors)
+        chat.until = max(chat.until, now + delay)
+        self.logger.warning(
+            "Network error sending to chat {} ({}), backing off for {:.1f} s.".format(
+                job.cid, e, delay
+            )
+        )
+        if self.errors > chat.errors:
+            # Failing in other chats too since the last message sent
+            self.until = max(self.until, now + self.jitter(self.errors))
+        self.retry(chat, job, e)
+
+    # Backoff (in s) after some consecutive errors: the exponential delay,
+    # and a random part of as much, so that retries don't all come at once
+    def jitter(self, errors):
+        delay = min(self.max_backoff, self.backoff * 2 ** (errors - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    # Puts a message that couldn't be sent back in line, as the policy says
+    def retry(self, chat, job, e, count=True):
+        if job.future.done():
+            return
+        if (
+            job.priority == SendScheduler.PERIODIC
+            and self.deferred == SendScheduler.DROP
+        ):
+            self.drop(job)
+            return
+        if count:
+            job.attempts += 1
+            if job.attempts > self.retries:
+                self.fail(job, e)
+                return
+        self.retried += 1
+        self.enqueue(chat, job)
+
+    # Drops every message still waiting, and waits for the ones being sent
+    async def close(self):
+        dropped = self.queued
+        for chat in self.chats.values():
+            for _, _, job in chat.jobs:
+                job.future.cancel()
+            chat.jobs.clear()
+        self.dropped += dropped
+        self.queued = 0
+        if self.running:
+            await asyncio.wait(list(self.running))
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if dropped > 0:
+            self.logger.warning(
+                "Dropped {} messages waiting to be sent.".format(dropped)
+            )
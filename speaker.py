@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
+import os
 import random
 import time
 from sys import stderr
@@ -8,7 +10,41 @@ from sys import stderr
 from telegram.error import NetworkError
 
 from memorylist import MemoryList
+from metrics import REGISTRY
+from persister import Persister
+from profiler import PROFILER
 from reader import Reader, get_chat_title
+from scheduler import SendScheduler
+
+UPDATES = REGISTRY.counter("velasco_updates_total", "Updates read.")
+READ_TIME = REGISTRY.histogram(
+    "velasco_read_seconds", "Time taken to handle an update that was read."
+)
+READER_CACHE = REGISTRY.counter(
+    "velasco_reader_cache_total",
+    "Chats looked up in memory, by whether they were there.",
+    labels=("result",),
+)
+MEMORY_CHATS = REGISTRY.gauge("velasco_memory_chats", "Chats in memory.")
+MEMORY_CAPACITY = REGISTRY.gauge(
+    "velasco_memory_capacity", "Maximum number of chats in memory."
+)
+GENERATOR_MESSAGES = REGISTRY.gauge(
+    "velasco_generator_messages", "Messages learned by the chats in memory."
+)
+GENERATOR_TOKENS = REGISTRY.gauge(
+    "velasco_generator_tokens", "Tokens learned by the chats in memory."
+)
+GENERATOR_KEYS = REGISTRY.gauge(
+    "velasco_generator_keys", "Keys of the chains of the chats in memory."
+)
+GENERATOR_TRANSITIONS = REGISTRY.gauge(
+    "velasco_generator_transitions", "Transitions of the chains of the chats in memory."
+)
+GENERATOR_BYTES = REGISTRY.gauge(
+    "velasco_generator_bytes",
+    "Approximate size of the vocabularies of the chats in memory.",
+)
 
 
 # Auxiliar print to stderr function (alongside logger messages)
@@ -16,7 +52,33 @@ def eprint(*args, **kwargs):
     print(*args, end=" ", file=stderr, **kwargs)
 
 
+# Formats a number of bytes
+def size_text(size):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return "{:.0f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} GiB".format(size)
+
+
+# Describes a vocabulary's VocabStats
+def stats_text(stats):
+    if stats is None:
+        return "a vocabulary of unknown size"
+    return (
+        "a vocabulary of {} messages, {} tokens, {} keys and {} distinct "
+        "transitions (about {})".format(
+            stats.messages,
+            stats.tokens,
+            stats.keys,
+            stats.transitions,
+            size_text(stats.bytes),
+        )
+    )
+
+
 # Auxiliar message to send a text to a chat through a bot
+@PROFILER.hook("telegram.send")
 async def send(bot, cid, text, replying=None, formatting=None, logger=None, **kwargs):
     # Check if text is empty or just whitespace
     if not text or not text.strip():
@@ -59,6 +121,9 @@ class Speaker(object):
     ModeFixed = "FIXED_MODE"
     # Marks if the "periodic" messages have a weighted random chance to be sent, depending on the period
     ModeChance = "CHANCE_MODE"
+    # Time (in s) without updates after which the bot is idle, and waited
+    # between the batches of short term memory committed in the background
+    IDLE_TIME = 0.05
 
     def __init__(
         self,
@@ -77,26 +142,60 @@ class Speaker(object):
         bypass=False,
         cid_whitelist=None,
         max_len=50,
+        send_rate=25,
+        group_rate=20,
+        deferred=SendScheduler.QUEUE,
     ):
         # List of nicknames other than the username that the bot can be called as
         self.names = nicknames or []
-        # Mute time for Telegram network errors
+        # Maximum time to back off for after Telegram network errors
         self.mute_time = mute_time
-        # Last mute timestamp
-        self.mute_timer = None
         # The bot's username, "@" included
         self.username = username
         # The minimum and maximum chat period for this bot
         self.min_period = archivist.min_period
         self.max_period = archivist.max_period
+        # The size budget of the chats' vocabularies, unless their card sets
+        # another
+        self.vocab_limit = archivist.vocab_limit
+        # Maximum number of messages in a Reader's short term memory, and the
+        # number committed at once from it
+        self.short_memory = archivist.short_memory
+        self.commit_batch = archivist.commit_batch
 
         # The Archivist functions to load and save from and to files
         self.get_reader_file = archivist.get_reader
-        self.store_file = archivist.store
+        self.prepare_file = archivist.prepare
+        # Writes the files away from the event loop
+        self.persister = Persister(archivist, logger)
+        # Logs the messages read until they are saved, if enabled
+        self.message_log = archivist.message_log
+        self.replay_file = archivist.replay_log
+        # The pending flush of the message log, and the timer that starts one
+        self.log_flush = None
+        self.log_timer = None
+
+        # Sends the messages within Telegram's flood limits (group_rate is
+        # given in messages per minute), and keeps the backoff of every chat
+        self.scheduler = SendScheduler(
+            logger,
+            rate=send_rate,
+            group_rate=group_rate / 60,
+            deferred=deferred,
+            max_backoff=mute_time,
+        )
+        # The announcement being sent on wakeup
+        self.announcing = None
+        # The profiling window running, and the event that ends it early
+        self.profiling = None
+        self.profile_stop = None
 
         # Archivist function to crawl all stored Readers
         self.readers_pass = archivist.readers_pass
 
+        # Save the messages the last run didn't
+        archivist.recover_log()
+
         # Legacy load logging emssages
         logger.info("----")
         logger.info("Finished loading.")
@@ -113,8 +212,15 @@ class Speaker(object):
         self.repeat = repeat
         # If not empty, whitelist of chat IDs to only respond to
         self.cid_whitelist = cid_whitelist
-        # Memory list/cache for the last accessed chats
-        self.memory = MemoryList(memory)
+        # Memory list/cache for the last accessed chats, by chat ID
+        self.memory = MemoryList(memory, key=lambda reader: reader.cid())
+        # The Readers whose short term memory is being committed, by chat ID,
+        # the task committing them and the chat it's committing
+        self.overflowing = {}
+        self.committing = None
+        self.committing_cid = None
+        # When the last update was read
+        self.last_read = time.perf_counter()
         # Minimum time to wait between memory saves (triggered at the next message from any chat)
         self.save_time = save_time
         # Last save timestamp
@@ -126,62 +232,90 @@ class Speaker(object):
         # Max word length for a message
         self.max_len = max_len
 
-    # Sends an announcement to all chats that pass the check
+        REGISTRY.collectors.append(self.collect_metrics)
+
+    # Sends an announcement to all chats that pass the check, as fast as the
+    # flood limits allow, and waits until it has gone to all of them
     async def announce(self, bot, announcement, check=(lambda _: True)):
+        start = time.perf_counter()
+        futures = []
         for reader in self.readers_pass():
             try:
                 if check(reader):
-                    await send(bot, reader.cid(), announcement)
-                    self.logger.info(
-                        "Sending announcement to chat {}".format(reader.cid())
+                    cid = reader.cid()
+                    futures.append(
+                        self.scheduler.submit(
+                            cid,
+                            lambda cid=cid: send(bot, cid, announcement),
+                            SendScheduler.ANNOUNCE,
+                        )
                     )
             except Exception:
                 pass
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        failed = sum(1 for result in results if isinstance(result, BaseException))
+        self.logger.info(
+            "Sent announcement to {} chats ({} failed) in {:.1f} s.".format(
+                len(results) - failed, failed, time.perf_counter() - start
+            )
+        )
 
     # If wakeup flag is set, sends a wake-up message as announcement to all chats that
     # are groups. Also, always sends a wakeup message to the 'bot admin'
     async def wake(self, bot, wake):
-        await send(bot, self.admin, wake)
+        await self.scheduler.send(
+            self.admin, lambda: send(bot, self.admin, wake), SendScheduler.REPLY
+        )
 
         if self.wakeup:
 
             def group_check(reader):
                 return reader.check_type("group")
 
-            await self.announce(bot, wake, group_check)
+            # Sent in the background, so that the bot starts reading meanwhile
+            self.announcing = asyncio.ensure_future(
+                self.announce(bot, wake, group_check)
+            )
 
     # Looks up a reader in the memory list
     def get_reader(self, cid):
-        return self.memory.search(lambda r: r.cid() == cid, None)
+        return self.memory.get(cid)
 
     # Looks up and returns a reader if it's in memory, or loads up a reader from
     # file, adds it to memory, and returns it. Any other reader pushed out of
     # memory is saved to file
-    def load_reader(self, chat):
+    async def load_reader(self, chat):
         cid = str(chat.id)
         reader = self.get_reader(cid)
         if reader is not None:
+            READER_CACHE.inc(1, "hit")
             return reader
+        READER_CACHE.inc(1, "miss")
 
+        # The files may still be being written since it was last pushed out
+        await self.persister.wait(cid)
         reader = self.get_reader_file(cid)
         if not reader:
             reader = Reader.FromChat(
                 chat, self.min_period, self.max_period, self.logger
             )
+            reader.limit_memory(self.short_memory, self.commit_batch)
+            self.replay_file(cid, reader)
 
         old_reader = self.memory.add(reader)
         if old_reader is not None:
             old_reader.commit_memory()
-            self.store(old_reader)
+            await self.store(old_reader)
 
         return reader
 
     # Returns a reader if it's in memory, or loads it up from a file and returns
     # it otherwise. Does NOT add the Reader to memory
     # This is useful for command prompts that do not require the Reader to be cached
-    def access_reader(self, cid):
+    async def access_reader(self, cid):
         reader = self.get_reader(cid)
         if reader is None:
+            await self.persister.wait(cid)
             return self.get_reader_file(cid)
         return reader
 
@@ -195,19 +329,11 @@ class Speaker(object):
                 return True
         return False
 
-    # Returns True if not enough time has passed since the last mute timestamp
-    def is_mute(self):
-        current_time = int(time.perf_counter())
-        return (
-            self.mute_timer is not None
-            and (current_time - self.mute_timer) < self.mute_time
-        )
-
     # Series of checks to determine if the bot should reply to a specific message, aside
     # from the usual periodic messages
     async def should_reply(self, message, reader):
-        if self.is_mute():
-            # Not if mute time hasn't finished
+        if self.scheduler.paused(reader.cid()) > 0:
+            # Not if the chat (or the bot) is backing off from Telegram errors
             return False
         if not self.bypass and reader.is_restricted():
             # If we're not in testing mode and the chat is restricted
@@ -224,11 +350,17 @@ class Speaker(object):
             (replied is not None) and (replied.from_user.name == self.username)
         ) or (self.mentioned(text))
 
-    def store(self, reader):
+    # Queues a Reader to be written to file, pruning its vocabulary first if
+    # it went over its budget. Only what changed since it was last stored is
+    # written, and nothing if it didn't change. Returns whether it was queued
+    async def store(self, reader):
         if reader is None:
             raise ValueError("Tried to store a None Reader.")
-        else:
-            self.store_file(*reader.archive())
+        reader.prune(self.vocab_limit)
+        if not reader.is_dirty():
+            return False
+        await self.persister.submit(self.prepare_file(*reader.archive()))
+        return True
 
     # Check if enough time for saving memory has passed
     def should_save(self):
@@ -238,30 +370,186 @@ class Speaker(object):
         return elapsed >= self.save_time
 
     # Save all Readers in memory to files if it's save time
-    def save(self):
+    async def save(self):
         if self.should_save():
             self.logger.info("Saving chats in memory...")
-            for reader in self.memory:
-                self.store(reader)
+            # Other updates can change the memory while waiting to store
+            queued = skipped = 0
+            for reader in list(self.memory):
+                if await self.store(reader):
+                    queued += 1
+                else:
+                    skipped += 1
             self.memory_timer = time.perf_counter()
-            self.logger.info("Chats saved.")
+            persister = self.persister
+            self.logger.info(
+                "{} chats queued for saving, {} unchanged skipped. Queue depth {} "
+                "(max. {}), {} written, {} merged, {} failed, write time {:.3f} s "
+                "on average (max. {:.3f} s).".format(
+                    queued,
+                    skipped,
+                    persister.depth(),
+                    persister.max_depth,
+                    persister.writes,
+                    persister.merged,
+                    persister.failures,
+                    persister.mean_write_time(),
+                    persister.max_write_time,
+                )
+            )
+            scheduler = self.scheduler
+            self.logger.info(
+                "Messages: {} waiting or being sent (max. {}), {} sent, {} failed, "
+                "{} retried, {} dropped, {:.3f} s of delay on average "
+                "(max. {:.3f} s).".format(
+                    scheduler.depth(),
+                    scheduler.max_depth,
+                    scheduler.sent,
+                    scheduler.failures,
+                    scheduler.retried,
+                    scheduler.dropped,
+                    scheduler.mean_delay(),
+                    scheduler.max_delay,
+                )
+            )
+
+    # Saves all Readers in memory and waits for every file to be written
+    async def close(self):
+        if self.announcing is not None:
+            self.announcing.cancel()
+        if self.profiling is not None and not self.profiling.done():
+            self.profile_stop.set()
+            await self.profiling
+        await self.scheduler.close()
+        if self.committing is not None:
+            self.committing.cancel()
+        self.logger.info("Saving chats in memory before exiting...")
+        for reader in list(self.memory):
+            await self.store(reader)
+        await self.persister.close()
+        if self.message_log is not None:
+            if self.log_timer is not None:
+                self.log_timer.cancel()
+            if self.log_flush is not None and not self.log_flush.done():
+                await asyncio.wait([self.log_flush])
+            self.message_log.flush()
+        self.logger.info("Chats saved.")
+
+    # The number of messages in a short term memory from which it's committed
+    # in the background: a batch under the limit, so that the Reader only has
+    # to commit them itself if the bot is never idle
+    def memory_mark(self):
+        return max(0, self.short_memory - self.commit_batch)
+
+    # Commits the short term memory of a Reader that went near its size in the
+    # background, so that it isn't all done at once when the chat talks
+    def commit_overflow(self, reader):
+        self.overflowing[reader.cid()] = reader
+        if self.committing is None or self.committing.done():
+            self.start_committing()
+
+    def start_committing(self):
+        self.committing = asyncio.ensure_future(self.commit_batches())
+        self.committing.add_done_callback(self.committed)
+
+    # Commits the oldest messages of the overflowing Readers, a batch at a
+    # time whenever no update was read for a while, until they are back
+    # under the mark
+    async def commit_batches(self):
+        while len(self.overflowing) > 0:
+            await asyncio.sleep(Speaker.IDLE_TIME)
+            if time.perf_counter() - self.last_read < Speaker.IDLE_TIME:
+                continue
+            cid, reader = next(iter(self.overflowing.items()))
+            self.committing_cid = cid
+            left = reader.commit_some(self.commit_batch)
+            if left <= self.memory_mark():
+                del self.overflowing[cid]
+        self.committing_cid = None
+
+    # Logs a failure committing a short term memory in the background, and
+    # goes on with the other Readers without the one that failed
+    def committed(self, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        cid = self.committing_cid
+        self.overflowing.pop(cid, None)
+        self.committing_cid = None
+        self.logger.error(
+            "Failed committing the short term memory of chat {}:".format(cid)
+        )
+        self.logger.exception(future.exception())
+        if len(self.overflowing) > 0:
+            self.start_committing()
+
+    # Appends a message read to the message log, and flushes it if a batch is
+    # waiting, or sets a timer to do so otherwise
+    def log_message(self, cid, mid, text):
+        if self.message_log is None:
+            return
+        if self.message_log.append(cid, mid, text):
+            self.flush_log()
+        elif self.log_timer is None:
+            self.log_timer = asyncio.get_running_loop().call_later(
+                self.message_log.interval, self.flush_log
+            )
 
-    # Reads a non-command message
+    # Writes and syncs the messages waiting in the message log from another
+    # thread. If it's already being flushed, it's tried again later
+    def flush_log(self):
+        loop = asyncio.get_running_loop()
+        if self.log_timer is not None:
+            self.log_timer.cancel()
+            self.log_timer = None
+        if self.log_flush is not None and not self.log_flush.done():
+            self.log_timer = loop.call_later(self.message_log.interval, self.flush_log)
+            return
+        self.log_flush = loop.run_in_executor(None, self.message_log.flush)
+        self.log_flush.add_done_callback(self.log_flushed)
+
+    def log_flushed(self, future):
+        if future.exception() is not None:
+            self.logger.error("Failed writing the message log:")
+            self.logger.exception(future.exception())
+
+    # Reads a non-command message, measuring it
+    @PROFILER.hook("speaker.read")
     async def read(self, update, context):
+        UPDATES.inc()
+        with READ_TIME.time():
+            await self.read_update(update, context)
+
+    # Handles a non-command message
+    async def read_update(self, update, context):
+        self.last_read = time.perf_counter()
         # Check for save time
-        self.save()
+        await self.save()
 
         # Ignore non-message updates
         if update.message is None:
             return
 
         chat = update.message.chat
-        reader = self.load_reader(chat)
-        reader.read(update.message)
+        reader = await self.load_reader(chat)
+        text = reader.read(update.message)
+        self.log_message(reader.cid(), update.message.message_id, text)
+        if (
+            self.short_memory is not None
+            and len(reader.short_term_mem) > self.memory_mark()
+        ):
+            self.commit_overflow(reader)
+        # Save the vocabulary whole if it keeps too many changed keys in memory
+        if reader.over_capacity():
+            await self.store(reader)
 
         # Check if it's a "replyable" message & roll the chance to do so
         if await self.should_reply(update.message, reader) and reader.is_answering():
-            await self.say(context.bot, reader, replying=update.message.message_id)
+            await self.say(
+                context.bot,
+                reader,
+                replying=update.message.message_id,
+                priority=SendScheduler.REPLY,
+            )
             return
 
         # Update the Reader's title if it has changed since the last message read
@@ -280,7 +568,7 @@ class Speaker(object):
     # Handles /speak command
     async def speak(self, update, context):
         chat = update.message.chat
-        reader = self.load_reader(chat)
+        reader = await self.load_reader(chat)
 
         if not self.bypass and reader.is_restricted():
             user = await update.message.chat.get_member(update.message.from_user.id)
@@ -295,7 +583,7 @@ class Speaker(object):
         words = update.message.text.split()
         if len(words) > 1:
             reader.read(" ".join(words[1:]))
-        await self.say(context.bot, reader, replying=rid)
+        await self.say(context.bot, reader, replying=rid, priority=SendScheduler.REPLY)
 
     # Checks user permissions. Bot admin is always considered as having full permissions
     def user_is_admin(self, member):
@@ -320,56 +608,149 @@ class Speaker(object):
             return ""
         return generated
 
-    # Say a newly generated message
-    async def say(self, bot, reader, replying=None, **kwargs):
+    # Say a newly generated message. The message is queued in the scheduler
+    # and sent once the flood limits allow it, without waiting for it here
+    @PROFILER.hook("speaker.say")
+    async def say(
+        self, bot, reader, replying=None, priority=SendScheduler.PERIODIC, **kwargs
+    ):
         cid = reader.cid()
         if self.cid_whitelist is not None and cid not in self.cid_whitelist:
             # Don't, if there's a whitelist and this chat is not in it
             return
-        if self.is_mute():
-            # Don't, if mute time isn't over
+        if self.scheduler.would_drop(cid, priority):
+            # Don't, if the chat is backing off and the message would be dropped
             return
 
-        try:
-            await send(
-                bot, cid, self.speech(reader), replying, logger=self.logger, **kwargs
+        texts = [self.speech(reader)]
+        if self.bypass:
+            # Testing mode, force a reasonable period (to not have the bot spam one specific chat with a low period)
+            minp = self.min_period
+            maxp = self.max_period
+            rangep = maxp - minp
+            reader.set_period(random.randint(rangep // 4, rangep) + minp)
+        if random.random() <= self.repeat:
+            texts.append(self.speech(reader))
+
+        for text, rid in zip(texts, [replying, None]):
+            future = self.scheduler.submit(
+                cid,
+                lambda text=text, rid=rid: send(
+                    bot, cid, text, rid, logger=self.logger, **kwargs
+                ),
+                priority,
             )
-            if self.bypass:
-                # Testing mode, force a reasonable period (to not have the bot spam one specific chat with a low period)
-                minp = self.min_period
-                maxp = self.max_period
-                rangep = maxp - minp
-                reader.set_period(random.randint(rangep // 4, rangep) + minp)
-            if random.random() <= self.repeat:
-                await send(bot, cid, self.speech(reader), logger=self.logger, **kwargs)
-        # Consider any Network Error as a Telegram temporary ban, as I couldn't find
-        # out in the documentation how error 429 is handled by python-telegram-bot
-        except NetworkError as e:
-            self.logger.error("Sending a message caused network error:")
-            self.logger.exception(e)
+            future.add_done_callback(lambda f: self.sent(bot, cid, f))
+
+    # Handles the outcome of sending a message
+    def sent(self, bot, cid, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        e = future.exception()
+        # Flood limits and temporary network errors were already backed off
+        # from and retried by the scheduler
+        if isinstance(e, NetworkError):
+            self.logger.error("Sending a message caused network error:", exc_info=e)
             if "Not enough rights to send text messages to the chat" in str(e):
                 # We've been muted in the chat, get out of it as it doesn't make any sense to remain
                 self.logger.error("Leaving chat...")
-                bot.leaveChat(cid)
-            else:
-                self.logger.error("Going mute for {} seconds.".format(self.mute_time))
-                self.mute_timer = int(time.perf_counter())
+                asyncio.ensure_future(bot.leave_chat(cid))
+        else:
+            self.logger.error("Sending a message caused exception:", exc_info=e)
+
+    # Sets the gauges of the metrics taken from the chats in memory
+    def collect_metrics(self):
+        MEMORY_CHATS.set(len(self.memory))
+        MEMORY_CAPACITY.set(self.memory.capacity())
+        totals = [0] * 5
+        for reader in self.memory:
+            stats = reader.stats()
+            if stats is not None:
+                totals = [total + n for total, n in zip(totals, stats)]
+        GENERATOR_MESSAGES.set(totals[0])
+        GENERATOR_TOKENS.set(totals[1])
+        GENERATOR_KEYS.set(totals[2])
+        GENERATOR_TRANSITIONS.set(totals[3])
+        GENERATOR_BYTES.set(totals[4])
+
+    # Starts profiling the bot for some seconds in the background
+    def start_profile(self, seconds, message=None):
+        self.profile_stop = asyncio.Event()
+        self.profiling = asyncio.ensure_future(self.profile_window(seconds, message))
+
+    # Profiles the bot for some seconds (or until profile_stop is set), then
+    # logs the summary, and sends it with the collapsed stacks to the chat of
+    # the message that asked for it, if any
+    async def profile_window(self, seconds, message=None):
+        if not PROFILER.start():
+            return
+        self.logger.info("Profiling for {} s...".format(seconds))
+        try:
+            await asyncio.wait_for(self.profile_stop.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        summary, paths = PROFILER.stop()
+        self.logger.info("{}\nWritten to {}.".format(summary, " and ".join(paths)))
+        if message is None:
+            return
+        try:
+            await message.reply_text(summary)
+            with open(paths[1], "rb") as file:
+                await message.reply_document(
+                    document=file, filename=os.path.basename(paths[1])
+                )
         except Exception as e:
-            self.logger.error("Sending a message caused exception:")
-            self.logger.exception(e)
+            self.logger.error("Failed sending the profile:", exc_info=e)
+
+    # Handling /profile command (exclusive for bot admin)
+    # Profiles the bot for the given seconds (60 by default), or stops the
+    # profiling window running with "/profile stop"
+    async def profile(self, update, context):
+        words = update.message.text.split()
+        running = self.profiling is not None and not self.profiling.done()
+        if len(words) > 1 and words[1] == "stop":
+            if running:
+                self.profile_stop.set()
+            else:
+                await update.message.reply_text("I'm not profiling.")
+            return
+        if running:
+            await update.message.reply_text("I'm already profiling.")
+            return
+        try:
+            seconds = float(words[1]) if len(words) > 1 else 60
+        except ValueError:
+            await update.message.reply_text("Usage: /profile [SECONDS | stop]")
+            return
+        await update.message.reply_text("Profiling for {} s.".format(seconds))
+        self.start_profile(seconds, update.message)
+
+    # Handling /metrics command (exclusive for bot admin)
+    # Sends the metrics in the Prometheus text format, as a file
+    async def get_metrics(self, update, context):
+        REGISTRY.collect()
+        await update.message.reply_document(
+            document=REGISTRY.render().encode("utf-8"), filename="metrics.txt"
+        )
 
     # Handling /count command
     async def get_count(self, update, context):
-        cid = str(update.message.chat.id)
-        reader = self.load_reader(cid)
+        reader = await self.load_reader(update.message.chat)
 
-        num = str(reader.count()) if reader else "no"
+        stats = reader.stats() if reader else None
+        if stats is None:
+            num = str(reader.count()) if reader else "no"
+        else:
+            # Including the ones read but not learned yet
+            num = str(stats.messages + len(reader.short_term_mem))
         await update.message.reply_text("I remember {} messages.".format(num))
 
     # Handling /get_chats command (exclusive for bot admin)
     async def get_chats(self, update, context):
         lines = [
-            "[{}]: {}".format(reader.cid(), reader.title())
+            "[{}]: {} ({})".format(
+                reader.cid(), reader.title(), stats_text(reader.stats())
+            )
             for reader in self.readers_pass()
         ]
         chat_list = "\n".join(lines)
@@ -379,7 +760,7 @@ class Speaker(object):
     # Print the current period or set a new one if one is given
     async def period(self, update, context):
         chat = update.message.chat
-        reader = self.load_reader(str(chat.id))
+        reader = await self.load_reader(chat)
 
         words = update.message.text.split()
         if len(words) <= 1:
@@ -412,7 +793,7 @@ class Speaker(object):
     # Print the current answer probability or set a new one if one is given
     async def answer(self, update, context):
         chat = update.message.chat
-        reader = self.load_reader(str(chat.id))
+        reader = await self.load_reader(chat)
 
         words = update.message.text.split()
         if len(words) <= 1:
@@ -449,7 +830,7 @@ class Speaker(object):
             return
         chat = update.message.chat
         user = await chat.get_member(update.message.from_user.id)
-        reader = self.load_reader(str(chat.id))
+        reader = await self.load_reader(chat)
 
         if reader.is_restricted():
             if not self.user_is_admin(user):
@@ -469,7 +850,7 @@ class Speaker(object):
             return
         chat = update.message.chat
         user = await chat.get_member(update.message.from_user.id)
-        reader = self.load_reader(str(chat.id))
+        reader = await self.load_reader(chat)
 
         if reader.is_restricted():
             if not self.user_is_admin(user):
@@ -487,7 +868,7 @@ class Speaker(object):
         usr = msg.from_user
         cht = msg.chat
         chtname = cht.title if cht.title else cht.first_name
-        rdr = self.access_reader(str(cht.id))
+        rdr = await self.access_reader(str(cht.id))
 
         answer = (
             "You're **{name}**, with username `{username}`, and "
@@ -509,7 +890,7 @@ class Speaker(object):
     async def where(self, update, context):
         msg = update.message
         chat = msg.chat
-        reader = self.access_reader(str(chat.id))
+        reader = await self.access_reader(str(chat.id))
         if reader.is_restricted() and reader.is_silenced():
             permissions = "restricted and silenced"
         elif reader.is_restricted():
@@ -522,13 +903,14 @@ class Speaker(object):
         answer = (
             "You're messaging in the chat of saved title __{cname}__,"
             " with id `{cid}`, message count {c}, period {p}, and answer "
-            "probability {a}.\n\nThis chat is {perm}."
+            "probability {a}.\n\nThis chat has {v}.\n\nThis chat is {perm}."
         ).format(
             cname=reader.title(),
             cid=reader.cid(),
             c=reader.count(),
             p=reader.period(),
             a=reader.answer(),
+            v=stats_text(reader.stats()),
             perm=permissions,
         )
 
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import tempfile
+import unittest
+
+import record
+from archivist import Archivist
+from generator import Generator
+from metadata import Metadata
+
+LOGGER = logging.getLogger("tests")
+
+MESSAGES = [
+    "hola que tal",
+    "hola que pasa",
+    "que tal el día de hoy",
+    "un mensaje con ñandú y emojis 🦆",
+]
+NEW_MESSAGES = [
+    "hola que tal",
+    "algo nuevo que decir",
+    "que tal el día de mañana",
+]
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archivist = Archivist(
+            LOGGER, chatdir=self.directory.name, chatext=".vls", journal_size=2**20
+        )
+        self.tag = "1234"
+        self.card = Metadata(self.tag, "group", "Test").dumps()
+        # The Generator the bot keeps learning, and the one the files have to
+        # load as
+        self.vocab = Generator()
+        self.reference = Generator()
+        self.learn(MESSAGES)
+        self.archivist.store(self.tag, self.card, self.vocab)
+        # The number of the journal the first record file was written up to
+        self.base = record.journal_of(self.record_file())
+
+    def tearDown(self):
+        self.archivist.close()
+        self.directory.cleanup()
+
+    def learn(self, messages):
+        self.vocab.add_many(messages)
+        self.reference.add_many(messages)
+
+    def journals(self):
+        return [number for number, _ in self.archivist.journal_files(self.tag)]
+
+    def record_file(self):
+        return self.archivist.chat_file(
+            tag=self.tag, file="record", ext=record.EXTENSION
+        )
+
+    def check_loaded(self):
+        vocab = self.archivist.get_vocab(self.tag)
+        self.addCleanup(vocab.record.close)
+        self.assertEqual(vocab.to_dict(), self.reference.to_dict())
+        self.assertEqual(vocab.stats(), self.reference.stats())
+
+    def test_whole_first(self):
+        self.assertTrue(os.path.exists(self.record_file()))
+        self.assertEqual(self.journals(), [])
+        self.assertEqual(self.vocab.journal, [])
+        self.check_loaded()
+
+    def test_append(self):
+        size = os.path.getsize(self.record_file())
+        for message in NEW_MESSAGES:
+            self.learn([message])
+            job = self.archivist.prepare(self.tag, self.card, self.vocab)
+            self.assertIsNone(job.vocab)
+            self.assertEqual(len(job.journal), 1)
+            self.archivist.write(job)
+        # Only the journal grew
+        self.assertEqual(os.path.getsize(self.record_file()), size)
+        self.assertEqual(self.journals(), [self.base + 1])
+        self.check_loaded()
+
+    def test_nothing_learned(self):
+        self.archivist.store(self.tag, self.card, self.vocab)
+        self.assertEqual(self.journals(), [])
+        self.check_loaded()
+
+    def test_compaction(self):
+        self.archivist.journal_size = 1
+        self.learn(NEW_MESSAGES[:1])
+        self.archivist.store(self.tag, self.card, self.vocab)
+        self.archivist.close()
+        # The journal was folded, and new words go to the next one
+        self.assertEqual(record.journal_of(self.record_file()), self.base + 1)
+        self.assertEqual(self.journals(), [self.base + 2])
+        self.check_loaded()
+        self.learn(NEW_MESSAGES[1:])
+        self.archivist.journal_size = 2**20
+        self.archivist.store(self.tag, self.card, self.vocab)
+        self.assertEqual(self.journals(), [self.base + 2])
+        self.check_loaded()
+
+    def test_whole_after_journal(self):
+        self.learn(NEW_MESSAGES[:1])
+        self.archivist.store(self.tag, self.card, self.vocab)
+        # A Generator changed some other way is saved whole, journals included
+        self.vocab.journal = None
+        self.learn(NEW_MESSAGES[1:])
+        self.archivist.store(self.tag, self.card, self.vocab)
+        self.assertEqual(self.journals(), [])
+        self.assertEqual(record.journal_of(self.record_file()), self.base + 1)
+        self.check_loaded()
+
+    def test_cut_short(self):
+        self.learn(NEW_MESSAGES[:1])
+        self.archivist.store(self.tag, self.card, self.vocab)
+        # The bot stopped while appending a line
+        filepath = self.archivist.journal_files(self.tag)[-1][1]
+        with open(filepath, "a", encoding="utf-8") as f:
+            f.write('["\\n^MESSAGE_SEPARATOR^", "a me')
+        with self.assertLogs(LOGGER, level="WARNING"):
+            self.check_loaded()
+
+
+if __name__ == "__main__":
+    unittest.main()
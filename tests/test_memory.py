@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import tempfile
+import time
+import unittest
+
+from archivist import Archivist
+from generator import Generator
+from metadata import Metadata
+from reader import Reader
+from speaker import Speaker
+
+LOGGER = logging.getLogger("tests")
+
+
+def make_reader(cid="1234", limit=None, batch=1):
+    reader = Reader(Metadata(cid, "group", "Test"), Generator(), 1, 100, LOGGER)
+    reader.limit_memory(limit, batch)
+    return reader
+
+
+def fill(reader, n, start=0):
+    for i in range(start, start + n):
+        reader.add_memory(str(i), "mensaje número {}".format(i))
+
+
+class TestShortMemory(unittest.TestCase):
+    def test_unlimited(self):
+        reader = make_reader()
+        fill(reader, 300)
+        self.assertEqual(len(reader.short_term_mem), 300)
+
+    def test_cap(self):
+        reader = make_reader(limit=100, batch=30)
+        reference = Generator()
+        for i in range(500):
+            fill(reader, 1, i)
+            self.assertLessEqual(len(reader.short_term_mem), 100)
+            reference.add("mensaje número {}".format(i))
+        # The oldest messages were committed, in the order they were read
+        self.assertEqual(reader.short_term_mem[0].id, str(500 - 100 + 20))
+        reader.commit_memory()
+        self.assertEqual(reader.vocab.to_dict(), reference.to_dict())
+        self.assertEqual(list(reader.recent_ids)[-1], "499")
+
+    def test_replay(self):
+        reader = make_reader(limit=50, batch=10)
+        reader.replay([(str(i), "mensaje {}".format(i)) for i in range(200)])
+        self.assertLessEqual(len(reader.short_term_mem), 50)
+        self.assertEqual(reader.meta.count, 200)
+
+
+class TestBackgroundCommit(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        archivist = Archivist(
+            LOGGER,
+            chatdir=self.directory.name,
+            chatext=".vls",
+            short_memory=100,
+            commit_batch=20,
+        )
+        with self.assertLogs(LOGGER):
+            self.speaker = Speaker("@velascobot", archivist, LOGGER)
+
+    async def asyncTearDown(self):
+        if self.speaker.committing is not None:
+            self.speaker.committing.cancel()
+        await self.speaker.persister.close()
+        self.directory.cleanup()
+
+    async def test_idle(self):
+        reader = make_reader(limit=100, batch=20)
+        fill(reader, 95)
+        self.speaker.commit_overflow(reader)
+        # Nothing is committed while updates keep coming
+        for _ in range(5):
+            self.speaker.last_read = time.perf_counter()
+            await asyncio.sleep(Speaker.IDLE_TIME / 2)
+        self.assertEqual(len(reader.short_term_mem), 95)
+        await asyncio.wait_for(self.speaker.committing, 5)
+        self.assertEqual(len(reader.short_term_mem), 75)
+        self.assertEqual(self.speaker.overflowing, {})
+
+    async def test_failure(self):
+        reader = make_reader("1", limit=100, batch=20)
+        broken = make_reader("2", limit=100, batch=20)
+        fill(broken, 90)
+        fill(reader, 90)
+        # A broken vocabulary fails committing
+        broken._vocab = None
+        self.speaker.commit_overflow(broken)
+        self.speaker.commit_overflow(reader)
+        with self.assertLogs(LOGGER, level="ERROR"):
+            for _ in range(100):
+                await asyncio.sleep(Speaker.IDLE_TIME)
+                if len(self.speaker.overflowing) == 0:
+                    break
+        self.assertEqual(self.speaker.overflowing, {})
+        self.assertEqual(len(reader.short_term_mem), 70)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import tempfile
+import unittest
+
+from archivist import Archivist
+from generator import Generator
+from messagelog import MessageLog
+from metadata import Metadata
+
+LOGGER = logging.getLogger("tests")
+
+MESSAGES = [
+    ("10", "hola que tal"),
+    ("11", None),
+    ("12", "que tal el día de hoy 🦆"),
+    ("13", "hola que pasa"),
+]
+
+
+class TestMessageLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.logdir = os.path.join(self.directory.name, MessageLog.DIRECTORY)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def log(self, messages, tag="1234", batch=32):
+        log = MessageLog(self.logdir, LOGGER, batch=batch)
+        for mid, text in messages:
+            log.append(tag, mid, text)
+        return log
+
+    def test_batch(self):
+        log = MessageLog(self.logdir, LOGGER, batch=2)
+        self.assertFalse(log.append("1234", "10", "hola"))
+        self.assertTrue(log.append("1234", "11", "adiós"))
+        self.assertEqual(log.flush(), 2)
+        self.assertEqual(log.flush(), 0)
+
+    def test_replay(self):
+        self.log(MESSAGES).flush()
+        # A new run finds the segments the last one left
+        log = MessageLog(self.logdir, LOGGER)
+        self.assertEqual(log.tags(), ["1234"])
+        self.assertEqual(log.replay("1234"), MESSAGES)
+        # and never appends to them
+        log.append("1234", "14", "otro")
+        log.flush()
+        self.assertEqual(len(os.listdir(self.logdir)), 2)
+        self.assertEqual(log.replay("1234"), MESSAGES + [("14", "otro")])
+
+    def test_not_flushed(self):
+        self.log(MESSAGES)
+        self.assertEqual(MessageLog(self.logdir, LOGGER).tags(), [])
+
+    def test_seal(self):
+        log = self.log(MESSAGES[:2])
+        log.flush()
+        sealed = log.seal("1234")
+        log.append("1234", "12", MESSAGES[2][1])
+        log.remove("1234", sealed)
+        log.flush()
+        self.assertEqual(log.replay("1234"), [MESSAGES[2]])
+        log.remove("1234", log.seal("1234"))
+        self.assertEqual(log.tags(), [])
+        self.assertEqual(os.listdir(self.logdir), [])
+
+    def test_cut_short(self):
+        log = self.log(MESSAGES)
+        log.flush()
+        filepath = log.segment_file("1234", log.number("1234"))
+        with open(filepath, "a", encoding="utf-8") as f:
+            f.write('["14", "a me')
+        with self.assertLogs(LOGGER, level="WARNING"):
+            entries = MessageLog(self.logdir, LOGGER).replay("1234")
+        self.assertEqual(entries, MESSAGES)
+
+
+class TestRecovery(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.logdir = os.path.join(self.directory.name, MessageLog.DIRECTORY)
+        self.tag = "1234"
+        archivist = self.archivist()
+        archivist.store(
+            self.tag, Metadata(self.tag, "group", "Test").dumps(), Generator()
+        )
+        archivist.close()
+        # The messages a run read and logged before it stopped without saving
+        log = MessageLog(self.logdir, LOGGER)
+        for mid, text in MESSAGES:
+            log.append(self.tag, mid, text)
+        log.flush()
+        self.reference = Generator()
+        self.reference.add_many(text for _, text in MESSAGES if text is not None)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def archivist(self):
+        archivist = Archivist(
+            LOGGER,
+            chatdir=self.directory.name,
+            chatext=".vls",
+            message_log=MessageLog(self.logdir, LOGGER),
+        )
+        self.addCleanup(archivist.close)
+        return archivist
+
+    def check_saved(self):
+        archivist = Archivist(LOGGER, chatdir=self.directory.name, chatext=".vls")
+        reader = archivist.get_reader(self.tag)
+        self.addCleanup(reader.vocab.record.close)
+        self.assertEqual(reader.vocab.to_dict(), self.reference.to_dict())
+        self.assertEqual(reader.meta.count, len(MESSAGES))
+
+    def test_get_reader(self):
+        reader = self.archivist().get_reader(self.tag)
+        self.assertEqual(reader.meta.count, len(MESSAGES))
+        self.assertEqual(len(reader.short_term_mem), 3)
+        reader.commit_memory()
+        self.assertEqual(reader.vocab.to_dict(), self.reference.to_dict())
+
+    def test_recover(self):
+        archivist = self.archivist()
+        archivist.recover_log()
+        self.assertEqual(archivist.message_log.tags(), [])
+        self.assertEqual(os.listdir(self.logdir), [])
+        self.check_saved()
+
+    def test_update(self):
+        archivist = self.archivist()
+        archivist.update_chat(self.tag)
+        self.assertEqual(archivist.message_log.tags(), [])
+        self.check_saved()
+
+    def test_read_only(self):
+        archivist = self.archivist()
+        archivist.read_only = True
+        archivist.recover_log()
+        self.assertEqual(archivist.message_log.tags(), [self.tag])
+
+
+if __name__ == "__main__":
+    unittest.main()
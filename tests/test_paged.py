@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import tempfile
+import unittest
+
+import record
+from archivist import Archivist
+from generator import Generator, PagedGenerator
+from metadata import Metadata
+
+LOGGER = logging.getLogger("tests")
+
+
+# Messages with many different keys
+def messages(start, n):
+    return [
+        "mensaje {} dice palabra{} y palabra{} luego".format(i, i, i * 7)
+        for i in range(start, start + n)
+    ]
+
+
+class TestPagedGenerator(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filepath = os.path.join(self.directory.name, "record" + record.EXTENSION)
+        self.reference = Generator()
+        self.reference.add_many(messages(0, 200))
+        record.save(self.reference, self.filepath)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def paged(self, capacity):
+        records = record.RecordFile(self.filepath)
+        self.addCleanup(records.close)
+        return PagedGenerator(records, capacity)
+
+    def test_bounded(self):
+        vocab = self.paged(50)
+        self.assertGreater(vocab.n_keys, 50)
+        for key, _ in list(vocab.record.items()):
+            self.assertIsNotNone(vocab.lookup(key))
+            self.assertLessEqual(vocab.resident(), 50)
+        self.assertEqual(vocab.faults, vocab.n_keys)
+        self.assertEqual(vocab.evictions, vocab.n_keys - 50)
+        self.assertEqual(vocab.to_dict(), self.reference.to_dict())
+        for _ in range(20):
+            self.assertGreater(len(vocab.generate()), 0)
+        self.assertLessEqual(vocab.resident(), 50)
+
+    def test_learn(self):
+        for capacity in (0, 1, 50):
+            vocab = self.paged(capacity)
+            reference = Generator()
+            reference.add_many(messages(0, 200))
+            for message in messages(100, 150):
+                vocab.add(message)
+                reference.add(message)
+            # The changed keys are never dropped, only the ones paged in
+            self.assertEqual(vocab.to_dict(), reference.to_dict())
+            self.assertEqual(vocab.stats(), reference.stats())
+            self.assertEqual(len(vocab.paged), 0)
+            self.assertTrue(vocab.over_capacity())
+
+    def test_refresh(self):
+        vocab = self.paged(50)
+        vocab.add_many(messages(200, 100))
+        self.assertTrue(vocab.over_capacity())
+        spill = vocab.spill()
+        self.assertFalse(vocab.over_capacity())
+        record.save(vocab, self.filepath)
+        # Learned while the spill was being written
+        vocab.add("mensaje nuevo que no está escrito")
+        changed = len(vocab.fresh)
+        self.assertTrue(vocab.refresh(spill, record.RecordFile(self.filepath)))
+        self.addCleanup(vocab.record.close)
+        self.assertEqual(len(vocab.cache), changed)
+        self.assertFalse(vocab.over_capacity())
+        self.reference.add_many(messages(200, 100))
+        self.reference.add("mensaje nuevo que no está escrito")
+        self.assertEqual(vocab.to_dict(), self.reference.to_dict())
+
+    def test_stale_refresh(self):
+        vocab = self.paged(50)
+        old = vocab.spill()
+        vocab.spill()
+        records = record.RecordFile(self.filepath)
+        self.assertFalse(vocab.refresh(old, records))
+        self.assertTrue(records._map.closed)
+        self.assertIsNotNone(vocab.spilling)
+
+
+class TestPagedArchivist(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archivist = Archivist(
+            LOGGER, chatdir=self.directory.name, chatext=".vls", resident_keys=50
+        )
+        self.tag = "1234"
+        self.card = Metadata(self.tag, "group", "Test").dumps()
+        self.reference = Generator()
+        self.reference.add_many(messages(0, 200))
+        self.archivist.store(self.tag, self.card, self.reference.copy())
+
+    def tearDown(self):
+        self.archivist.close()
+        self.directory.cleanup()
+
+    def test_spill(self):
+        vocab = self.archivist.get_vocab(self.tag)
+        self.assertIsInstance(vocab, PagedGenerator)
+        spills = 0
+        for i in range(200, 400, 10):
+            vocab.add_many(messages(i, 10))
+            self.reference.add_many(messages(i, 10))
+            job = self.archivist.prepare(self.tag, self.card, vocab)
+            if job.spill is not None:
+                self.assertIsNotNone(job.vocab)
+                spills += 1
+            self.archivist.write(job)
+            self.archivist.end_spill(job)
+            self.assertLessEqual(len(vocab.cache), 50)
+        self.assertGreater(spills, 0)
+        self.assertEqual(vocab.to_dict(), self.reference.to_dict())
+        vocab.record.close()
+        loaded = self.archivist.get_vocab(self.tag)
+        self.addCleanup(loaded.record.close)
+        self.assertEqual(loaded.to_dict(), self.reference.to_dict())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+import record
+from generator import Generator
+
+MESSAGES = [
+    "hola que tal",
+    "hola que pasa",
+    "Hola QUE tal estás",
+    "que tal el día de hoy",
+    "^IS_STICKER^ CAACAgIAAxkBAAI",
+    "un mensaje con ñandú y emojis 🦆🦆",
+    "hola que tal",
+]
+
+
+class TestRecord(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filepath = os.path.join(self.directory.name, "record" + record.EXTENSION)
+        self.gen = Generator()
+        self.gen.add_many(MESSAGES)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def load(self):
+        records = record.RecordFile(self.filepath)
+        self.addCleanup(records.close)
+        return Generator(load=records, mode=Generator.MODE_RECORD)
+
+    def test_round_trip(self):
+        record.save(self.gen, self.filepath, journal=3)
+        loaded = self.load()
+        self.assertEqual(loaded.to_dict(), self.gen.to_dict())
+        self.assertEqual(loaded.stats(), self.gen.stats())
+        self.assertEqual(record.journal_of(self.filepath), 3)
+        self.assertEqual(len(loaded.cache), 0)
+
+    def test_learn_after_loading(self):
+        record.save(self.gen, self.filepath)
+        loaded = self.load()
+        loaded.add_many(["hola que tal", "algo nuevo que decir"])
+        self.gen.add_many(["hola que tal", "algo nuevo que decir"])
+        self.assertEqual(loaded.to_dict(), self.gen.to_dict())
+        self.assertEqual(loaded.stats(), self.gen.stats())
+
+    def test_generate(self):
+        record.save(self.gen, self.filepath)
+        loaded = self.load()
+        for _ in range(20):
+            self.assertGreater(len(loaded.generate()), 0)
+
+    def test_trie(self):
+        self.gen.set_order(4)
+        self.gen.add_many(MESSAGES)
+        record.save(self.gen, self.filepath)
+        loaded = self.load()
+        self.assertIsNotNone(loaded.trie)
+        self.assertEqual(loaded.to_dict(), self.gen.to_dict())
+
+    def test_not_a_record(self):
+        with open(self.filepath, "wb") as f:
+            f.write(b"not a record file at all")
+        with self.assertRaises(ValueError):
+            record.RecordFile(self.filepath)
+        open(self.filepath, "wb").close()
+        with self.assertRaises(ValueError):
+            record.RecordFile(self.filepath)
+
+
+if __name__ == "__main__":
+    unittest.main()
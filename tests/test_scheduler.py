@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import time
+import unittest
+from datetime import timedelta
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from scheduler import SendScheduler, TokenBucket
+
+LOGGER = logging.getLogger("tests")
+
+
+# A fake send: records the chat and text, and raises the errors given first
+class Sender(object):
+    def __init__(self, errors=None):
+        self.sent = []
+        self.errors = list(errors or [])
+
+    def __call__(self, cid, text):
+        async def send():
+            await asyncio.sleep(0)
+            if self.errors:
+                raise self.errors.pop(0)
+            self.sent.append((cid, text))
+            return text
+
+        return send
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_delay(self):
+        bucket = TokenBucket(2, burst=2)
+        now = bucket.stamp
+        self.assertEqual(bucket.delay(now), 0)
+        bucket.take(now)
+        bucket.take(now)
+        self.assertAlmostEqual(bucket.delay(now), 0.5)
+        self.assertAlmostEqual(bucket.delay(now + 0.25), 0.25)
+        self.assertAlmostEqual(bucket.full_in(now + 0.5), 0.5)
+        self.assertEqual(bucket.delay(now + 10), 0)
+        self.assertEqual(bucket.tokens, 2)
+
+
+class TestSendScheduler(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await self.scheduler.close()
+
+    def make(self, **kwargs):
+        kwargs.setdefault("rate", 1000)
+        kwargs.setdefault("burst", 1000)
+        kwargs.setdefault("chat_rate", 1000)
+        kwargs.setdefault("group_rate", 1000)
+        self.scheduler = SendScheduler(LOGGER, **kwargs)
+        return self.scheduler
+
+    async def test_priority(self):
+        scheduler = self.make()
+        sender = Sender()
+        futures = [
+            scheduler.submit(1, sender(1, "periodic"), SendScheduler.PERIODIC),
+            scheduler.submit(1, sender(1, "announce"), SendScheduler.ANNOUNCE),
+            scheduler.submit(1, sender(1, "reply"), SendScheduler.REPLY),
+            scheduler.submit(1, sender(1, "periodic 2"), SendScheduler.PERIODIC),
+        ]
+        results = await asyncio.gather(*futures)
+        self.assertEqual(results, ["periodic", "announce", "reply", "periodic 2"])
+        self.assertEqual(
+            [text for _, text in sender.sent],
+            ["reply", "periodic", "periodic 2", "announce"],
+        )
+        self.assertEqual(scheduler.sent, 4)
+        self.assertEqual(scheduler.depth(), 0)
+
+    async def test_global_rate(self):
+        scheduler = self.make(rate=20, burst=1)
+        sender = Sender()
+        start = time.monotonic()
+        await asyncio.gather(
+            *[scheduler.submit(cid, sender(cid, "hola")) for cid in range(6)]
+        )
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(len(sender.sent), 6)
+
+    async def test_chat_rate(self):
+        scheduler = self.make(chat_rate=1000, group_rate=10)
+        sender = Sender()
+        start = time.monotonic()
+        await asyncio.gather(*[scheduler.submit(-5, sender(-5, i)) for i in range(3)])
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+        self.assertEqual([text for _, text in sender.sent], [0, 1, 2])
+
+    async def test_retry_after(self):
+        scheduler = self.make()
+        sender = Sender([RetryAfter(timedelta(seconds=0.1))])
+        with self.assertLogs(LOGGER, level="WARNING"):
+            future = scheduler.submit(1, sender(1, "hola"), SendScheduler.REPLY)
+            await asyncio.sleep(0.02)
+            self.assertGreater(scheduler.paused(1), 0)
+            self.assertEqual(scheduler.paused(2), 0)
+            self.assertEqual(await future, "hola")
+        self.assertEqual(scheduler.retried, 1)
+
+    async def test_network_errors(self):
+        scheduler = self.make(retries=2, backoff=0.01)
+        sender = Sender([NetworkError("timed out")] * 3)
+        with self.assertLogs(LOGGER, level="WARNING"):
+            with self.assertRaises(NetworkError):
+                await scheduler.send(1, sender(1, "hola"), SendScheduler.REPLY)
+        self.assertEqual(scheduler.retried, 2)
+        self.assertEqual(scheduler.failures, 1)
+        # Other chats aren't held back by a single one
+        self.assertEqual(scheduler.paused(), 0)
+
+    async def test_bad_request(self):
+        scheduler = self.make()
+        sender = Sender([BadRequest("chat not found")])
+        with self.assertRaises(BadRequest):
+            await scheduler.send(1, sender(1, "hola"))
+        self.assertEqual(scheduler.retried, 0)
+
+    async def test_drop(self):
+        scheduler = self.make(deferred=SendScheduler.DROP, backoff=10)
+        sender = Sender([NetworkError("timed out")])
+        with self.assertLogs(LOGGER, level="WARNING"):
+            with self.assertRaises(asyncio.CancelledError):
+                await scheduler.send(1, sender(1, "hola"))
+            self.assertTrue(scheduler.would_drop(1, SendScheduler.PERIODIC))
+            self.assertFalse(scheduler.would_drop(1, SendScheduler.REPLY))
+            future = scheduler.submit(1, sender(1, "adiós"))
+        self.assertTrue(future.cancelled())
+        self.assertEqual(scheduler.dropped, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import random
+import unittest
+from collections import Counter
+
+from generator import Generator, Successors, compact, grow, pick, successors
+
+
+class TestSuccessors(unittest.TestCase):
+    def test_add_counts(self):
+        succ = Successors.FromList(["a", "b", "a", "c", "a"])
+        self.assertEqual(list(succ.items()), [("a", 3), ("b", 1), ("c", 1)])
+        self.assertEqual(succ.total, 5)
+        succ.add("b", 4)
+        self.assertEqual(dict(succ.items()), {"a": 3, "b": 5, "c": 1})
+        self.assertEqual(succ.total, 9)
+        self.assertEqual(sorted(succ.to_list()), sorted("aaabbbbbc"))
+
+    def test_index(self):
+        words = ["w{}".format(i) for i in range(Successors.INDEX_SIZE * 2)]
+        succ = Successors()
+        for word in words + words[:5]:
+            succ.add(word)
+        self.assertIsNotNone(succ._index)
+        self.assertEqual(len(succ), len(words))
+        self.assertEqual(succ.counts[:5], [2] * 5)
+        self.assertEqual(succ.total, len(words) + 5)
+        for i, word in enumerate(words):
+            self.assertEqual(succ._index[word], i)
+
+    def test_copy(self):
+        succ = Successors(["a", "b"], [2, 3])
+        other = succ.copy()
+        other.add("a")
+        self.assertEqual(dict(succ.items()), {"a": 2, "b": 3})
+        self.assertEqual(dict(other.items()), {"a": 3, "b": 3})
+
+    # Samples a Successors and checks that every word comes up about as often
+    # as its count says, and none that isn't in it
+    def check_sampling(self, succ, n=40000):
+        random.seed(1)
+        seen = Counter(succ.choice() for _ in range(n))
+        self.assertLessEqual(set(seen), set(succ.words))
+        for word, count in succ.items():
+            expected = n * count / succ.total
+            self.assertAlmostEqual(seen[word], expected, delta=0.1 * expected + 50)
+
+    def test_choice_scan(self):
+        succ = Successors(["a", "b", "c"], [1, 5, 10])
+        self.assertLessEqual(len(succ), Successors.SCAN_SIZE)
+        self.check_sampling(succ)
+        self.assertIsNone(succ._alias)
+
+    def test_choice_alias(self):
+        words = ["w{}".format(i) for i in range(20)]
+        succ = Successors(words, [i + 1 for i in range(20)])
+        self.check_sampling(succ)
+        self.assertIsNotNone(succ._alias)
+        # The table is built again after a change
+        succ.add("w0", 100)
+        self.assertIsNone(succ._alias)
+        self.check_sampling(succ)
+
+    def test_choice_single(self):
+        self.assertEqual(Successors(["a"], [7]).choice(), "a")
+
+    def test_compact_values(self):
+        self.assertEqual(compact([(4, 1)]), 4)
+        value = compact([(4, 2)])
+        self.assertIsInstance(value, Successors)
+        self.assertEqual(list(successors(value)), [(4, 2)])
+        self.assertEqual(list(successors(4)), [(4, 1)])
+        value = grow(None, 4)
+        self.assertEqual(value, 4)
+        value = grow(value, 5)
+        value = grow(value, 4, 2)
+        self.assertEqual(dict(successors(value)), {4: 3, 5: 1})
+        self.assertEqual(pick(4), 4)
+        self.assertIn(pick(value), (4, 5))
+
+
+class TestGeneratorCounts(unittest.TestCase):
+    def test_counts_learned(self):
+        gen = Generator()
+        for _ in range(3):
+            gen.add("hola que tal")
+        gen.add("hola que pasa")
+        cache = gen.to_dict()
+        self.assertEqual(cache[Generator.HEAD], {"hola": 4})
+        self.assertEqual(cache[str(("hola", "que"))], {"tal": 3, "pasa": 1})
+        self.assertEqual(gen.n_tokens, 12)
+
+    def test_legacy_lists(self):
+        # Dumps made before the counts were kept list every word as seen
+        key = str(("hola", "que"))
+        gen = Generator.loads(
+            json.dumps({Generator.HEAD: ["hola", "hola"], key: ["tal", "pasa", "tal"]})
+        )
+        self.assertEqual(gen.to_dict()[key], {"tal": 2, "pasa": 1})
+        self.assertEqual(gen.to_dict()[Generator.HEAD], {"hola": 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
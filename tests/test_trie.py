@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import tempfile
+import unittest
+
+from database import DatabaseArchivist
+from generator import Generator
+from metadata import Metadata
+
+LOGGER = logging.getLogger("tests")
+
+MESSAGES = [
+    "el perro come y luego duerme",
+    "el perro come y luego corre",
+    "El Perro come pienso",
+    "el gato come y luego duerme la siesta",
+    "hoy el perro come y luego duerme",
+]
+NEW_MESSAGES = [
+    "el perro come y luego ladra",
+    "mañana el gato come y luego duerme",
+]
+
+
+# The dump of a Generator, with the edges of its ChainTrie in order, as the
+# order they're dumped in depends on the IDs of their words
+def normalized(gen):
+    cache = gen.to_dict()
+    if Generator.TRIE in cache:
+        cache[Generator.TRIE]["edges"].sort()
+    return cache
+
+
+class TestChainTrie(unittest.TestCase):
+    def setUp(self):
+        self.gen = Generator()
+        self.gen.set_order(4)
+        self.gen.add_many(MESSAGES)
+
+    def test_json(self):
+        loaded = Generator.loads(self.gen.dumps())
+        self.assertEqual(loaded.order(), 4)
+        self.assertEqual(normalized(loaded), normalized(self.gen))
+        # The casefolded words the trie is keyed by aren't added as words
+        self.assertEqual(len(loaded.tokens), len(self.gen.tokens))
+        self.assertEqual(loaded.trie.transitions(), self.gen.trie.transitions())
+
+    def test_lookup(self):
+        tokens = self.gen.tokens
+        folds = [tokens.fold(tokens.ids[w]) for w in ["perro", "come", "y", "luego"]]
+        value = self.gen.trie.lookup(folds)
+        words = {tokens.word(w) for w, _ in value.items()}
+        self.assertEqual(words, {"duerme", "corre"})
+        self.assertIsNone(self.gen.trie.lookup(folds[:2]))
+
+    def test_generate(self):
+        for _ in range(20):
+            self.assertGreater(len(self.gen.generate()), 0)
+
+    def test_order(self):
+        self.gen.set_order(3)
+        self.assertEqual(self.gen.order(), 3)
+        self.assertLessEqual(max(self.gen.trie.depths()), 3)
+        self.assertIsNone(self.gen.journal)
+        self.gen.set_order(2)
+        self.assertIsNone(self.gen.trie)
+        self.assertNotIn(Generator.TRIE, self.gen.to_dict())
+
+
+class TestDatabaseTrie(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archivist = DatabaseArchivist(
+            LOGGER, chatdir=self.directory.name, chatext=".vls"
+        )
+        self.tag = "1234"
+        self.card = Metadata(self.tag, "group", "Test", order=4).dumps()
+        self.vocab = Generator()
+        self.vocab.set_order(4)
+        self.vocab.add_many(MESSAGES)
+        self.archivist.store(self.tag, self.card, self.vocab)
+
+    def tearDown(self):
+        self.archivist.close()
+        self.directory.cleanup()
+
+    def test_whole(self):
+        loaded = self.archivist.get_vocab(self.tag)
+        self.assertIsNotNone(loaded.trie)
+        self.assertEqual(normalized(loaded), normalized(self.vocab))
+        self.assertGreater(self.archivist.vocab_size(self.tag), 0)
+
+    def test_journal(self):
+        self.vocab.add_many(NEW_MESSAGES)
+        job = self.archivist.prepare(self.tag, self.card, self.vocab)
+        self.assertIsNone(job.vocab)
+        self.assertGreater(self.archivist.write(job), 0)
+        loaded = self.archivist.get_vocab(self.tag)
+        self.assertEqual(normalized(loaded), normalized(self.vocab))
+
+    def test_lower_order(self):
+        self.vocab.set_order(2)
+        self.archivist.store(self.tag, self.card, self.vocab)
+        self.assertIsNone(self.archivist.get_vocab(self.tag).trie)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,12 +2,18 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import asyncio
 import logging
+import os
 
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 
 # from telegram.error import *
 from archivist import Archivist
+from database import DatabaseArchivist
+from messagelog import MessageLog
+from metrics import MetricsServer
+from profiler import PROFILER
 from speaker import Speaker
 
 coloredlogsError = None
@@ -132,13 +138,31 @@ def main():
         default=20,
         help="The memory capacity for the last C updated chats. (default: 20).",
     )
+    parser.add_argument(
+        "-S",
+        "--short_memory",
+        metavar="N",
+        type=int,
+        default=500,
+        help="The maximum number of messages a chat keeps before committing them to"
+        + " its vocabulary, which is done a batch at a time. (default: 500)",
+    )
+    parser.add_argument(
+        "--commit_batch",
+        metavar="N",
+        type=int,
+        default=50,
+        help="The number of messages committed at a time from a full short term"
+        + " memory. (default: 50)",
+    )
     parser.add_argument(
         "-m",
         "--mute_time",
         metavar="T",
         type=int,
         default=60,
-        help="The time (in s) for the muting period when Telegram limits the bot. (default: 60).",
+        help="The maximum time (in s) to back off for after Telegram network errors."
+        + " (default: 60).",
     )
     parser.add_argument(
         "-s",
@@ -165,25 +189,151 @@ def main():
         help="The maximum value for a chat's period. (default: 100000)",
     )
 
+    parser.add_argument(
+        "-D",
+        "--database",
+        metavar="FILE",
+        nargs="?",
+        const="",
+        default=None,
+        help="Store the chats in a SQLite database instead of the chat logs directory"
+        + ' (default file: "CHATLOG_DIR/{}").'.format(DatabaseArchivist.FILENAME),
+    )
+
+    parser.add_argument(
+        "-k",
+        "--resident_keys",
+        metavar="K",
+        type=int,
+        default=None,
+        help="The maximum number of chain keys read from a chat's record file kept in"
+        + " memory. (default: all of them)",
+    )
+
+    parser.add_argument(
+        "-V",
+        "--vocab_limit",
+        metavar="MIB",
+        type=float,
+        default=None,
+        help="The size budget (in MiB) of a chat's vocabulary, over which its least"
+        + " frequent transitions are pruned when it's saved. A chat's card can set"
+        + " its own. (default: no limit)",
+    )
+
+    parser.add_argument(
+        "-L",
+        "--no_message_log",
+        action="store_true",
+        help="Don't log the messages read until their chat is saved, so that a crash"
+        + " loses every message read since the last save.",
+    )
+
+    parser.add_argument(
+        "-r",
+        "--send_rate",
+        metavar="RATE",
+        type=float,
+        default=25,
+        help="The maximum number of messages per second sent overall. (default: 25)",
+    )
+    parser.add_argument(
+        "-R",
+        "--group_rate",
+        metavar="RATE",
+        type=float,
+        default=20,
+        help="The maximum number of messages per minute sent to a group. (default: 20)",
+    )
+
+    parser.add_argument(
+        "--deferred",
+        choices=["queue", "drop"],
+        default="queue",
+        help="Whether periodic messages that have to wait for Telegram's limits are"
+        + " kept queued or dropped. (default: queue)",
+    )
+
+    parser.add_argument(
+        "-M",
+        "--metrics_port",
+        metavar="PORT",
+        type=int,
+        default=None,
+        help="Serve the bot's metrics in the Prometheus text format on"
+        + " http://127.0.0.1:PORT/metrics. (default: off)",
+    )
+
+    parser.add_argument(
+        "--profile",
+        metavar="SECONDS",
+        nargs="?",
+        type=float,
+        const=60,
+        default=None,
+        help="Profile the bot for its first SECONDS (default: 60) after starting.",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        metavar="DIR",
+        default="profiles",
+        help="The folder where profiles are written. (default: profiles)",
+    )
+
     args = parser.parse_args()
 
     assert args.max_period >= args.min_period
+    if args.resident_keys is not None and args.resident_keys < 1:
+        parser.error("--resident_keys has to be at least 1.")
+    if args.short_memory < 1 or args.commit_batch < 1:
+        parser.error("--short_memory and --commit_batch have to be at least 1.")
 
     # Create the Application and pass it your bot's token.
     application = Application.builder().token(args.token).build()
 
+    vocab_limit = None
+    if args.vocab_limit is not None:
+        vocab_limit = int(args.vocab_limit * 2**20)
+
     filter_cids = args.filter
     if filter_cids:
         filter_cids.append(str(args.admin_id))
 
-    archivist = Archivist(
-        logger,
-        chatdir=args.directory,
-        chatext=".vls",
-        min_period=args.min_period,
-        max_period=args.max_period,
-        read_only=False,
-    )
+    message_log = None
+    if not args.no_message_log:
+        message_log = MessageLog(
+            os.path.join(args.directory, MessageLog.DIRECTORY), logger
+        )
+
+    if args.database is None:
+        archivist = Archivist(
+            logger,
+            chatdir=args.directory,
+            chatext=".vls",
+            min_period=args.min_period,
+            max_period=args.max_period,
+            read_only=False,
+            resident_keys=args.resident_keys,
+            vocab_limit=vocab_limit,
+            message_log=message_log,
+            short_memory=args.short_memory,
+            commit_batch=args.commit_batch,
+        )
+    else:
+        archivist = DatabaseArchivist(
+            logger,
+            chatdir=args.directory,
+            chatext=".vls",
+            database=args.database,
+            min_period=args.min_period,
+            max_period=args.max_period,
+            read_only=False,
+            resident_keys=args.resident_keys,
+            vocab_limit=vocab_limit,
+            message_log=message_log,
+            short_memory=args.short_memory,
+            commit_batch=args.commit_batch,
+        )
 
     # We'll get the username after the application starts
     # For now, use a placeholder that will be updated
@@ -199,14 +349,36 @@ def main():
         memory=args.capacity,
         mute_time=args.mute_time,
         save_time=args.save_time,
+        send_rate=args.send_rate,
+        group_rate=args.group_rate,
+        deferred=args.deferred,
     )
 
+    PROFILER.directory = args.profile_dir
+
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = MetricsServer(logger, args.metrics_port)
+
     # Define a post-init callback to send wake message after bot starts
     async def post_init(app):
+        if metrics_server is not None:
+            metrics_server.loop = asyncio.get_running_loop()
+            metrics_server.start()
+        if args.profile is not None:
+            speakerbot.start_profile(args.profile)
         await speakerbot.wake(app.bot, wake_msg)
 
-    # Set the post_init callback on the application
+    # Save every chat in memory and wait for all files to be written
+    async def post_shutdown(app):
+        await speakerbot.close()
+        archivist.close()
+        if metrics_server is not None:
+            metrics_server.close()
+
+    # Set the post_init and post_shutdown callbacks on the application
     application.post_init = post_init
+    application.post_shutdown = post_shutdown
 
     # Add handlers to the application
     application.add_handler(CommandHandler("start", static_reply(start_msg)))
@@ -220,6 +392,20 @@ def main():
             "list", speakerbot.get_chats, filters=filters.Chat(chat_id=speakerbot.admin)
         )
     )
+    application.add_handler(
+        CommandHandler(
+            "metrics",
+            speakerbot.get_metrics,
+            filters=filters.Chat(chat_id=speakerbot.admin),
+        )
+    )
+    application.add_handler(
+        CommandHandler(
+            "profile",
+            speakerbot.profile,
+            filters=filters.Chat(chat_id=speakerbot.admin),
+        )
+    )
     # application.add_handler(CommandHandler("user", get_name, filters.Chat(chat_id=archivist.admin)))
     # application.add_handler(CommandHandler("id", get_id))
     application.add_handler(CommandHandler("stop", stop))